@@ -28,28 +28,44 @@
 #              greyscale only).
 # 13 Sep 2013: Update code for COMP10001 project 2, semester 2 2013.
 #
+# Lazy imports: PIL is imported inside the functions that need it, so
+#              that importing this module (and steganography etc.) is fast
+#              for short-lived command line runs.
+# Fast conversion: to_rectangle cuts images from PIL straight out of the
+#              pixel buffer; other sources are validated in bulk.
+#
 ################################################################################
 
-from PIL import Image
+import struct
 
-def read_image(filename):
+def read_image(filename, native=False):
     """read_image(filename) -> list of lists of pixel intensities
     
     Output image is rectangular, RGB, in row major coordinates.
+    With native=True the image keeps its own mode if it is one of
+    NATIVE_MODES (see to_rectangle).
     """
+    from PIL import Image
     image = Image.open(filename)
-    return to_rectangle(image)
+    return to_rectangle(image, native)
 
-def write_image(image, filename):
+def write_image(image, filename, mode='RGB', profile=None, lossless=False,
+                workers=1):
     """write_image(image, filename) -> None
 
     Writes image data file to filename.
 
-    Input image must be rectangular, RGB,
+    Input image must be rectangular, RGB (or the given mode),
     in row major coordinates.
+    profile is one of SAVE_PROFILES (default: PIL's own settings), and
+    lossless=True rejects lossy formats (see save_image).
     """
-    out_image = to_flat(image)
-    out_image.save(filename)
+    # check the format before doing any work
+    image_format = output_format(filename)
+    if lossless:
+        check_lossless(image_format)
+    out_image = to_flat(image, mode)
+    save_image(out_image, filename, profile, image_format, lossless, workers)
 
 def get_width(image):
     """get_width(image) -> integer width of the image (number of columns).
@@ -80,41 +96,415 @@ def clip(n):
 
 #### Extra stuff added by Adrian Cheung ####
 
+# Modes that can be worked on directly, without converting to RGB:
+# mode -> (intensity values per pixel, bits per intensity value).
+# In native mode every pixel is still a tuple, e.g. (v,) for greyscale.
+NATIVE_MODES = {
+    'L': (1, 8),
+    'LA': (2, 8),
+    'RGB': (3, 8),
+    'RGBA': (4, 8),
+    'I;16': (1, 16),
+    'I;16B': (1, 16),
+    'I;16L': (1, 16),
+}
+
+def native_mode(mode):
+    """native_mode(mode) -> mode
+
+    The mode an image of the given mode is read in with native=True.
+    """
+    if mode in NATIVE_MODES:
+        return mode
+    return 'RGB'
+
+def get_channels(mode):
+    """get_channels(mode) -> number of intensity values per pixel"""
+    return NATIVE_MODES[mode][0]
+
+def get_depth(mode):
+    """get_depth(mode) -> number of bits per intensity value"""
+    return NATIVE_MODES[mode][1]
+
+def capacity(mode, width, height, num_bits):
+    """capacity(mode, width, height, num_bits) -> integer
+
+    Number of bits that can be hidden in a width x height image of the
+    given mode, using num_bits bits of each intensity value.
+    """
+    return width * height * get_channels(mode) * num_bits
+
+def open_image(filename):
+    """open_image(filename) -> PIL Image
+
+    Opens the image without converting it to rectangular format, for
+    callers that only need part of it (see to_rectangle).
+    """
+    from PIL import Image
+    return Image.open(filename)
+
+def read_size(filename):
+    """read_size(filename) -> (width, height)
+
+    Reads only the image header; no pixel data is decoded.
+    """
+    from PIL import Image
+    image = Image.open(filename)
+    try:
+        return image.size
+    finally:
+        image.close()
+
+# formats read_rows can stop decoding early (see the checks there)
+PARTIAL_DECODE_FORMATS = ('PNG', 'BMP', 'PPM', 'TGA')
+
+def read_rows(filename, rows):
+    """read_rows(filename, rows) -> PIL Image of the top rows of the image
+
+    For PNG (non-interlaced) and uncompressed BMP, PPM and TGA files only
+    those rows are decoded; the decoder stops once they are filled. Other
+    files are decoded in full and cropped. rows <= 0 gives an empty
+    (zero-height) image.
+    """
+    from PIL import Image
+    image = Image.open(filename)
+    width, height = image.size
+    rows = max(0, min(rows, height))
+    if rows == height:
+        return image
+    if rows == 0:
+        empty = Image.new(image.mode, (width, 0))
+        image.close()
+        return empty
+    tiles = image.tile
+    # only these decoders write the image top-down, line by line, so they
+    # can be stopped early by shrinking the image; others (e.g. TIFF)
+    # ignore the shortened tile and decode the whole image
+    if image.format in PARTIAL_DECODE_FORMATS and len(tiles) == 1 and \
+            not image.info.get('interlace') and \
+            tuple(tiles[0][1]) == (0, 0, width, height):
+        codec, extents, offset, args = tiles[0]
+        leading = None
+        if codec == 'zip':
+            leading = offset
+        elif codec == 'raw':
+            if isinstance(args, str):
+                args = (args,)
+            stride = args[1] if len(args) > 1 else 0
+            orientation = args[2] if len(args) > 2 else 1
+            if orientation >= 0:
+                leading = offset
+            elif stride:
+                # stored bottom up: the top rows are at the end
+                leading = offset + (height - rows) * stride
+        if leading is not None:
+            # shrink the image so the decoder stops after these rows
+            image._size = (width, rows)
+            image.tile = [(codec, (0, 0, width, rows), leading, args)]
+            image.load()
+            return image
+    return image.crop((0, 0, width, rows))
+
+# Output profiles: PNG compression is often slower than the encode itself,
+# so callers can pick a speed/size trade-off. Per format: save options for
+# PIL, plus the row filter used by the parallel PNG writer below.
+# The 'balanced' PNG settings are PIL's defaults.
+SAVE_PROFILES = {
+    'fastest': {
+        'PNG': {'compress_level': 1, 'compress_type': 2},  # Z_HUFFMAN_ONLY
+        'TIFF': {'compression': None},
+        'WEBP': {'lossless': True, 'method': 0, 'quality': 0},
+        'png_filter': 'sub',
+    },
+    'balanced': {
+        'PNG': {'compress_level': 6},
+        'TIFF': {'compression': 'tiff_lzw'},
+        'WEBP': {'lossless': True, 'method': 4, 'quality': 80},
+        'png_filter': 'up',
+    },
+    'smallest': {
+        'PNG': {'compress_level': 9, 'optimize': True},
+        'TIFF': {'compression': 'tiff_adobe_deflate'},
+        'WEBP': {'lossless': True, 'method': 6, 'quality': 100},
+        'png_filter': 'up',
+    },
+}
+
+# Formats that would destroy hidden bits (WebP is saved losslessly when
+# lossless=True). GIF is here too: PIL reduces images to a 256 colour
+# palette to save them as GIF, which changes the pixel values.
+LOSSY_FORMATS = ('JPEG', 'MPO', 'JPEG2000', 'GIF')
+
+# Images with more pixels than this are compressed in strips on several
+# threads when save_image is given workers > 1
+STRIP_THRESHOLD = 4000000
+
+def output_format(filename, image_format=None):
+    """output_format(filename) -> PIL format name, from the extension"""
+    if image_format:
+        return image_format.upper()
+    from PIL import Image
+    extension = filename[filename.rfind('.'):].lower() if '.' in filename \
+        else ''
+    try:
+        return Image.registered_extensions()[extension]
+    except KeyError:
+        raise ValueError('Unknown image format: {}'.format(filename))
+
+def check_lossless(image_format):
+    """check_lossless(format) -> None
+
+    Raises ValueError if the format is lossy, i.e. would destroy data hidden
+    in the low bits of the pixels.
+    """
+    if image_format.upper() in LOSSY_FORMATS:
+        raise ValueError('{} does not keep pixel values exactly and would '
+                         'destroy the hidden data; use PNG, BMP, TIFF or '
+                         'WebP'.format(image_format))
+
+def save_image(image, filename, profile=None, image_format=None,
+               lossless=False, workers=1):
+    """save_image(PIL image, filename) -> None
+
+    Saves a PIL image with the options of the given profile (one of
+    SAVE_PROFILES; None keeps PIL's defaults). With lossless=True lossy
+    formats raise ValueError and WebP is saved losslessly. Large PNGs are
+    compressed on several threads if workers > 1.
+    """
+    image_format = output_format(filename, image_format)
+    if lossless:
+        check_lossless(image_format)
+    if profile is not None and profile not in SAVE_PROFILES:
+        raise ValueError('Unknown profile {}; expected one of {}'.format(
+            profile, ', '.join(sorted(SAVE_PROFILES))))
+    settings = SAVE_PROFILES.get(profile or 'balanced')
+    options = dict(settings.get(image_format, {})) if profile else {}
+    if lossless and image_format == 'WEBP':
+        options['lossless'] = True
+    width, height = image.size
+    if image_format == 'PNG' and workers > 1 and \
+            width * height > STRIP_THRESHOLD and image.mode in PNG_COLOUR_TYPES:
+        level = settings['PNG']['compress_level']
+        with open(filename, 'wb') as outfile:
+            write_png_strips(image, outfile, level, settings['png_filter'],
+                             workers)
+        return
+    image.save(filename, image_format, **options)
+
+# Parallel PNG writer: the image is cut into strips of rows, each strip is
+# filtered and deflated on its own thread (zlib releases the GIL), and the
+# pieces are joined into one zlib stream, each piece ending on a byte
+# boundary with a sync flush (as pigz does).
+PNG_COLOUR_TYPES = {'L': 0, 'RGB': 2, 'LA': 4, 'RGBA': 6}
+
+def _png_chunk(kind, data):
+    import zlib
+    return struct.pack('>I', len(data)) + kind + data + \
+        struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+def _filter_rows(rows, previous, png_filter, bpp):
+    # rows: (n, stride) uint8 array; previous: the row above the first one
+    # (zeros at the top of the image). Returns the filtered scanlines with
+    # their filter type bytes.
+    import numpy as np
+    count, stride = rows.shape
+    out = np.empty((count, stride + 1), dtype=np.uint8)
+    if png_filter == 'sub':
+        out[:, 0] = 1
+        out[:, 1:bpp + 1] = rows[:, :bpp]
+        out[:, bpp + 1:] = rows[:, bpp:] - rows[:, :-bpp]
+    elif png_filter == 'up':
+        out[:, 0] = 2
+        above = np.vstack([previous[None, :], rows[:-1]])
+        out[:, 1:] = rows - above
+    else:
+        out[:, 0] = 0
+        out[:, 1:] = rows
+    return out.tobytes()
+
+def write_png_strips(image, outfile, level=6, png_filter='up', workers=4,
+                     strip_rows=256):
+    """write_png_strips(PIL image, file object) -> None
+
+    Writes an 8 bit L/LA/RGB/RGBA image as PNG, compressing strips of
+    strip_rows rows on workers threads.
+    """
+    import zlib
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    width, height = image.size
+    bpp = len(image.mode)
+    pixels = np.frombuffer(image.tobytes(), dtype=np.uint8).reshape(
+        height, width * bpp)
+    starts = list(range(0, height, strip_rows))
+
+    def compress(start):
+        previous = pixels[start - 1] if start else \
+            np.zeros(width * bpp, dtype=np.uint8)
+        data = _filter_rows(pixels[start:start + strip_rows], previous,
+                            png_filter, bpp)
+        deflate = zlib.compressobj(level, zlib.DEFLATED, -15)
+        last = start == starts[-1]
+        body = deflate.compress(data) + deflate.flush(
+            zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+        return body, zlib.adler32(data), len(data)
+
+    outfile.write(b'\x89PNG\r\n\x1a\n')
+    outfile.write(_png_chunk(b'IHDR', struct.pack(
+        '>IIBBBBB', width, height, 8, PNG_COLOUR_TYPES[image.mode], 0, 0, 0)))
+    # zlib header: deflate, 32K window, no preset dictionary
+    outfile.write(_png_chunk(b'IDAT', b'\x78\x01'))
+    checksum = 1
+    with ThreadPoolExecutor(workers) as pool:
+        for body, adler, length in pool.map(compress, starts):
+            checksum = _adler32_combine(checksum, adler, length)
+            outfile.write(_png_chunk(b'IDAT', body))
+    outfile.write(_png_chunk(b'IDAT', struct.pack('>I', checksum)))
+    outfile.write(_png_chunk(b'IEND', b''))
+
+def _adler32_combine(adler1, adler2, length2):
+    # adler32 of the concatenation, from the checksums of the two parts
+    base = 65521
+    rem = length2 % base
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1) % base
+    sum1 += (adler2 & 0xFFFF) + base - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + base - rem
+    sum1 %= base
+    sum2 %= base
+    return (sum2 << 16) | sum1
+
 # Converts from PIL Image class (flat) to rectangular format
-def to_rectangle(image):
+# With native=True, images in one of NATIVE_MODES are kept in their own
+# mode and bit depth instead of being converted to RGB.
+#
+# Images that come from PIL are trusted: after convert() PIL guarantees
+# every pixel has the right number of integer values in range, so the rows
+# are cut straight out of the pixel buffer without looking at each pixel.
+# Anything else with the same interface (size, mode, getdata) is checked
+# in bulk (see validate_pixels) and clipped to range. trusted=True/False
+# overrides this choice.
+def to_rectangle(image, native=False, trusted=None):
+    mode = image.mode if native and image.mode in NATIVE_MODES else 'RGB'
     # Convert image to RGB if it is not already in that format.
-    if image.mode != 'RGB':
-        image = image.convert('RGB')
-    assert(image.mode == 'RGB')
-    pixels = list(image.getdata())
-    # Convert the flat representation into a list of rows.
+    if image.mode != mode:
+        image = image.convert(mode)
+    if trusted is None:
+        trusted = _is_pil_image(image)
+    if trusted:
+        return _rows_from_buffer(image, mode)
+    return _rows_checked(image, mode)
+
+def _is_pil_image(image):
+    from PIL import Image
+    return isinstance(image, Image.Image)
+
+def _rows_from_buffer(image, mode):
+    channels, depth = NATIVE_MODES[mode]
+    width, height = image.size
+    values = image.tobytes()
+    if depth > 8:
+        from array import array
+        import sys
+        values = array('H', values)
+        # I;16 and I;16L are little endian, I;16B big endian
+        if (mode == 'I;16B') != (sys.byteorder == 'big'):
+            values.byteswap()
+    # one tuple per pixel, built in C by zip over the channel planes
+    pixels = list(zip(*[values[c::channels] for c in range(channels)]))
+    return [pixels[row * width:(row + 1) * width] for row in range(height)]
+
+def validate_pixels(pixels, mode='RGB', clip_values=True):
+    """validate_pixels(pixels, mode) -> numpy array of shape (n, channels)
+
+    Bulk check of a flat sequence of pixels from an untrusted source:
+    every pixel must have get_channels(mode) integer values (a plain
+    integer is accepted for single channel modes). Values outside the
+    range of the mode are clipped, or rejected if clip_values is False.
+    Raises ValueError naming the first invalid pixel.
+    """
+    return _check_pixels(pixels, mode, clip_values)[1]
+
+def _check_pixels(pixels, mode, clip_values):
+    # -> (pixels as tuples, values array, whether any value was clipped).
+    # The checks run over all values at once (set/map/fromiter in C); the
+    # pixels are only looked at one by one to report an error.
+    import numpy as np
+    from itertools import chain
+    channels, depth = NATIVE_MODES[mode]
+    top = (1 << depth) - 1
+    pixels = list(pixels)
+    if channels == 1:
+        pixels = [pixel if isinstance(pixel, tuple) else (pixel,)
+                  for pixel in pixels]
+    try:
+        sizes = set(map(len, pixels))
+    except TypeError:
+        sizes = None
+    if sizes not in ({channels}, set()):
+        for pixel in pixels:
+            if not isinstance(pixel, (tuple, list)) or len(pixel) != channels:
+                raise ValueError('Invalid pixel for mode {}: {}'.format(
+                    mode, pixel))
+    # exact type check, as before: bool and float are not intensities
+    if set(map(type, chain.from_iterable(pixels))) - {int}:
+        for pixel in pixels:
+            for value in pixel:
+                if type(value) != int:
+                    raise ValueError('Invalid pixel, intensities are not '
+                                     'integers: {}'.format(pixel))
+    try:
+        values = np.fromiter(chain.from_iterable(pixels), dtype=np.int64,
+                             count=len(pixels) * channels)
+    except OverflowError:
+        values = np.array([max(-1, min(top + 1, value)) for value in
+                           chain.from_iterable(pixels)], dtype=np.int64)
+    values = values.reshape(len(pixels), channels)
+    outside = (values < 0) | (values > top)
+    clipped = bool(outside.any())
+    if clipped:
+        if not clip_values:
+            bad = pixels[int(np.flatnonzero(outside.any(axis=1))[0])]
+            raise ValueError('Invalid pixel, intensities out of range '
+                             '[0,{}]: {}'.format(top, bad))
+        values = np.clip(values, 0, top)
+    return pixels, values, clipped
+
+def validate_rectangle(image, mode='RGB', clip_values=False):
+    """validate_rectangle(image, mode) -> None
+
+    Bulk check that image is rectangular and every pixel is valid for mode
+    (see validate_pixels), e.g. before writing an image built by other
+    code. Raises ValueError.
+    """
+    width = get_width(image)
+    for row in image:
+        if len(row) != width:
+            raise ValueError('Image is not rectangular')
+    pixels = [pixel for row in image for pixel in row]
+    validate_pixels(pixels, mode, clip_values)
+
+def _rows_checked(image, mode):
     width, height = image.size
-    rows_cols = []
-    for row in range(height):
-        this_row = []
-        row_offset = row * width
-        for col in range(width):
-            this_pixel = pixels[row_offset + col]
-            # check that each pixel has (red, green, blue) components only
-            if len(this_pixel) != 3:
-                raise('Invalid pixel, not in (R,G,B) format: {}'.format(this_pixel))
-            r, g, b = this_pixel
-            if type(r) != int or type(g) != int or type(b) != int:
-                raise('Invalid pixel, intensities are not integers: {}'.format(this_pixel))
-            # make sure each intensity value is in the range [0,255]
-            r = clip(r)
-            g = clip(g)
-            b = clip(b)
-            this_row.append((r, g, b))
-        rows_cols.append(this_row)
-    return rows_cols
+    pixels, values, clipped = _check_pixels(image.getdata(), mode, True)
+    if len(pixels) != width * height:
+        raise ValueError('Image has {} pixels, expected {}'.format(
+            len(pixels), width * height))
+    if clipped:
+        pixels = [tuple(pixel) for pixel in values.tolist()]
+    else:
+        pixels = [tuple(pixel) for pixel in pixels]
+    return [pixels[row * width:(row + 1) * width] for row in range(height)]
 
 # Converts from rectangular format back to flat default
-# PIL Image class
-def to_flat(image):
+# PIL Image class (or the given mode, see NATIVE_MODES)
+def to_flat(image, mode='RGB'):
+    from PIL import Image
     flat_pixels = []
     for row in image:
         flat_pixels += row
-    out_image = Image.new('RGB', (get_width(image), get_height(image)))
+    if mode != 'RGB' and get_channels(mode) == 1:
+        flat_pixels = [pixel[0] for pixel in flat_pixels]
+    out_image = Image.new(mode, (get_width(image), get_height(image)))
     out_image.putdata(flat_pixels)
     return out_image
@@ -0,0 +1,214 @@
+"""
+################################################################################
+Batch image I/O
+
+Notes:
+
+Batch jobs that call SimpleImage.read_image / write_image in a loop leave
+the CPU idle while a file is read and decoded, and the disk idle while an
+image is encoded or scrambled. The helpers here overlap the two:
+
+- read_images decodes the next few images on a background thread pool
+  while the caller works on the current one, and yields them in order.
+  Read-ahead is bounded both by a number of images (depth) and by an
+  estimate of the memory they take (max_bytes, worked out from the image
+  headers before decoding). One image is always allowed, however big.
+- AsyncWriter saves results on a thread pool, with the same kind of bound;
+  write() blocks once too much is waiting to be written.
+
+    with batchio.AsyncWriter() as writer:
+        for name, image in batchio.read_images(names):
+            writer.write(image_scrambler.scramble(image), 'out/' + name)
+
+PIL releases the GIL while decoding and compressing, so threads are
+enough for the I/O to run alongside the compute.
+################################################################################
+"""
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import SimpleImage as sim
+
+READ_AHEAD = 4
+MAX_BYTES = 256 << 20
+# Rough memory per intensity value of the forms images can be read in; a
+# rectangular image (lists of tuples of ints) costs far more than the
+# pixel data itself
+FORM_OVERHEAD = {'rectangle': 30, 'array': 1, 'pil': 1}
+
+"""
+Reading
+"""
+
+def _load(path, form, native):
+    if form == 'rectangle':
+        return sim.read_image(path, native)
+    PILimage = sim.open_image(path)
+    if form == 'array':
+        import engine
+        return engine.from_pil(PILimage, native)
+    PILimage.load()
+    return PILimage
+
+def estimate_bytes(path, form='rectangle', native=False):
+    """
+    Estimated memory taken by the image at path once read in the given
+    form; only the header is read.
+    """
+    PILimage = sim.open_image(path)
+    try:
+        width, height = PILimage.size
+        mode = sim.native_mode(PILimage.mode) if native else 'RGB'
+    finally:
+        PILimage.close()
+    values = width * height * sim.get_channels(mode)
+    if form != 'rectangle':
+        values *= sim.get_depth(mode) // 8
+    return values * FORM_OVERHEAD[form]
+
+def read_images(paths, depth=READ_AHEAD, max_bytes=MAX_BYTES, workers=2,
+                form='rectangle', native=False):
+    """
+    Yield (path, image) for every path, in order, decoding up to depth
+    images ahead on workers threads while keeping the estimated memory of
+    the images read ahead under max_bytes.
+
+    form is 'rectangle' (as SimpleImage.read_image), 'array' ((array,
+    mode) as engine.from_pil) or 'pil' (a loaded PIL image). An error
+    reading an image is raised when that image is reached.
+    """
+    if form not in FORM_OVERHEAD:
+        raise ValueError('Unknown form {}'.format(form))
+    paths = iter(paths)
+    pending = deque()
+    used = 0
+    next_path = None
+    with ThreadPoolExecutor(workers) as pool:
+        while True:
+            # queue up more reads while there is room
+            while len(pending) < max(depth, 1):
+                if next_path is None:
+                    next_path = next(paths, None)
+                    if next_path is None:
+                        break
+                    try:
+                        size = estimate_bytes(next_path, form, native)
+                    except Exception:
+                        # let the read itself report the problem
+                        size = 0
+                if pending and used + size > max_bytes:
+                    break
+                pending.append((next_path, size,
+                                pool.submit(_load, next_path, form, native)))
+                used += size
+                next_path = None
+            if not pending:
+                return
+            path, size, future = pending.popleft()
+            try:
+                yield path, future.result()
+            except BaseException:
+                # read error, or the caller stopped early: drop the rest
+                for item in pending:
+                    item[2].cancel()
+                raise
+            # the caller is done with the previous image
+            used -= size
+
+"""
+Writing
+"""
+
+class AsyncWriter(object):
+    """
+    Writes images on a thread pool. write() returns at once unless
+    max_pending images (or max_bytes of estimated memory) are already
+    waiting, in which case it waits for room. Errors are raised from a
+    later write() or from close().
+    """
+    def __init__(self, workers=2, max_pending=8, max_bytes=MAX_BYTES):
+        self.pool = ThreadPoolExecutor(workers)
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.pending = 0
+        self.used = 0
+        self.errors = []
+        self.room = threading.Condition()
+
+    def _done(self, size, future):
+        with self.room:
+            self.pending -= 1
+            self.used -= size
+            if future.exception() is not None:
+                self.errors.append(future.exception())
+            self.room.notify_all()
+
+    def _submit(self, size, func, *args, **kwargs):
+        with self.room:
+            while self.pending and (self.pending >= self.max_pending or
+                                    self.used + size > self.max_bytes):
+                self.room.wait()
+            if self.errors:
+                raise self.errors.pop(0)
+            self.pending += 1
+            self.used += size
+        future = self.pool.submit(func, *args, **kwargs)
+        future.add_done_callback(lambda done: self._done(size, done))
+        return future
+
+    def write(self, image, filename, mode='RGB', profile=None,
+              lossless=False):
+        """
+        Queue SimpleImage.write_image(image, filename, ...) for an image
+        in rectangular format.
+        """
+        size = sim.get_width(image) * sim.get_height(image) * \
+            sim.get_channels(mode) * FORM_OVERHEAD['rectangle']
+        return self._submit(size, sim.write_image, image, filename, mode,
+                            profile, lossless)
+
+    def save(self, PILimage, filename, profile=None, lossless=False):
+        """
+        Queue SimpleImage.save_image for a PIL image.
+        """
+        width, height = PILimage.size
+        size = width * height * len(PILimage.getbands())
+        return self._submit(size, sim.save_image, PILimage, filename,
+                            profile, None, lossless)
+
+    def close(self):
+        """
+        Wait for every queued write; raises the first error, if any.
+        """
+        self.pool.shutdown(wait=True)
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.close()
+        else:
+            self.pool.shutdown(wait=True)
+        return False
+
+def map_images(func, paths, out_dir, depth=READ_AHEAD, max_bytes=MAX_BYTES,
+               workers=2, profile=None, lossless=False):
+    """
+    func(image) -> image for every image in paths (rectangular RGB format),
+    with reads and writes overlapping the calls. Results are written to
+    out_dir under the same file names.
+
+    Result:
+        List of the output filenames.
+    """
+    outputs = []
+    with AsyncWriter(workers, max_bytes=max_bytes) as writer:
+        for path, image in read_images(paths, depth, max_bytes, workers):
+            out_name = os.path.join(out_dir, os.path.basename(path))
+            writer.write(func(image), out_name, 'RGB', profile, lossless)
+            outputs.append(out_name)
+    return outputs
@@ -29,6 +29,12 @@
 #
 # 25 Feb 2014: Added extra functionality, i,e, converting a string of ASCII
 #              characters into a string of binary, and vice versa
+# Binary payloads: byte_to_bits, bytes_to_bits and bits_to_bytes work on
+#              raw bytes, so arbitrary files (not just ASCII text) can be
+#              converted to and from bitstreams.
+# Bit planes:  get_planes, extract_planes and insert_planes work on whole
+#              numpy arrays of intensity values instead of one int at a
+#              time (numpy is only imported when they are called).
 #
 ################################################################################
 
@@ -70,7 +76,7 @@ def get_bit(int, position):
     bit is at position 1, and so forth.
 
     >>> for pos in range(8):
-    ...     print(b.get_bit(167, pos))
+    ...     print(get_bit(167, pos))
     ... 
     1
     1
@@ -173,7 +179,7 @@ def message_to_bits(message):
         '01000001'
         >>> message_to_bits('hello')
         '0110100001100101011011000110110001101111'
-        >>> message_to_bits("\n!@%&'")
+        >>> message_to_bits("\\n!@%&'")
         '000010100010000101000000001001010010011000100111'
         
     """
@@ -310,3 +316,174 @@ def codebit(i,indexable):
         return 0
     else:
         return indexable[i]
+
+def byte_to_bits(byte):
+    """byte_to_bits(int) -> string
+
+    Convert an integer in the range [0,255] to an 8 bit string of 1s and 0s.
+    Unlike char_to_bits this works on raw byte values, so it is not limited
+    to ASCII.
+
+    >>> byte_to_bits(65)
+    '01000001'
+    >>> byte_to_bits(255)
+    '11111111'
+    """
+    result = ''
+    for index in range(8):
+        result = get_bit(byte, index) + result
+    return result
+
+# Lookup table so bytes_to_bits does not rebuild each byte bit by bit
+# (format is used here as it is cheaper at import time; same result as
+# byte_to_bits)
+_BYTE_BITS = [format(n, '08b') for n in range(256)]
+
+def bytes_to_bits(data):
+    """
+    Takes a bytes object (or bytearray) and returns a STRING of binary
+    digits, 8 per byte, most significant bit first.
+
+    Inputs:
+        data: bytes to be converted into binary
+
+    Result:
+        A string of binary digits, the 'bitstream'
+
+    Examples:
+        >>> bytes_to_bits(b'')
+        ''
+        >>> bytes_to_bits(b'A\\x00')
+        '0100000100000000'
+    """
+    return ''.join([_BYTE_BITS[byte] for byte in bytearray(data)])
+
+def bits_to_bytes(bitstream):
+    """
+    Inverse of bytes_to_bits. The bitstream is processed 8 bits at a time;
+    if its length is not divisible by 8 the remainder is ignored, as in
+    slicer. Zero bytes are kept, there is no stop code for binary data.
+
+    Inputs:
+        A string of binary bits
+
+    Result:
+        A bytes object
+
+    Examples:
+        >>> bits_to_bytes('0100000100000000')
+        b'A\\x00'
+        >>> bits_to_bytes('0100000')
+        b''
+    """
+    end = len(bitstream) - len(bitstream) % 8
+    return bytes(bytearray([int(bitstream[i:i + 8], 2)
+                            for i in range(0, end, 8)]))
+
+"""
+Bit planes
+
+The functions below work on numpy arrays of intensity values (uint8, or
+uint16 for 16-bit images) rather than one int at a time. Bit plane k of an
+array is bit k of every value. A bitstream is laid out the way encode_ext
+walks an image: for each value in turn (in the array's row-major order),
+num_bits bits starting from the plane start and going up. Packed buffers
+hold the bitstream 8 bits to a byte, most significant bit first, as
+bytes_to_bits/bits_to_bytes do.
+"""
+
+def get_planes(array, num_bits=1, start=0):
+    """get_planes(array, num_bits, start) -> array
+
+    The bit planes start .. start + num_bits - 1 of an array, as an array
+    of 0s and 1s (uint8) with an extra last axis: result[..., i] is bit
+    start + i of each value.
+
+    >>> import numpy as np
+    >>> get_planes(np.array([5, 2], dtype=np.uint8), 3)
+    array([[1, 0, 1],
+           [0, 1, 0]], dtype=uint8)
+    """
+    import numpy as np
+    if array.dtype == np.uint8 and num_bits > 1:
+        # one pass over the data instead of one per plane
+        planes = np.unpackbits(array[..., None], axis=-1, bitorder='little')
+        return planes[..., start:start + num_bits]
+    shifts = np.arange(start, start + num_bits, dtype=array.dtype)
+    return ((array[..., None] >> shifts) & 1).astype(np.uint8)
+
+def extract_planes(array, num_bits=1, start=0, per_line=False):
+    """extract_planes(array, num_bits, start, per_line) -> array
+
+    The bitstream held in planes start .. start + num_bits - 1 of an
+    array, packed into bytes (a uint8 array; call tobytes() for bytes). As
+    in bits_to_bytes, an incomplete last byte is dropped. With per_line,
+    each line along the last axis is a separate bitstream and the result
+    has one row of bytes per line.
+
+    >>> import numpy as np
+    >>> extract_planes(np.array([1, 0, 0, 0, 0, 0, 1, 0], dtype=np.uint8))
+    array([130], dtype=uint8)
+    >>> extract_planes(np.array([2, 3, 0, 1], dtype=np.uint8), 2).tobytes()
+    b'r'
+    """
+    import numpy as np
+    stream = get_planes(array, num_bits, start)
+    if per_line:
+        stream = stream.reshape(array.shape[:-1] + (-1,))
+    else:
+        stream = stream.reshape(-1)
+    usable = stream.shape[-1] - stream.shape[-1] % 8
+    return np.packbits(stream[..., :usable], axis=-1)
+
+def insert_planes(array, data, num_bits=1, start=0, per_line=False):
+    """insert_planes(array, data, num_bits, start, per_line) -> array
+
+    The inverse of extract_planes: write the bitstream in data (bytes,
+    bytearray or a uint8 array) into planes start .. start + num_bits - 1
+    of array, IN PLACE, and return array. Bits past the end of data are
+    set to 0 in those planes, like encode_ext does after the message, and
+    bits of data past the end of the array are ignored. The other planes
+    are not touched. With per_line, data holds one row of bytes per line
+    along the last axis of array.
+
+    Without per_line the array must be contiguous, so that it can be
+    written through a flat view.
+
+    >>> import numpy as np
+    >>> a = np.array([255, 255, 255, 255], dtype=np.uint8)
+    >>> insert_planes(a, b'r', 2)
+    array([254, 255, 252, 253], dtype=uint8)
+    """
+    import numpy as np
+    if isinstance(data, np.ndarray):
+        data = data.astype(np.uint8, copy=False)
+    else:
+        data = np.frombuffer(data, dtype=np.uint8)
+    if per_line:
+        lines = array
+        if data.ndim == 1:
+            data = data.reshape(array.shape[:-1] + (-1,))
+    else:
+        if not array.flags.c_contiguous:
+            raise ValueError('insert_planes needs a contiguous array')
+        lines = array.reshape(-1)
+        data = data.reshape(-1)
+    length = lines.shape[-1]
+    dtype = array.dtype.type
+    mask = ((1 << num_bits) - 1) << start
+    lines &= dtype(~mask & np.iinfo(array.dtype).max)
+    # only the values the data reaches need their bits set
+    count = min(-(-data.shape[-1] * 8 // num_bits), length)
+    if count:
+        stream = np.unpackbits(data, axis=-1, count=count * num_bits)
+        stream = stream.reshape(stream.shape[:-1] + (count, num_bits))
+        if num_bits <= 8 and start + num_bits <= 8:
+            values = np.packbits(stream, axis=-1, bitorder='little')[..., 0]
+        else:
+            shifts = np.arange(num_bits, dtype=array.dtype)
+            values = (stream.astype(array.dtype) << shifts).sum(
+                axis=-1, dtype=array.dtype)
+        lines[..., :count] |= values.astype(array.dtype, copy=False) << \
+            dtype(start)
+    return array
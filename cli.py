@@ -0,0 +1,205 @@
+"""
+################################################################################
+Command line interface
+
+Notes:
+
+Streaming front end for shell pipelines: the input image is read from
+stdin (or --input) and the result is written to stdout (or --output), so
+steps can be chained without temporary files:
+
+    python cli.py scramble < photo.png | python cli.py encode -n 2 -m hi > out.png
+    python cli.py decode -n 2 < out.png
+    python cli.py decode -n auto < out.png
+    python cli.py encode -n 2 --payload archive.tar < cover.png > out.png
+    python cli.py encode -n auto -m hello < cover.png > out.png
+    python cli.py scramble --method tiles --key secret < photo.png > out.png
+
+The image format is detected from the stream. Images are written back in
+the input format, except for formats that do not keep pixel values
+exactly (JPEG, GIF, see SimpleImage.LOSSY_FORMATS), which would destroy
+the hidden bits, so PNG is used instead; --format overrides this.
+
+decode writes the raw payload to stdout: the file contents for payloads
+embedded with --payload (encode_file), otherwise the text message.
+
+-n auto picks the smallest num_bits that fits (encode) or detects it
+(decode); neither works with --key, and --key does not work with
+--payload. Errors (bad arguments, unreadable or lossy images) go to
+stderr with exit status 2; nothing is written to stdout then.
+################################################################################
+"""
+import argparse
+import io
+import os
+import sys
+
+def read_input(filename):
+    # PIL needs a seekable file, so stdin is read into memory
+    if filename in (None, '-'):
+        return io.BytesIO(sys.stdin.buffer.read())
+    return open(filename, 'rb')
+
+def write_output(filename, data):
+    if filename in (None, '-'):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+    else:
+        with open(filename, 'wb') as outfile:
+            outfile.write(data)
+
+def output_format(source_format, requested=None):
+    import SimpleImage as sim
+    if requested:
+        return requested.upper()
+    if source_format is None or source_format in sim.LOSSY_FORMATS:
+        return 'PNG'
+    return source_format
+
+def num_bits_arg(text):
+    # 1-8 or 'auto'; checked here so the library's printed errors never
+    # end up on stdout
+    if text == 'auto':
+        return text
+    try:
+        num_bits = int(text)
+    except ValueError:
+        num_bits = 0
+    if not 0 < num_bits <= 8:
+        raise argparse.ArgumentTypeError(
+            "must be an integer between 1 and 8, or 'auto'")
+    return num_bits
+
+def check_args(args):
+    # combinations the library would silently ignore or cannot decode
+    key = getattr(args, 'key', None)
+    if args.command in ('encode', 'decode') and key is not None and \
+            args.num_bits == 'auto':
+        raise ValueError('-n auto does not work with --key')
+    if args.command == 'encode' and key is not None and \
+            args.payload is not None:
+        raise ValueError('--key does not work with --payload')
+
+def run(args):
+    """
+    Run one command; returns the bytes to write out.
+    """
+    from PIL import Image
+    import SimpleImage as sim
+    import steganography as steg
+    import image_scrambler as isc
+
+    check_args(args)
+    PILimage = Image.open(read_input(args.input))
+    source_format = PILimage.format
+    image_format = output_format(source_format, args.format)
+    if args.command == 'encode':
+        # a lossy output format would destroy the hidden data
+        sim.check_lossless(image_format)
+    if args.command == 'decode':
+        image = sim.to_rectangle(PILimage)
+        if args.num_bits == 'auto':
+            result = steg.decode_auto(image)
+            if result.kind == 'file':
+                return result.data
+            return result.data.encode('latin-1')
+        # characters are single bytes (see bits.char_to_bits)
+        if args.key is not None:
+            # keyed (scatter) payloads are always text messages
+            return steg.decode_ext(image, args.num_bits,
+                                   args.key).encode('latin-1')
+        try:
+            steg.read_header(image, args.num_bits)
+        except ValueError:
+            return steg.decode_ext(image, args.num_bits).encode('latin-1')
+        out = io.BytesIO()
+        steg.extract_file(image, args.num_bits, out)
+        return out.getvalue()
+    if args.command == 'encode':
+        import planner
+        image = sim.to_rectangle(PILimage)
+        num_bits = args.num_bits
+        if args.payload is not None:
+            if num_bits == 'auto':
+                width, height = PILimage.size
+                plan = planner.plan_file(width, height,
+                                         os.path.getsize(args.payload))
+                if plan is None:
+                    raise ValueError('{} does not fit in the image'.format(
+                        args.payload))
+                num_bits = plan.num_bits
+            with open(args.payload, 'rb') as payload_file:
+                steg.embed_file(image, payload_file, num_bits)
+            output = sim.to_flat(image)
+        else:
+            if num_bits == 'auto':
+                num_bits = planner.choose_num_bits(image, args.message)
+                if num_bits is None:
+                    raise ValueError('The message does not fit in the '
+                                     'image')
+            output = sim.to_flat(steg.encode_ext(image, args.message,
+                                                 num_bits, args.key))
+    elif args.command == 'scramble':
+        output = isc.scramblePILimage(PILimage, method=args.method,
+                                      key=args.key, tile=args.tile)
+    else:
+        output = isc.unscramblePILimage(PILimage, method=args.method,
+                                        key=args.key, tile=args.tile)
+    out = io.BytesIO()
+    options = {}
+    if args.profile:
+        options = dict(sim.SAVE_PROFILES[args.profile].get(image_format, {}))
+    if args.command == 'encode' and image_format == 'WEBP':
+        options['lossless'] = True
+    output.save(out, image_format, **options)
+    return out.getvalue()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Image steganography and scrambling (stdin -> stdout)')
+    commands = parser.add_subparsers(dest='command')
+    encode = commands.add_parser('encode', help='hide a message or file')
+    encode.add_argument('-n', '--num-bits', type=num_bits_arg, default=1,
+                        help="1-8, or 'auto' for the smallest that fits")
+    encode.add_argument('-m', '--message', default='')
+    encode.add_argument('--payload', help='embed this file instead of a '
+                        'text message')
+    encode.add_argument('--key', help='keyed scatter mode')
+    decode = commands.add_parser('decode', help='extract a message or file')
+    decode.add_argument('-n', '--num-bits', type=num_bits_arg, default=1,
+                        help="1-8, or 'auto' to detect it")
+    decode.add_argument('--key', help='keyed scatter mode')
+    scramble = commands.add_parser('scramble', help='scramble an image')
+    unscramble = commands.add_parser('unscramble', help='unscramble an image')
+    for command in (scramble, unscramble):
+        command.add_argument('--method', choices=('rows', 'tiles'),
+                             default='rows', help="'tiles' needs --key")
+        command.add_argument('--key', help='key for the tiled method')
+        command.add_argument('--tile', type=int, default=64,
+                             help='tile size in pixels (tiled method)')
+    for command in commands.choices.values():
+        command.add_argument('-i', '--input', default='-',
+                             help="input image (default '-', stdin)")
+        command.add_argument('-o', '--output', default='-',
+                             help="output file (default '-', stdout)")
+        command.add_argument('--format', default=None,
+                             help='output image format, e.g. PNG')
+        command.add_argument('--profile', default=None,
+                             choices=('fastest', 'balanced', 'smallest'),
+                             help='speed/size trade-off for the output')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+    try:
+        data = run(args)
+    except (ValueError, OSError) as error:
+        # includes PIL's UnidentifiedImageError for input that is not an
+        # image
+        sys.stderr.write('{}\n'.format(error))
+        return 2
+    write_output(args.output, data)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,423 @@
+"""
+################################################################################
+Differential tests
+
+Notes:
+
+The pure Python functions (steganography.encode_ext/decode_ext,
+image_scrambler.scramble/unscramble/int_mod, bits.message_to_bits) are the
+reference. Faster versions (engine.py, pipeline.py, watermark.py) must
+give exactly the same results, so this harness runs both on random inputs
+and compares (batch functions and watermark.PreparedCover against the
+reference run once per image):
+
+- random images: odd widths, single pixel rows and columns, empty images,
+  1 to 4 intensity values per pixel and 8 or 16 bits per value
+- random messages: empty, exactly filling the image, one byte too long,
+  with zero bytes or characters above 127 in them
+- num_bits at the edges: 0, 1, depth - 1, depth, depth + 1
+
+Outcomes must match exactly. Errors count as outcomes too: the reference
+rejects a bad num_bits by printing a message and returning None where the
+engine raises ValueError, and these are treated as the same outcome; any
+other exception must be of the same type on both sides (e.g. unscramble
+on an image whose tags do not fit raises ValueError or IndexError in
+both).
+
+Every case is generated from its own seed, so a failure can be replayed
+on its own.
+
+Run:
+    python differential.py                        quick check (fixed seed)
+    python differential.py --fuzz --seed 7 --duration 3600
+    python differential.py --replay encode_ext:123456
+################################################################################
+"""
+import argparse
+import contextlib
+import io
+import random
+import sys
+import time
+
+REJECTED = 'rejected num_bits'
+
+"""
+Random inputs
+"""
+
+def random_image(rng, channels=None, depth=8, awkward=True):
+    """
+    A random image in rectangular format, biased towards awkward sizes
+    unless awkward is False (scramble needs rows and columns long enough
+    to hold their tags).
+    """
+    if channels is None:
+        channels = rng.choice([3, 3, 1, 2, 4])
+    if awkward:
+        width = rng.choice([0, 1, 1, 2, 3, 5, 7, 8, rng.randint(1, 40)])
+        height = rng.choice([0, 1, 1, 2, 3, 9, rng.randint(1, 40)])
+    else:
+        width = rng.randint(8, 40)
+        height = rng.randint(8, 40)
+    top = (1 << depth) - 1
+    return [[tuple([rng.randint(0, top) for c in range(channels)])
+             for col in range(width)]
+            for row in range(height)]
+
+def random_num_bits(rng, depth=8):
+    return rng.choice([0, 1, 1, 2, depth - 1, depth, depth, depth + 1,
+                       rng.randint(1, depth)])
+
+def random_message(rng, capacity_bytes):
+    """
+    A random message around the capacity of the image (in whole bytes).
+    """
+    length = rng.choice([0, 1, capacity_bytes, capacity_bytes + 1,
+                         max(capacity_bytes - 1, 0),
+                         rng.randint(0, capacity_bytes + 2)])
+    alphabet = rng.choice(['printable', 'bytes', 'wide'])
+    chars = []
+    for i in range(length):
+        if alphabet == 'printable':
+            chars.append(chr(rng.randint(32, 126)))
+        elif alphabet == 'bytes':
+            # includes zero bytes, which end the message early
+            chars.append(chr(rng.randint(0, 255)))
+        else:
+            chars.append(chr(rng.randint(1, 400)))
+    return ''.join(chars)
+
+def _capacity_bytes(image, num_bits):
+    if not image or not image[0]:
+        return 0
+    return len(image) * len(image[0]) * len(image[0][0]) * \
+        max(num_bits, 1) // 8
+
+"""
+Running both sides
+"""
+
+def outcome(func, *args):
+    """
+    Call func and return ('ok', result) or ('error', exception type).
+    Printed output is swallowed; a None result from the reference (its
+    way of rejecting num_bits) becomes the same outcome as ValueError.
+    """
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func(*args)
+    except ValueError as error:
+        if str(error).startswith('Number of bits'):
+            return ('error', REJECTED)
+        return ('error', 'ValueError')
+    except Exception as error:
+        return ('error', type(error).__name__)
+    if result is None:
+        return ('error', REJECTED)
+    return ('ok', result)
+
+def _engine():
+    import engine
+    return engine
+
+def check_encode_ext(rng):
+    engine = _engine()
+    depth = rng.choice([8, 8, 8, 16])
+    image = random_image(rng, depth=depth)
+    num_bits = random_num_bits(rng, depth)
+    message = random_message(rng, _capacity_bytes(image, num_bits))
+    import steganography as steg
+    reference = outcome(steg.encode_ext, image, message, num_bits, None,
+                        depth)
+    fast = outcome(lambda: engine.to_rectangle(engine.encode_ext(
+        engine.from_rectangle(image, depth), message, num_bits, depth)))
+    return reference, fast, (image, message, num_bits, depth)
+
+def check_decode_ext(rng):
+    engine = _engine()
+    import steganography as steg
+    depth = rng.choice([8, 8, 8, 16])
+    image = random_image(rng, depth=depth)
+    num_bits = random_num_bits(rng, depth)
+    if rng.random() < 0.5:
+        # a real message rather than noise, so the stop code is exercised
+        message = random_message(rng, _capacity_bytes(image, num_bits))
+        with contextlib.redirect_stdout(io.StringIO()):
+            encoded = steg.encode_ext(image, message, num_bits, None, depth)
+        image = encoded if encoded is not None else image
+    block_size = rng.choice([1, 3, 65536])
+    reference = outcome(steg.decode_ext, image, num_bits, None, depth)
+    fast = outcome(lambda: engine.decode_ext(
+        engine.from_rectangle(image, depth), num_bits, depth, block_size))
+    return reference, fast, (image, num_bits, depth, block_size)
+
+def _with_seed(seed, func):
+    # scramble draws from the global random module; both sides must
+    # start from the same state
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        return func()
+    finally:
+        random.setstate(state)
+
+def check_scramble(rng):
+    engine = _engine()
+    import image_scrambler as isc
+    depth = rng.choice([8, 8, 16])
+    image = random_image(rng, depth=depth)
+    seed = rng.randint(0, 1 << 30)
+    reference = _with_seed(seed, lambda: outcome(isc.scramble, image, depth))
+    fast = _with_seed(seed, lambda: outcome(lambda: engine.to_rectangle(
+        engine.scramble(engine.from_rectangle(image, depth), depth))))
+    return reference, fast, (image, depth, seed)
+
+def check_unscramble(rng):
+    engine = _engine()
+    import image_scrambler as isc
+    depth = rng.choice([8, 8, 16])
+    image = random_image(rng, depth=depth, awkward=rng.random() < 0.3)
+    if rng.random() < 0.8:
+        # mostly scrambled images; raw noise checks the error paths
+        result = _with_seed(rng.randint(0, 1 << 30),
+                            lambda: outcome(isc.scramble, image, depth))
+        if result[0] == 'ok':
+            image = result[1]
+    reference = outcome(isc.unscramble, image, depth)
+    fast = outcome(lambda: engine.to_rectangle(
+        engine.unscramble(engine.from_rectangle(image, depth), depth)))
+    return reference, fast, (image, depth)
+
+def check_int_mod(rng):
+    engine = _engine()
+    import image_scrambler as isc
+    if rng.random() < 0.5:
+        values = list(range(256))
+        reference = ('ok', [isc.int_mod(n) for n in values])
+        fast = outcome(lambda: [engine.int_mod(n) for n in values])
+    else:
+        values = [rng.randint(0, 0xFFFF) for i in range(256)]
+        reference = ('ok', [isc.int_mod16(n) for n in values])
+        fast = outcome(lambda: [engine.int_mod(n, 16) for n in values])
+    return reference, fast, (values,)
+
+def check_message_to_bits(rng):
+    engine = _engine()
+    import bits
+    message = random_message(rng, rng.randint(0, 64))
+    reference = outcome(bits.message_to_bits, message)
+    fast = outcome(lambda: ''.join(
+        [str(bit) for bit in engine.message_to_bits(message).tolist()]))
+    return reference, fast, (message,)
+
+def check_pipeline(rng):
+    engine = _engine()
+    import pipeline
+    import steganography as steg
+    image = random_image(rng, channels=3, awkward=rng.random() < 0.2)
+    num_bits = rng.randint(1, 8)
+    message = random_message(rng, _capacity_bytes(image, num_bits))
+    seed = rng.randint(0, 1 << 30)
+
+    def reference_steps():
+        import image_scrambler as isc
+        scrambled = isc.unscramble(isc.scramble(image))
+        encoded = steg.encode_ext(scrambled, message, num_bits)
+        return encoded, [steg.decode_ext(encoded, num_bits)]
+
+    def pipeline_steps():
+        result = pipeline.Pipeline([
+            pipeline.Scramble(), pipeline.Unscramble(),
+            pipeline.EncodeExt(message, num_bits),
+            pipeline.DecodeExt(num_bits)]).run(engine.from_rectangle(image))
+        return engine.to_rectangle(result.image), result.messages
+
+    reference = _with_seed(seed, lambda: outcome(reference_steps))
+    fast = _with_seed(seed, lambda: outcome(pipeline_steps))
+    return reference, fast, (image, message, num_bits, seed)
+
+def _same_size_images(rng, count, depth=8):
+    # count random images of one random size and number of channels
+    first = random_image(rng, depth=depth)
+    height = len(first)
+    width = len(first[0]) if first else 0
+    channels = len(first[0][0]) if width else 3
+    top = (1 << depth) - 1
+    images = [first]
+    for i in range(count - 1):
+        images.append([[tuple([rng.randint(0, top) for c in range(channels)])
+                        for col in range(width)]
+                       for row in range(height)])
+    return images
+
+def _reference_batch(func, items):
+    # the reference run once per image; a rejected num_bits rejects the
+    # whole batch
+    results = []
+    for args in items:
+        result = func(*args)
+        if result is None:
+            return None
+        results.append(result)
+    return results
+
+def check_encode_ext_batch(rng):
+    engine = _engine()
+    import steganography as steg
+    depth = rng.choice([8, 8, 16])
+    images = _same_size_images(rng, rng.randint(1, 5), depth)
+    num_bits = random_num_bits(rng, depth)
+    messages = [random_message(rng, _capacity_bytes(image, num_bits))
+                for image in images]
+    reference = outcome(_reference_batch, steg.encode_ext,
+                        [(image, message, num_bits, None, depth)
+                         for image, message in zip(images, messages)])
+    fast = outcome(lambda: [engine.to_rectangle(array) for array in
+                            engine.encode_ext_batch(images, messages,
+                                                    num_bits, depth)])
+    return reference, fast, (images, messages, num_bits, depth)
+
+def check_decode_ext_batch(rng):
+    engine = _engine()
+    import steganography as steg
+    depth = rng.choice([8, 8, 16])
+    images = _same_size_images(rng, rng.randint(1, 5), depth)
+    num_bits = random_num_bits(rng, depth)
+    if 0 < num_bits <= depth and rng.random() < 0.7:
+        images = [steg.encode_ext(image, random_message(
+            rng, _capacity_bytes(image, num_bits)), num_bits, None, depth)
+                  for image in images]
+    block_size = rng.choice([1, 3, 65536])
+    reference = outcome(_reference_batch, steg.decode_ext,
+                        [(image, num_bits, None, depth) for image in images])
+    fast = outcome(lambda: engine.decode_ext_batch(images, num_bits, depth,
+                                                   block_size))
+    return reference, fast, (images, num_bits, depth, block_size)
+
+# PIL modes for (intensity values per pixel, depth) in native mode
+_COVER_MODES = {(1, 8): 'L', (2, 8): 'LA', (3, 8): 'RGB', (4, 8): 'RGBA',
+                (1, 16): 'I;16'}
+
+def check_prepared_cover(rng):
+    engine = _engine()
+    import steganography as steg
+    import watermark
+    depth = rng.choice([8, 8, 16])
+    image = random_image(rng, channels=1 if depth > 8 else None,
+                         depth=depth)
+    if not image or not image[0]:
+        # PIL images are at least 1x1
+        image = random_image(rng, channels=3, awkward=False)
+        depth = 8
+    mode = _COVER_MODES[(len(image[0][0]), depth)]
+    num_bits = random_num_bits(rng, depth)
+    message = random_message(rng, _capacity_bytes(image, num_bits))
+    PILimage = engine.to_pil(engine.from_rectangle(image, depth), mode)
+    reference = outcome(steg.encode_ext, image, message, num_bits, None,
+                        depth)
+
+    def prepared():
+        cover = watermark.PreparedCover(PILimage, num_bits, native=True)
+        return [engine.to_rectangle(cover.encode(message)),
+                engine.to_rectangle(engine.from_pil(
+                    cover.encodePILimage(message), True)[0])]
+
+    fast = outcome(prepared)
+    if fast[0] == 'ok':
+        # both outputs must match the reference
+        first, second = fast[1]
+        fast = ('ok', first) if first == second else ('ok', fast[1])
+    return reference, fast, (image, message, num_bits, depth)
+
+CHECKS = {
+    'encode_ext': check_encode_ext,
+    'decode_ext': check_decode_ext,
+    'scramble': check_scramble,
+    'unscramble': check_unscramble,
+    'int_mod': check_int_mod,
+    'message_to_bits': check_message_to_bits,
+    'pipeline': check_pipeline,
+    'encode_ext_batch': check_encode_ext_batch,
+    'decode_ext_batch': check_decode_ext_batch,
+    'prepared_cover': check_prepared_cover,
+}
+
+"""
+Campaigns
+"""
+
+def run_case(name, seed):
+    """
+    Run one check with the given case seed.
+
+    Result:
+        None if both sides agree, otherwise a description of the mismatch.
+    """
+    reference, fast, inputs = CHECKS[name](random.Random(seed))
+    if reference == fast:
+        return None
+    return '{}:{} inputs={!r}\n  reference: {!r}\n  fast:      {!r}'.format(
+        name, seed, inputs, reference, fast)
+
+def run(iterations=None, seed=0, duration=None, names=None, stop_early=True,
+        report=None):
+    """
+    Run cases round robin over the checks until iterations cases have run
+    or duration seconds have passed.
+
+    Result:
+        (number of cases run, list of mismatch descriptions)
+    """
+    names = list(names or sorted(CHECKS))
+    seeds = random.Random(seed)
+    start = time.time()
+    failures = []
+    count = 0
+    while True:
+        if iterations is not None and count >= iterations:
+            break
+        if duration is not None and time.time() - start >= duration:
+            break
+        name = names[count % len(names)]
+        failure = run_case(name, seeds.randint(0, (1 << 31) - 1))
+        count += 1
+        if failure is not None:
+            failures.append(failure)
+            if report is not None:
+                report(failure)
+            if stop_early:
+                break
+    return count, failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compare the fast engines with the reference functions')
+    parser.add_argument('--fuzz', action='store_true',
+                        help='long campaign; keep going after failures')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--iterations', type=int, default=None)
+    parser.add_argument('--duration', type=float, default=None,
+                        help='seconds to run for (fuzz mode)')
+    parser.add_argument('--check', action='append', choices=sorted(CHECKS),
+                        help='run only these checks (repeatable)')
+    parser.add_argument('--replay', help='NAME:SEED of a single case')
+    args = parser.parse_args(argv)
+    if args.replay:
+        name, seed = args.replay.split(':')
+        failure = run_case(name, int(seed))
+        print(failure or 'ok')
+        return 1 if failure else 0
+    iterations = args.iterations
+    if iterations is None and args.duration is None:
+        iterations = 100000 if args.fuzz else 700
+
+    def report(failure):
+        print('MISMATCH ' + failure)
+    count, failures = run(iterations, args.seed, args.duration, args.check,
+                          stop_early=not args.fuzz, report=report)
+    print('{} cases, {} mismatches'.format(count, len(failures)))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
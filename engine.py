@@ -0,0 +1,443 @@
+"""
+################################################################################
+Array engine
+
+Notes:
+
+numpy versions of the core operations in steganography.py and
+image_scrambler.py. They work on one pixel buffer, an array of shape
+(height, width, channels), instead of lists of lists of tuples, and give
+exactly the same results as the pure Python functions (including the
+row/column shuffles, which draw the same numbers from random.randint in
+the same order). The pure Python functions remain the reference; see
+differential.py.
+
+Used by pipeline.py. Functions that can work in place take an out
+argument; pass the input array to modify it in place. The *_batch
+functions take N images of the same size at once, as one
+(N, height, width, channels) stack.
+################################################################################
+"""
+import numpy as np
+from random import randint
+import bits
+import metrics
+import SimpleImage as sim
+
+"""
+Conversions
+"""
+
+def from_pil(PILimage, native=False):
+    """
+    PIL image -> (array, mode). As with SimpleImage.to_rectangle, the image
+    is converted to RGB unless native is set and its mode is supported.
+    """
+    mode = sim.native_mode(PILimage.mode) if native else 'RGB'
+    if PILimage.mode != mode:
+        PILimage = PILimage.convert(mode)
+    width, height = PILimage.size
+    channels = sim.get_channels(mode)
+    if sim.get_depth(mode) > 8:
+        dtype = '>u2' if mode == 'I;16B' else '<u2'
+        array = np.frombuffer(PILimage.tobytes(), dtype=dtype)
+        array = array.astype(np.uint16)
+    else:
+        array = np.frombuffer(PILimage.tobytes(), dtype=np.uint8).copy()
+    return array.reshape(height, width, channels), mode
+
+def to_pil(array, mode='RGB'):
+    from PIL import Image
+    height, width = array.shape[:2]
+    if sim.get_depth(mode) > 8:
+        dtype = '>u2' if mode == 'I;16B' else '<u2'
+        data = array.astype(dtype).tobytes()
+    else:
+        data = np.ascontiguousarray(array, dtype=np.uint8).tobytes()
+    return Image.frombytes(mode, (width, height), data)
+
+def from_rectangle(image, depth=8):
+    """
+    Rectangular list of lists of pixel tuples -> array.
+    """
+    dtype = np.uint16 if depth > 8 else np.uint8
+    if len(image) == 0 or len(image[0]) == 0:
+        return np.zeros((len(image), 0, 3), dtype=dtype)
+    return np.array(image, dtype=dtype)
+
+def to_rectangle(array):
+    return [[tuple(pixel) for pixel in row] for row in array.tolist()]
+
+"""
+Bits and messages
+"""
+
+def message_bytes(message):
+    """
+    The bytes message_to_bits encodes: the low 8 bits of each character.
+    """
+    return bytes(bytearray([ord(char) & 0xFF for char in message]))
+
+def message_to_bits(message):
+    """
+    Same as bits.message_to_bits, but returns an array of 0s and 1s.
+    """
+    return np.unpackbits(np.frombuffer(message_bytes(message),
+                                       dtype=np.uint8))
+
+def bytes_to_message(data):
+    """
+    Same as bits.bits_to_message, for a bitstream already packed into bytes
+    (any incomplete last byte must already have been dropped).
+    """
+    end = data.find(b'\x00')
+    if end >= 0:
+        data = data[:end]
+    return ''.join([chr(byte) for byte in bytearray(data)])
+
+"""
+Encode/decode
+"""
+
+def check_num_bits(num_bits, depth=8):
+    """
+    Raise ValueError unless num_bits is 1 .. depth, the check done by every
+    encode/decode function here.
+    """
+    if not(0 < num_bits <= depth):
+        raise ValueError('Number of bits must be an integer between 1 and {}'
+                         ' inclusive'.format(depth))
+
+def encode_ext(array, message, num_bits, depth=8, out=None):
+    """
+    Same result as steganography.encode_ext, on an array.
+    """
+    check_num_bits(num_bits, depth)
+    span = metrics.start('encode_ext')
+    if out is None:
+        out = array.copy()
+    elif out is not array:
+        out[...] = array
+    data = message_bytes(message)
+    span.lap('bits')
+    # the low num_bits bits of every intensity value are cleared after
+    # the message, like the reference does
+    bits.insert_planes(out, data, num_bits)
+    span.lap('embed')
+    pixels, size = metrics.array_stats(out)
+    span.done(pixels, len(message), size + len(data))
+    return out
+
+def decode_ext(array, num_bits, depth=8, block_size=65536):
+    """
+    Same result as steganography.decode_ext, on an array. Intensity values
+    are read block_size at a time and reading stops at the stop code.
+    """
+    check_num_bits(num_bits, depth)
+    span = metrics.start('decode_ext')
+    flat = array.reshape(-1)
+    # blocks of intensity values whose bits fill whole bytes
+    step = block_size * 8
+    data = []
+    for start in range(0, flat.size, step):
+        packed = bits.extract_planes(flat[start:start + step],
+                                     num_bits).tobytes()
+        end = packed.find(b'\x00')
+        if end >= 0:
+            data.append(packed[:end])
+            break
+        data.append(packed)
+    data = b''.join(data)
+    span.lap('extract')
+    message = bytes_to_message(data)
+    span.lap('bits')
+    pixels, size = metrics.array_stats(array)
+    span.done(pixels, len(message), size + len(data))
+    return message
+
+"""
+Intensity scrambling: int_mod is a fixed map on values, so it becomes a
+table lookup
+"""
+
+_LUTS = {}
+
+def _int_mod_table(depth=8):
+    import image_scrambler as isc
+    key = ('mix', depth)
+    if key not in _LUTS:
+        table = np.array([isc.int_mod(n) for n in range(256)],
+                         dtype=np.uint8)
+        if depth > 8:
+            n = np.arange(1 << 16, dtype=np.uint32)
+            high = (n >> 8) ^ 0xFF
+            high = ((high & 0x0F) << 4) | (high >> 4)
+            table = ((high << 8) | table[n & 0xFF]).astype(np.uint16)
+        table.setflags(write=False)
+        _LUTS[key] = table
+    return _LUTS[key]
+
+def int_mix_table(depth=8):
+    """
+    Lookup table equivalent to image_scrambler.int_mod (or int_mod16).
+    """
+    return _int_mod_table(depth)
+
+def unmix_int_table(depth=8):
+    """
+    Lookup table equivalent to image_scrambler.unmix_int (int_mod applied
+    five times).
+    """
+    key = ('unmix', depth)
+    if key not in _LUTS:
+        table = mix = int_mix_table(depth)
+        for i in range(4):
+            table = mix[table]
+        table = np.ascontiguousarray(table)
+        table.setflags(write=False)
+        _LUTS[key] = table
+    return _LUTS[key]
+
+def apply_table(array, table, out=None):
+    if out is None:
+        return table[array]
+    np.take(table, array, out=out)
+    return out
+
+def int_mod(n, depth=8):
+    return int(int_mix_table(depth)[n])
+
+def int_mix(array, depth=8, out=None):
+    return apply_table(array, int_mix_table(depth), out)
+
+def unmix_int(array, depth=8, out=None):
+    return apply_table(array, unmix_int_table(depth), out)
+
+"""
+Batches: N images of the same size as one (N, height, width, channels)
+stack, so a batch of thumbnails costs one pass instead of N calls
+"""
+
+def stack(images, depth=8):
+    """
+    Stack a list of images (arrays, rectangular lists or PIL images, which
+    are converted to RGB) of the same size into one (N, height, width,
+    channels) array. A 4 dimensional array is returned as it is.
+    """
+    if isinstance(images, np.ndarray) and images.ndim == 4:
+        return images
+    arrays = []
+    for image in images:
+        if isinstance(image, np.ndarray):
+            arrays.append(image)
+        elif hasattr(image, 'getbands'):
+            arrays.append(from_pil(image)[0])
+        else:
+            arrays.append(from_rectangle(image, depth))
+    if not arrays:
+        return np.zeros((0, 0, 0, 3), dtype=np.uint16 if depth > 8
+                        else np.uint8)
+    if len(set(array.shape for array in arrays)) > 1:
+        raise ValueError('Images in a batch must all have the same size')
+    return np.stack(arrays)
+
+def _batch_lines(batch):
+    # one line of intensity values per image (a view)
+    return batch.reshape(len(batch), int(np.prod(batch.shape[1:])))
+
+def encode_ext_batch(images, messages, num_bits, depth=8, out=None):
+    """
+    encode_ext for a batch: messages[i] is encoded into image i, all in
+    one pass. images is a stack or a list (see stack).
+
+    Result:
+        The encoded (N, height, width, channels) stack, in the same order.
+    """
+    check_num_bits(num_bits, depth)
+    span = metrics.start('encode_ext_batch')
+    batch = stack(images, depth)
+    messages = list(messages)
+    if len(messages) != len(batch):
+        raise ValueError('Expected {} messages, got {}'.format(
+            len(batch), len(messages)))
+    if out is None:
+        out = batch.copy()
+    elif out is not batch:
+        out[...] = batch
+    # one row of message bytes per image; the zero padding after shorter
+    # messages is the same as the cleared bits after them
+    data = [message_bytes(message) for message in messages]
+    rows = np.zeros((len(data), max([len(row) for row in data] or [0])),
+                    dtype=np.uint8)
+    for i, row in enumerate(data):
+        rows[i, :len(row)] = np.frombuffer(row, dtype=np.uint8)
+    span.lap('bits')
+    bits.insert_planes(_batch_lines(out), rows, num_bits, per_line=True)
+    span.lap('embed')
+    pixels, size = metrics.array_stats(out)
+    span.done(pixels, sum([len(row) for row in data]), size + rows.nbytes)
+    return out
+
+def decode_ext_batch(images, num_bits, depth=8, block_size=65536):
+    """
+    decode_ext for a batch. Intensity values are read a block at a time
+    (growing up to block_size) and only for the images whose message has
+    not ended yet.
+
+    Result:
+        List of the N messages, in the same order as the images.
+    """
+    check_num_bits(num_bits, depth)
+    span = metrics.start('decode_ext_batch')
+    batch = stack(images, depth)
+    lines = _batch_lines(batch)
+    data = [[] for line in lines]
+    active = np.arange(len(lines))
+    # messages are often short: start with a small block and grow it up
+    # to block_size * 8 values (always a multiple of 8, so the bits of a
+    # block fill whole bytes)
+    start, step = 0, min(4096, block_size * 8)
+    while start < lines.shape[1] and len(active):
+        packed = bits.extract_planes(lines[active, start:start + step],
+                                     num_bits, per_line=True)
+        remaining = []
+        for i, row in zip(active.tolist(), packed):
+            row = row.tobytes()
+            end = row.find(b'\x00')
+            if end >= 0:
+                data[i].append(row[:end])
+            else:
+                data[i].append(row)
+                remaining.append(i)
+        active = np.array(remaining, dtype=np.intp)
+        start += step
+        step = min(step * 2, block_size * 8)
+    data = [b''.join(chunks) for chunks in data]
+    span.lap('extract')
+    messages = [bytes_to_message(row) for row in data]
+    span.lap('bits')
+    pixels, size = metrics.array_stats(batch)
+    span.done(pixels, sum([len(row) for row in data]), size)
+    return messages
+
+def int_mix_batch(images, depth=8):
+    """
+    int_mix for a batch (int_mix itself takes arrays of any shape).
+    """
+    span = metrics.start('int_mix_batch')
+    batch = stack(images, depth)
+    out = int_mix(batch, depth)
+    span.lap('int_mix')
+    pixels, size = metrics.array_stats(batch)
+    span.done(pixels, buffer_bytes=size)
+    return out
+
+def unmix_int_batch(images, depth=8):
+    span = metrics.start('unmix_int_batch')
+    batch = stack(images, depth)
+    out = unmix_int(batch, depth)
+    span.lap('unmix_int')
+    pixels, size = metrics.array_stats(batch)
+    span.done(pixels, buffer_bytes=size)
+    return out
+
+"""
+Row and column shuffles
+"""
+
+def _tag_lines(lines, position):
+    # lines: (n, length) view; same as image_scrambler.tagger: line k gets
+    # the bits of str(k) at bit position, and zeros after them
+    count = len(lines)
+    tags = np.zeros((count, len(str(max(count - 1, 0)))), dtype=np.uint8)
+    for k in range(count):
+        tag = str(k).encode('ascii')
+        tags[k, :len(tag)] = np.frombuffer(tag, dtype=np.uint8)
+    return bits.insert_planes(lines.copy(), tags, 1, position, per_line=True)
+
+def _shuffle_order(count):
+    # the same randint calls as image_scrambler.mix_rows/mix_cols
+    remaining = list(range(count))
+    order = []
+    while remaining:
+        index = randint(0, len(remaining) - 1)
+        order.append(remaining[index])
+        del remaining[index]
+    return order
+
+def _read_tags(lines, position):
+    # same as image_scrambler.extractor for each line, lazily, so that
+    # errors come up in the same order as in the reference
+    for row in bits.extract_planes(lines, 1, position, per_line=True):
+        yield int(bytes_to_message(row.tobytes()))
+
+def _place(lines, numbers):
+    # template[n] = line for each line, as in unmix_rows
+    count = len(lines)
+    order = []
+    for n in numbers:
+        if not -count <= n < count:
+            raise IndexError('list assignment index out of range')
+        order.append(n)
+    result = lines.copy()
+    result[np.array(order, dtype=np.intp)] = lines
+    return result
+
+def mix_rows(array):
+    height, width, channels = array.shape
+    tagged = _tag_lines(array.reshape(height, width * channels), 0)
+    return tagged[_shuffle_order(height)].reshape(height, width, channels)
+
+def unmix_rows(array):
+    height, width, channels = array.shape
+    lines = array.reshape(height, width * channels)
+    return _place(lines, _read_tags(lines, 0)).reshape(array.shape)
+
+def mix_cols(array):
+    height, width, channels = array.shape
+    # the reference transposes twice, which fails for empty images
+    if height == 0 or width == 0:
+        raise IndexError('list index out of range')
+    columns = array.transpose(1, 0, 2).reshape(width, height * channels)
+    tagged = _tag_lines(columns, 1)[_shuffle_order(width)]
+    return tagged.reshape(width, height, channels).transpose(1, 0, 2).copy()
+
+def unmix_cols(array):
+    height, width, channels = array.shape
+    if height == 0 or width == 0:
+        raise IndexError('list index out of range')
+    columns = array.transpose(1, 0, 2).reshape(width, height * channels)
+    placed = _place(columns, _read_tags(columns, 1))
+    return placed.reshape(width, height, channels).transpose(1, 0, 2).copy()
+
+def mix(array):
+    return mix_cols(mix_rows(array))
+
+def unmix(array):
+    return unmix_rows(unmix_cols(array))
+
+def scramble(array, depth=8):
+    """
+    Same result as image_scrambler.scramble, given the same random state.
+    """
+    span = metrics.start('scramble')
+    mixed = mix(array)
+    span.lap('mix')
+    int_mix(mixed, depth, out=mixed)
+    span.lap('int_mix')
+    pixels, size = metrics.array_stats(array)
+    span.done(pixels, buffer_bytes=size)
+    return mixed
+
+def unscramble(array, depth=8):
+    """
+    Same result as image_scrambler.unscramble.
+    """
+    span = metrics.start('unscramble')
+    clean_int = unmix_int(array, depth)
+    span.lap('unmix_int')
+    all_clean = unmix(clean_int)
+    span.lap('unmix')
+    pixels, size = metrics.array_stats(array)
+    span.done(pixels, buffer_bytes=size)
+    return all_clean
@@ -24,19 +24,33 @@ Columns, then rows, are unscrambled
 ################################################################################
 
 
+from functools import lru_cache
 import bits
+import metrics
 import SimpleImage as sim
 from random import randint
-from PIL import Image
 
-def scramble(image):
+# depth is the number of bits per intensity value: 8, or 16 for 16-bit
+# images read in native mode (see SimpleImage.NATIVE_MODES)
+
+def scramble(image, depth=8):
+    span = metrics.start('scramble')
     sliced_and_diced = mix(image)
-    scrambled = int_mix(sliced_and_diced)
+    span.lap('mix')
+    scrambled = int_mix(sliced_and_diced, depth)
+    span.lap('int_mix')
+    pixels, size = metrics.image_stats(image, depth)
+    span.done(pixels, buffer_bytes=size)
     return scrambled
 
-def unscramble(image):
-    clean_int = unmix_int(image)
+def unscramble(image, depth=8):
+    span = metrics.start('unscramble')
+    clean_int = unmix_int(image, depth)
+    span.lap('unmix_int')
     all_clean = unmix(clean_int)
+    span.lap('unmix')
+    pixels, size = metrics.image_stats(image, depth)
+    span.done(pixels, buffer_bytes=size)
     return all_clean
 
 def tagger(image,position):
@@ -47,22 +61,22 @@ def tagger(image,position):
         row_bits = bits.message_to_bits(str(row_n))
         i = 0
         new_row = []
-        # Nested 'for' loop iterates over each pixel in the current row-list
-        # (r,g,b) matches r,g,b to the three intenstiy values in each pixel
-        # respectively, so r = first intensity value (red), and so on.
+        # Nested 'for' loop iterates over each pixel in the current row-list,
+        # and then over its intensity values (three for RGB, 1-4 for
+        # images in native mode)
         
-        for (r,g,b) in row:
-            # Use codebit function to set the LSB of the
-            # new intensity values to match the bit being indexed 
-            new_r = bits.set_bit(r,bits.codebit(i,row_bits),position)
-            new_g = bits.set_bit(g,bits.codebit(i + 1,row_bits),position)
-            new_b = bits.set_bit(b,bits.codebit(i + 2,row_bits),position)
-            # Amalgamate the three new intensity values into a new pixel
-            new_pixel = (new_r,new_g,new_b)
+        for pixel in row:
+            new_pixel = []
+            for intensity in pixel:
+                # Use codebit function to set the bit at position of the
+                # new intensity value to match the bit being indexed 
+                new_pixel.append(bits.set_bit(intensity,
+                                              bits.codebit(i,row_bits),
+                                              position))
+                # increment counter by 1 for each intensity value
+                i += 1
             # Append new pixel to new row-list
-            new_row.append(new_pixel)
-            # increment counter by 3, as each pixel has 3 intensity values
-            i += 3
+            new_row.append(tuple(new_pixel))
         
         # attach new row-list to new image-list
         new_image.append(new_row)
@@ -168,30 +182,233 @@ def int_mod(n):
     new_int = int('0b' + new_bin,2)
     return new_int
 
-def int_mix(image):
+def int_mod16(n):
+    # 16-bit version: the low byte goes through int_mod (so the row and
+    # column tags in bits 0 and 1 survive), the high byte is inverted and
+    # has its nibbles swapped. That is its own inverse, so like int_mod
+    # six applications give back the original value.
+    high = (n >> 8) ^ 0xFF
+    high = ((high & 0x0F) << 4) | (high >> 4)
+    return (high << 8) | int_mod(n & 0xFF)
+
+def int_mix(image, depth=8):
+    if depth > 8:
+        modify = int_mod16
+    else:
+        modify = int_mod
     new_image = []
     for row in image:
         new_row = []
-        for r,g,b in row:
-            new_r = int_mod(r)
-            new_g = int_mod(g)
-            new_b = int_mod(b)
-            new_pixel = (new_r,new_g,new_b)
+        for pixel in row:
+            new_pixel = tuple([modify(intensity) for intensity in pixel])
             new_row.append(new_pixel)
         new_image.append(new_row)
     return new_image
 
-def unmix_int(image):
-    mix = int_mix(image)
+def unmix_int(image, depth=8):
+    mix = int_mix(image, depth)
     for i in range(4):
-        mix = int_mix(mix)
+        mix = int_mix(mix, depth)
     return mix
 
+"""
+Tiled block scrambling
+
+mix permutes whole rows and then whole columns, and the column pass has to
+walk the image column by column (hence the transpose copies). The tiled
+mode works on square tiles (64x64 pixels by default) instead:
+
+- the full tiles are permuted; destination tile d comes from source tile
+  perm[d]
+- each tile is turned/flipped into one of its 8 orientations
+- every intensity value is XORed with a key stream the size of one tile,
+  plus a per-tile value, so flat areas do not give the tiles away
+- the strips along the right and bottom edges that do not fill a whole
+  tile stay in place and are only XORed
+
+perm, the orientations and the key stream all come from the key (a string
+or bytes), so nothing needs to be stored in the image and the exact image
+comes back on unscrambling (no tag bits are overwritten, unlike scramble).
+Each destination tile only depends on one source tile, so the image is
+processed one row of tiles at a time, with every tile read and written as
+a contiguous block; rows of tiles can run in parallel (workers).
+
+These functions work on numpy arrays of shape (height, width, channels),
+see engine.py; scramblePILimage/unscramblePILimage use them with
+method='tiles'.
+"""
+
+TILE_SIZE = 64
+
+@lru_cache(maxsize=4)
+def tile_plan(key, tiles_y, tiles_x, tile, channels, depth=8):
+    """
+    (perm, orientations, tile values, key stream) for a grid of
+    tiles_y x tiles_x tiles, derived from key. Cached, like
+    steganography.scatter_index; the arrays are read-only.
+    """
+    import hashlib
+    import numpy as np
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    seed = hashlib.sha256(b'tiles:' + key).digest()
+    rng = np.random.default_rng(list(bytearray(seed)))
+    dtype = np.uint16 if depth > 8 else np.uint8
+    top = (1 << depth) - 1
+    count = tiles_y * tiles_x
+    perm = rng.permutation(count)
+    orientations = rng.integers(0, 8, count)
+    values = rng.integers(0, top + 1, count).astype(dtype)
+    stream = rng.integers(0, top + 1, (tile, tile, channels)).astype(dtype)
+    for array in (perm, orientations, values, stream):
+        array.setflags(write=False)
+    return perm, orientations, values, stream
+
+def _orient(block, k):
+    # one of the 8 rotations/reflections of a square tile
+    import numpy as np
+    block = np.rot90(block, k % 4) if k % 4 else block
+    return block[:, ::-1] if k >= 4 else block
+
+def _unorient(block, k):
+    import numpy as np
+    block = block[:, ::-1] if k >= 4 else block
+    return np.rot90(block, -(k % 4)) if k % 4 else block
+
+def _xor_edges(array, out, stream, tiles_y, tiles_x, tile):
+    # the strips outside the tile grid: key stream repeated over them
+    import numpy as np
+    height, width = array.shape[:2]
+    for top, bottom, left, right in ((0, height, tiles_x * tile, width),
+                                     (tiles_y * tile, height, 0,
+                                      tiles_x * tile)):
+        if bottom > top and right > left:
+            reps = (-(-(bottom - top) // tile), -(-(right - left) // tile), 1)
+            mask = np.tile(stream, reps)[:bottom - top, :right - left]
+            out[top:bottom, left:right] = array[top:bottom, left:right] ^ mask
+
+def _tiled(array, key, tile, depth, workers, inverse):
+    import numpy as np
+    height, width, channels = array.shape
+    tiles_y, tiles_x = height // tile, width // tile
+    perm, orientations, values, stream = tile_plan(
+        key, tiles_y, tiles_x, tile, channels, depth)
+    out = np.empty_like(array)
+
+    def block(n):
+        y, x = divmod(int(n), tiles_x)
+        return (slice(y * tile, (y + 1) * tile),
+                slice(x * tile, (x + 1) * tile))
+
+    def band(tile_row):
+        # one row of destination tiles
+        for d in range(tile_row * tiles_x, (tile_row + 1) * tiles_x):
+            mask = stream ^ values[d]
+            if inverse:
+                out[block(perm[d])] = _unorient(array[block(d)] ^ mask,
+                                                orientations[d])
+            else:
+                out[block(d)] = _orient(array[block(perm[d])],
+                                        orientations[d]) ^ mask
+
+    if workers > 1 and tiles_y > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(band, range(tiles_y)))
+    else:
+        for tile_row in range(tiles_y):
+            band(tile_row)
+    _xor_edges(array, out, stream, tiles_y, tiles_x, tile)
+    return out
+
+def _check_key(key, tile):
+    if key is None:
+        raise ValueError('Tiled scrambling needs a key')
+    if not isinstance(key, (str, bytes)):
+        raise ValueError('The scrambling key must be a string or bytes, '
+                         'not {}'.format(type(key).__name__))
+    if tile < 1:
+        raise ValueError('The tile size must be at least 1, not {}'.format(
+            tile))
+
+def scramble_tiles(array, key, tile=TILE_SIZE, depth=8, workers=1):
+    """
+    Tiled scramble of an array of shape (height, width, channels).
+
+    Result:
+        A new array of the same shape; unscramble_tiles with the same key
+        and tile size gives back the original exactly.
+    """
+    _check_key(key, tile)
+    span = metrics.start('scramble_tiles')
+    out = _tiled(array, key, tile, depth, workers, False)
+    span.lap('tiles')
+    span.done(array.shape[0] * array.shape[1], buffer_bytes=array.nbytes)
+    return out
+
+def unscramble_tiles(array, key, tile=TILE_SIZE, depth=8, workers=1):
+    _check_key(key, tile)
+    span = metrics.start('unscramble_tiles')
+    out = _tiled(array, key, tile, depth, workers, True)
+    span.lap('tiles')
+    span.done(array.shape[0] * array.shape[1], buffer_bytes=array.nbytes)
+    return out
+
 # function wrapper for gui
-def scramblePILimage(PILimage):
-    image = sim.to_rectangle(PILimage)
-    return sim.to_flat(scramble(image))
+# With native=True the image keeps its own mode and bit depth (see
+# SimpleImage.NATIVE_MODES) instead of being converted to RGB.
+# method='tiles' uses the tiled block mode above, which needs a key.
+# Both take the same arguments in the same order; unscramblePILimage can
+# also keep its results in a resultcache.ResultCache (cache, last).
+SCRAMBLE_METHODS = ('rows', 'tiles')
+
+def _check_method(method):
+    if method not in SCRAMBLE_METHODS:
+        raise ValueError('Unknown scramble method {}'.format(method))
+
+def _tiles_PILimage(PILimage, native, key, tile, inverse):
+    import engine
+    array, mode = engine.from_pil(PILimage, native)
+    process = unscramble_tiles if inverse else scramble_tiles
+    return engine.to_pil(process(array, key, tile, sim.get_depth(mode)),
+                         mode)
+
+def scramblePILimage(PILimage, native=False, method='rows', key=None,
+                     tile=TILE_SIZE):
+    _check_method(method)
+    if method == 'tiles':
+        return _tiles_PILimage(PILimage, native, key, tile, False)
+    mode = sim.native_mode(PILimage.mode) if native else 'RGB'
+    image = sim.to_rectangle(PILimage, native)
+    return sim.to_flat(scramble(image, sim.get_depth(mode)), mode)
+
+def unscramblePILimage(PILimage, native=False, method='rows', key=None,
+                       tile=TILE_SIZE, cache=None):
+    _check_method(method)
+    mode = sim.native_mode(PILimage.mode) if native else 'RGB'
+    depth = sim.get_depth(mode)
+    if method == 'tiles':
+        _check_key(key, tile)
 
-def unscramblePILimage(PILimage):
-    image = sim.to_rectangle(PILimage)
-    return sim.to_flat(unscramble(image))
\ No newline at end of file
+        def run():
+            return _tiles_PILimage(PILimage, native, key, tile, True)
+    else:
+        def run():
+            image = sim.to_rectangle(PILimage, native)
+            return sim.to_flat(unscramble(image, depth), mode)
+    if cache is None:
+        return run()
+    # results are cached as (mode, size, pixel bytes); see resultcache.py
+    from PIL import Image
+    import resultcache
+    params = {'native': native}
+    if method == 'tiles':
+        params.update(method=method, key=key, tile=tile)
+    cache_key = resultcache.image_key(PILimage, 'unscramble', **params)
+    result = cache.get(cache_key)
+    if result is None:
+        output = run()
+        result = (output.mode, output.size, output.tobytes())
+        cache.put(cache_key, result)
+    mode, size, data = result
+    return Image.frombytes(mode, size, data)
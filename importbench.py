@@ -0,0 +1,110 @@
+"""
+################################################################################
+Import-time benchmark
+
+Notes:
+
+For short-lived command line runs (one process per file) the time taken to
+import the modules is a large part of the total. This script imports each
+module in a fresh interpreter several times, takes the median, and checks
+it against a budget. It also checks that heavy dependencies are not
+imported until an image operation actually runs:
+
+- no module may pull in PIL or numpy at import time
+- bits may not import anything outside the standard library
+
+Exits with status 1 if any budget is exceeded or a check fails, so it can
+be run as part of a build. Budgets are in milliseconds; use --scale on
+slow machines.
+
+Run:
+    python importbench.py
+    python importbench.py --repeat 15 --scale 2
+################################################################################
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# module -> import time budget in milliseconds
+BUDGETS = {
+    'bits': 10,
+    'SimpleImage': 10,
+    'steganography': 25,
+    'image_scrambler': 25,
+    'cli': 25,
+}
+HEAVY_MODULES = ('PIL', 'numpy')
+STDLIB_ONLY = ('bits',)
+
+# Runs in the child interpreter: time the import and report which
+# top-level modules it loaded
+PROBE = """
+import json, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = sorted(set(name.split('.')[0] for name in set(sys.modules) - before))
+print(json.dumps({{'elapsed': elapsed, 'loaded': loaded}}))
+"""
+
+def measure(module, repeat=7):
+    """
+    Import module in repeat fresh interpreters. Returns (median import time
+    in ms, top-level modules loaded by the import).
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    loaded = []
+    for i in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', PROBE.format(module=module)], cwd=here)
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        times.append(result['elapsed'] * 1000)
+        loaded = result['loaded']
+    times.sort()
+    return times[len(times) // 2], loaded
+
+def check(repeat=7, scale=1.0):
+    """
+    Measure every module in BUDGETS; prints a report and returns a list
+    of problems (empty if everything is within budget).
+    """
+    stdlib = getattr(sys, 'stdlib_module_names', None)
+    problems = []
+    for module in sorted(BUDGETS):
+        elapsed, loaded = measure(module, repeat)
+        budget = BUDGETS[module] * scale
+        print('{:<16} {:7.2f} ms  (budget {:.0f} ms)'.format(module, elapsed,
+                                                             budget))
+        if elapsed > budget:
+            problems.append('{} took {:.1f} ms to import, budget {:.0f} ms'
+                            .format(module, elapsed, budget))
+        heavy = [name for name in loaded if name in HEAVY_MODULES]
+        if heavy:
+            problems.append('{} imports {} eagerly'.format(module,
+                                                           ', '.join(heavy)))
+        if module in STDLIB_ONLY and stdlib is not None:
+            outside = [name for name in loaded if name not in stdlib and
+                       name != module and not name.startswith('_')]
+            if outside:
+                problems.append('{} imports non-stdlib modules: {}'.format(
+                    module, ', '.join(outside)))
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import-time benchmark')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply all budgets by this factor')
+    args = parser.parse_args(argv)
+    problems = check(args.repeat, args.scale)
+    for problem in problems:
+        print('FAIL: ' + problem)
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,266 @@
+"""
+################################################################################
+Metrics
+
+Notes:
+
+Counters and histograms for the core operations, updated by the library
+functions themselves (steganography.encode_ext/decode_ext,
+image_scrambler.scramble/unscramble, their numpy versions in engine.py
+under the same operation and stage names, the engine *_batch functions
+and Pipeline.run), so every caller is measured, not just one front end:
+
+    image_operations_total{operation}             calls
+    image_pixels_total{operation}                 pixels processed
+    image_payload_bytes_total{operation}          message bytes in/out
+    image_operation_seconds{operation,stage}      latency per stage, and
+                                                  stage="total"
+    image_operation_pixels{operation}             image size per call
+    image_peak_buffer_bytes{operation}            largest working buffer
+                                                  seen (pixel data plus
+                                                  bitstream)
+
+Export is in the Prometheus text format, either to a file (for the node
+exporter textfile collector) or from a small HTTP endpoint:
+
+    metrics.write('/var/lib/node_exporter/image.prom')
+    metrics.serve(9105)                 # GET /metrics
+
+Recording is a few dict updates per call (never per pixel), so it is on
+by default; set IMAGE_METRICS=0 in the environment or call disable() to
+turn it off. Only the standard library is used, to keep imports cheap.
+################################################################################
+"""
+import bisect
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+PIXEL_BUCKETS = (1e3, 1e4, 1e5, 1e6, 4e6, 1.6e7, 6.4e7)
+
+_enabled = os.environ.get('IMAGE_METRICS', '1') != '0'
+_lock = threading.Lock()
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def enabled():
+    return _enabled
+
+"""
+Metric types
+"""
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                              .replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}'
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, _label_text(self.labels, labels), value
+
+class Maximum(Counter):
+    """
+    A gauge holding the largest value observed.
+    """
+    kind = 'gauge'
+
+    def observe(self, labels=(), value=0):
+        with _lock:
+            if value > self.values.get(labels, 0):
+                self.values[labels] = value
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (last is +Inf), sum]
+        self.values = {}
+
+    def observe(self, labels=(), value=0.0):
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1),
+                                               0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for labels, (counts, total) in sorted(self.values.items()):
+            running = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                running += count
+                yield (self.name + '_bucket',
+                       _label_text(names, labels + (bound,)), running)
+            yield self.name + '_sum', _label_text(self.labels, labels), total
+            yield self.name + '_count', _label_text(self.labels, labels), \
+                running
+
+OPERATIONS = Counter('image_operations_total', 'Operations run',
+                     ('operation',))
+PIXELS = Counter('image_pixels_total', 'Pixels processed', ('operation',))
+PAYLOAD_BYTES = Counter('image_payload_bytes_total',
+                        'Message bytes encoded or decoded', ('operation',))
+LATENCY = Histogram('image_operation_seconds', 'Time per operation stage',
+                    ('operation', 'stage'))
+SIZES = Histogram('image_operation_pixels', 'Image size per operation',
+                  ('operation',), PIXEL_BUCKETS)
+PEAK_BUFFER = Maximum('image_peak_buffer_bytes',
+                      'Largest working buffer of an operation',
+                      ('operation',))
+
+REGISTRY = [OPERATIONS, PIXELS, PAYLOAD_BYTES, LATENCY, SIZES, PEAK_BUFFER]
+
+def reset():
+    with _lock:
+        for metric in REGISTRY:
+            metric.values.clear()
+
+"""
+Recording
+"""
+
+class Span(object):
+    """
+    Timing of one call: lap(stage) records the time since the previous lap
+    (or the start) for that stage, done() records the totals.
+    """
+    def __init__(self, operation):
+        self.operation = operation
+        self.start = self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        LATENCY.observe((self.operation, stage), now - self.last)
+        self.last = now
+
+    def done(self, pixels=0, payload_bytes=0, buffer_bytes=0):
+        operation = (self.operation,)
+        LATENCY.observe((self.operation, 'total'),
+                        time.perf_counter() - self.start)
+        OPERATIONS.inc(operation)
+        PIXELS.inc(operation, pixels)
+        SIZES.observe(operation, pixels)
+        if payload_bytes:
+            PAYLOAD_BYTES.inc(operation, payload_bytes)
+        PEAK_BUFFER.observe(operation, buffer_bytes)
+
+class _NullSpan(object):
+    def lap(self, stage):
+        pass
+
+    def done(self, pixels=0, payload_bytes=0, buffer_bytes=0):
+        pass
+
+NULL_SPAN = _NullSpan()
+
+def start(operation):
+    """
+    Start timing an operation; returns a Span (a no-op one if metrics are
+    disabled).
+    """
+    if not _enabled:
+        return NULL_SPAN
+    return Span(operation)
+
+def image_stats(image, depth=8):
+    """
+    (pixels, bytes of pixel data) for an image in rectangular format.
+    """
+    if not image or not image[0]:
+        return 0, 0
+    pixels = len(image) * len(image[0])
+    return pixels, pixels * len(image[0][0]) * (2 if depth > 8 else 1)
+
+def array_stats(array):
+    """
+    (pixels, bytes of pixel data) for an array of shape (..., channels),
+    e.g. one image or a stack of them (see engine.py).
+    """
+    channels = array.shape[-1] if array.ndim > 1 else 1
+    return (array.size // channels if channels else 0), array.nbytes
+
+"""
+Export
+"""
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    with _lock:
+        for metric in REGISTRY:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, labels, value))
+    return '\n'.join(lines) + '\n'
+
+def write(filename):
+    """
+    Write the metrics to filename, atomically (a scraper never sees a
+    half written file).
+    """
+    temp_name = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp_name, 'w') as outfile:
+        outfile.write(render())
+    os.replace(temp_name, filename)
+
+def serve(port=9105, host='127.0.0.1'):
+    """
+    Serve GET /metrics from a background thread. Returns the server
+    (call shutdown() to stop it).
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,167 @@
+"""
+################################################################################
+Multi-cover payloads
+
+Notes:
+
+encode_file embeds as much of a payload as fits in one cover and drops the
+rest. For payloads bigger than any single cover (archives several GB in
+size), the functions here split the payload into shards, one per cover,
+each sized to that cover's capacity.
+
+Each shard is an ordinary encode_file payload with FLAG_SHARD set and its
+sequence number in the header; the final shard also has FLAG_LAST_SHARD
+set, so the payload can be read from a stream without knowing its total
+size in advance.
+
+Covers are encoded in parallel across a process pool. On decode the
+headers are read first (only the top rows of each image are decoded) to
+put the images in shard order, whatever order they are given in; the
+images are then decoded concurrently and the shards written out in
+sequence. At most two shards per worker are in flight at a time, so memory
+use is bounded by the cover sizes, not the payload size.
+################################################################################
+"""
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import SimpleImage as sim
+import steganography as steg
+
+def shard_capacity(image_name, num_bits):
+    """
+    Number of payload bytes a cover can hold as a shard. Only the image
+    header is read.
+    """
+    width, height = sim.read_size(image_name)
+    return (width * height * 3 * num_bits) // 8 \
+        - steg.header_size(steg.FLAG_SHARD)
+
+def _read_exact(payload_file, size):
+    # file.read may return short reads for pipes/sockets
+    chunks = []
+    while size > 0:
+        chunk = payload_file.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+def _encode_shard(cover_name, data, index, last, num_bits, out_name):
+    flags = steg.FLAG_SHARD
+    if last:
+        flags |= steg.FLAG_LAST_SHARD
+    return steg.encode_file(cover_name, io.BytesIO(data), num_bits, out_name,
+                            flags=flags, shard_index=index)
+
+def _shard_header(image_name, num_bits):
+    # only the top rows of the image are decoded
+    header = steg.read_header_direct(image_name, num_bits)
+    if not header.flags & steg.FLAG_SHARD:
+        raise ValueError('{} does not hold a payload shard'.format(image_name))
+    return header.shard_index, bool(header.flags & steg.FLAG_LAST_SHARD)
+
+def _decode_shard(image_name, num_bits):
+    out = io.BytesIO()
+    steg.extract_file(sim.read_image(image_name), num_bits, out, 65536)
+    return out.getvalue()
+
+def _drain(pending, max_pending):
+    # Wait until fewer than max_pending jobs are running; returns the
+    # futures that finished
+    finished = set()
+    while len(pending) >= max_pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        finished |= done
+    return finished, pending
+
+def encode_shards(cover_names, payload_file, num_bits, output_names,
+                  workers=None):
+    """
+    Split the payload read from payload_file across the covers, in order,
+    and write the encoded images to output_names (same length as
+    cover_names). Raises ValueError if the payload does not fit in all of
+    the covers together.
+
+    Result:
+        Number of covers used (the remaining covers are left untouched).
+    """
+    if len(cover_names) != len(output_names):
+        raise ValueError('Need one output name per cover')
+    if not steg._check_num_bits(num_bits):
+        return None
+    workers = workers or os.cpu_count() or 1
+    pending = set()
+    used = 0
+    # one byte of look-ahead tells us whether the current shard is the last
+    carry = b''
+    with ProcessPoolExecutor(workers) as pool:
+        for index, (cover, out_name) in enumerate(zip(cover_names,
+                                                       output_names)):
+            capacity = shard_capacity(cover, num_bits)
+            if capacity <= 0:
+                raise ValueError('{} is too small to hold a shard'
+                                 .format(cover))
+            data = carry + _read_exact(payload_file, capacity - len(carry))
+            carry = payload_file.read(1)
+            last = not carry
+            if not last and index == len(cover_names) - 1:
+                raise ValueError('Payload does not fit in the given covers')
+            done, pending = _drain(pending, 2 * workers)
+            for future in done:
+                future.result()
+            pending.add(pool.submit(_encode_shard, cover, data, index, last,
+                                    num_bits, out_name))
+            used += 1
+            if last:
+                break
+        for future in pending:
+            future.result()
+    return used
+
+def decode_shards(image_names, num_bits, out_file, workers=None):
+    """
+    Decode a set of images written by encode_shards (in any order) and
+    write the reassembled payload to the open binary file out_file.
+    Raises ValueError if shards are missing or duplicated.
+
+    Result:
+        Total number of payload bytes written.
+    """
+    if not steg._check_num_bits(num_bits):
+        return None
+    workers = workers or os.cpu_count() or 1
+    image_names = list(image_names)
+    with ProcessPoolExecutor(workers) as pool:
+        # put the images in shard order first, from their headers, so the
+        # shards can be written out as they are decoded
+        headers = pool.map(_shard_header, image_names,
+                           [num_bits] * len(image_names))
+        order = {}
+        last_index = None
+        for name, (index, last) in zip(image_names, headers):
+            if index in order:
+                raise ValueError('Duplicate shard {}'.format(index))
+            order[index] = name
+            if last:
+                last_index = index
+        if last_index is None or len(order) != last_index + 1 or \
+                max(order) != last_index:
+            raise ValueError('Missing shards: got {} of {}'.format(
+                len(order),
+                'unknown' if last_index is None else last_index + 1))
+        total = 0
+        pending = deque()
+        for index in range(last_index + 1):
+            if len(pending) >= 2 * workers:
+                data = pending.popleft().result()
+                out_file.write(data)
+                total += len(data)
+            pending.append(pool.submit(_decode_shard, order[index], num_bits))
+        while pending:
+            data = pending.popleft().result()
+            out_file.write(data)
+            total += len(data)
+    return total
@@ -0,0 +1,223 @@
+"""
+################################################################################
+Multi-frame images
+
+Notes:
+
+Image.open only presents the first frame of an animated GIF or multi-page
+TIFF, so scramblePILimage/encodePILimage leave the other frames alone. The
+functions here process every frame:
+
+- frames are read lazily, one at a time (only a few are held waiting for
+  a worker)
+- frames are processed in parallel across a process pool, in the frame's
+  own mode where possible (see SimpleImage.NATIVE_MODES)
+- results are written back as a multi-frame file in the original order,
+  keeping the per-frame duration for GIFs
+
+Palette ('P') frames, as found in GIFs, are processed on their palette
+indices and written back with the same palette, so nothing is lost to
+re-quantisation. GIF frames that Pillow can only present as RGB (frames
+with their own local palette) cannot be written back losslessly, so they
+are rejected.
+
+decode_frame decodes a single frame, seeking straight to it without
+decoding the others.
+################################################################################
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import SimpleImage as sim
+
+"""
+Frame helpers
+"""
+
+def _frame_state(frame):
+    # (mode, size, pixel bytes, palette): what a worker needs to rebuild
+    # the frame
+    palette = frame.getpalette() if frame.mode == 'P' else None
+    return frame.mode, frame.size, frame.tobytes(), palette
+
+def _frame_image(mode, size, data):
+    # palette frames are worked on as a plane of indices
+    from PIL import Image
+    if mode == 'P':
+        return Image.frombytes('L', size, data)
+    return Image.frombytes(mode, size, data)
+
+def _work_mode(mode):
+    if mode == 'P':
+        return 'L'
+    return sim.native_mode(mode)
+
+def process_frame(op, state, params):
+    """
+    Run op ('scramble', 'unscramble' or 'encode') on one frame; state is
+    as returned by _frame_state. Returns the new state.
+    """
+    import steganography as steg
+    import image_scrambler as isc
+
+    mode, size, data, palette = state
+    work_mode = _work_mode(mode)
+    image = sim.to_rectangle(_frame_image(mode, size, data), True)
+    depth = sim.get_depth(work_mode)
+    if op == 'scramble':
+        output = isc.scramble(image, depth)
+    elif op == 'unscramble':
+        output = isc.unscramble(image, depth)
+    elif op == 'encode':
+        output = steg.encode_ext(image, params['message'], params['num_bits'],
+                                 depth=depth)
+        if output is None:
+            raise ValueError('num_bits out of range')
+    else:
+        raise ValueError('Unknown operation {}'.format(op))
+    out_mode = 'P' if mode == 'P' else work_mode
+    return out_mode, size, sim.to_flat(output, work_mode).tobytes(), palette
+
+_strategy_lock = threading.RLock()
+
+@contextmanager
+def _palette_frames():
+    # keep GIF frames that share the global palette in 'P' mode (newer
+    # Pillow converts every frame after the first to RGB by default).
+    # Pillow reads the setting from a module global on every seek and
+    # load, so it is only changed for the duration of this block and then
+    # put back, leaving other GIF users in the process unaffected.
+    from PIL import GifImagePlugin
+    strategy = getattr(GifImagePlugin, 'LoadingStrategy', None)
+    if strategy is None:
+        yield
+        return
+    with _strategy_lock:
+        saved = GifImagePlugin.LOADING_STRATEGY
+        GifImagePlugin.LOADING_STRATEGY = \
+            strategy.RGB_AFTER_DIFFERENT_PALETTE_ONLY
+        try:
+            yield
+        finally:
+            GifImagePlugin.LOADING_STRATEGY = saved
+
+def _open_frames(filename):
+    from PIL import Image
+    with _palette_frames():
+        return Image.open(filename)
+
+def _read_frame(PILimage, index):
+    # seek to frame index and return its state, or None past the end
+    with _palette_frames():
+        try:
+            PILimage.seek(index)
+        except EOFError:
+            return None
+        if PILimage.format == 'GIF' and PILimage.mode != 'P':
+            raise ValueError('GIF frame {} has a local palette and cannot be '
+                             'written back losslessly'.format(index))
+        return _frame_state(PILimage), dict(PILimage.info)
+
+def iter_frames(PILimage):
+    """
+    Lazily yield (frame state, frame info) for every frame of an image.
+    """
+    index = 0
+    while True:
+        frame = _read_frame(PILimage, index)
+        if frame is None:
+            return
+        yield frame
+        index += 1
+
+"""
+Whole-file operations
+"""
+
+def process_frames(filename, out_filename, op, params=None, workers=None):
+    """
+    Run op on every frame of filename in parallel and write the frames, in
+    order, to out_filename (a multi-frame format: GIF or TIFF). params is
+    a dict of extra arguments for op, or a list of dicts, one per frame.
+
+    Result:
+        Number of frames written.
+    """
+    from PIL import Image
+    workers = workers or os.cpu_count() or 1
+    source = _open_frames(filename)
+    source_format = source.format
+    frames = []
+    durations = []
+    pending = []
+    with ProcessPoolExecutor(workers) as pool:
+        for index, (state, info) in enumerate(iter_frames(source)):
+            frame_params = params[index] if isinstance(params, list) \
+                else params
+            pending.append(pool.submit(process_frame, op, state,
+                                       frame_params or {}))
+            durations.append(info.get('duration'))
+            # bounded read-ahead: collect finished frames in order
+            while len(pending) >= 2 * workers:
+                frames.append(pending.pop(0).result())
+        frames += [future.result() for future in pending]
+    images = []
+    for mode, size, data, palette in frames:
+        image = Image.frombytes(mode, size, data)
+        if palette is not None:
+            image.putpalette(palette)
+        images.append(image)
+    options = {'save_all': True, 'append_images': images[1:]}
+    if source_format == 'GIF' or out_filename.lower().endswith('.gif'):
+        # keep frames and palettes exactly as they are; passing the shared
+        # palette stops Pillow writing a local palette per frame (which
+        # would make the frames read back as RGB)
+        options['optimize'] = False
+        options['disposal'] = 1
+        palettes = [frame[3] for frame in frames]
+        if palettes[0] is not None and \
+                all(palette == palettes[0] for palette in palettes):
+            options['palette'] = bytes(bytearray(palettes[0]))
+        if all(duration is not None for duration in durations):
+            options['duration'] = durations
+        options['loop'] = source.info.get('loop', 0)
+    images[0].save(out_filename, **options)
+    return len(images)
+
+def scramble_frames(filename, out_filename, workers=None):
+    return process_frames(filename, out_filename, 'scramble', None, workers)
+
+def unscramble_frames(filename, out_filename, workers=None):
+    return process_frames(filename, out_filename, 'unscramble', None, workers)
+
+def encode_frames(filename, messages, num_bits, out_filename, workers=None):
+    """
+    Encode a message into every frame; messages is a single message used
+    for all frames, or a list with one message per frame.
+    """
+    if isinstance(messages, list):
+        params = [{'message': message, 'num_bits': num_bits}
+                  for message in messages]
+    else:
+        params = {'message': messages, 'num_bits': num_bits}
+    return process_frames(filename, out_filename, 'encode', params, workers)
+
+def count_frames(filename):
+    with _palette_frames():
+        return getattr(_open_frames(filename), 'n_frames', 1)
+
+def decode_frame(filename, num_bits, index=0):
+    """
+    Decode the message hidden in one frame, seeking straight to it; the
+    other frames are not decoded (apart from any earlier GIF frames the
+    format itself needs to composite this one).
+    """
+    import steganography as steg
+    with _palette_frames():
+        source = _open_frames(filename)
+        source.seek(index)
+        mode, size, data, palette = _frame_state(source)
+    work_mode = _work_mode(mode)
+    image = sim.to_rectangle(_frame_image(mode, size, data), True)
+    return steg.decode_ext(image, num_bits, depth=sim.get_depth(work_mode))
@@ -0,0 +1,204 @@
+"""
+################################################################################
+Pipelines
+
+Notes:
+
+Chaining operations with the PIL wrappers (scramblePILimage, then
+encodePILimage, ...) converts the whole image to lists of tuples and back
+at every step. A Pipeline runs a sequence of stages on one pixel buffer
+(a numpy array, see engine.py) instead:
+
+    result = Pipeline([Scramble(), EncodeExt('hi', 2)]).run(PILimage)
+    result.image        # PIL image, converted once at the end
+    Pipeline([DecodeExt(2), Unscramble()]).run(result.image).messages
+
+- the image is converted to an array once at the start and back once at
+  the end
+- stages that map intensity values one by one (int_mix, unmix_int,
+  Lookup) are applied in place, and adjacent ones are fused into a single
+  table lookup; Scramble and Unscramble are split into their row/column
+  shuffle and their int_mix/unmix_int step so these can fuse across stages
+- DecodeExt straight after EncodeExt with the same num_bits does not read
+  the image back: the message it would find is known from the encode
+
+Results are the same as running the pure Python functions one after the
+other (Scramble uses the random module in the same way as
+image_scrambler.scramble).
+################################################################################
+"""
+from collections import namedtuple
+import numpy as np
+import engine
+import metrics
+import SimpleImage as sim
+
+PipelineResult = namedtuple('PipelineResult', ['image', 'messages'])
+
+"""
+Stages
+"""
+
+# Each stage expands into steps; a step is one of
+#   ('table', table)             per-value lookup, applied in place
+#   ('func', func)               array -> array (or None if done in place)
+#   ('encode', message, num_bits)
+#   ('decode', num_bits)
+
+class Scramble(object):
+    def steps(self, depth):
+        return [('func', engine.mix),
+                ('table', engine.int_mix_table(depth))]
+
+class Unscramble(object):
+    def steps(self, depth):
+        return [('table', engine.unmix_int_table(depth)),
+                ('func', engine.unmix)]
+
+class EncodeExt(object):
+    def __init__(self, message, num_bits):
+        self.message = message
+        self.num_bits = num_bits
+
+    def steps(self, depth):
+        return [('encode', self.message, self.num_bits)]
+
+class DecodeExt(object):
+    """
+    Decodes the message at this point of the pipeline; the messages are
+    returned in PipelineResult.messages, in stage order.
+    """
+    def __init__(self, num_bits):
+        self.num_bits = num_bits
+
+    def steps(self, depth):
+        return [('decode', self.num_bits)]
+
+class Lookup(object):
+    """
+    Maps every intensity value through table (a sequence indexed by value,
+    covering every value of the image's bit depth).
+    """
+    def __init__(self, table):
+        self.table = table
+
+    def steps(self, depth):
+        dtype = np.uint16 if depth > 8 else np.uint8
+        table = np.asarray(self.table, dtype=dtype)
+        if len(table) != 1 << depth:
+            raise ValueError('Lookup table must have {} entries'.format(
+                1 << depth))
+        return [('table', table)]
+
+class Custom(object):
+    """
+    Any other operation: func takes the (height, width, channels) array and
+    returns the new array, or modifies it in place and returns None.
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def steps(self, depth):
+        return [('func', self.func)]
+
+"""
+Planning
+"""
+
+def _is_identity(table):
+    return bool(np.array_equal(table, np.arange(len(table))))
+
+def fuse(steps):
+    """
+    Fuse adjacent table steps into one table (dropping it if it maps every
+    value to itself) and mark decodes that directly follow an encode with
+    the same num_bits.
+    """
+    fused = []
+    for step in steps:
+        previous = fused[-1] if fused else None
+        if step[0] == 'table' and previous is not None and \
+                previous[0] == 'table':
+            # first previous, then step
+            fused[-1] = ('table', step[1][previous[1]])
+        elif step[0] == 'decode' and previous is not None and \
+                previous[0] == 'encode' and previous[2] == step[1]:
+            fused.append(('decoded', previous[1], step[1]))
+        else:
+            fused.append(step)
+    return [step for step in fused
+            if not (step[0] == 'table' and _is_identity(step[1]))]
+
+def _encoded_message(message, num_bits, size):
+    # what decode_ext returns straight after encode_ext: the message cut to
+    # the capacity, up to the first zero byte
+    usable = size * num_bits // 8
+    return engine.bytes_to_message(engine.message_bytes(message)[:usable])
+
+"""
+Pipeline
+"""
+
+class Pipeline(object):
+    def __init__(self, stages=()):
+        self.stages = list(stages)
+
+    def then(self, stage):
+        """
+        Pipeline with stage added at the end (the pipeline itself is not
+        changed).
+        """
+        return Pipeline(self.stages + [stage])
+
+    def plan(self, depth=8):
+        steps = []
+        for stage in self.stages:
+            steps += stage.steps(depth)
+        return fuse(steps)
+
+    def run(self, image, native=False, mode=None):
+        """
+        Run the stages on image, which is a PIL image or a (height, width,
+        channels) array. With native=True, PIL images in one of
+        SimpleImage.NATIVE_MODES are processed in their own mode. Arrays
+        are not modified; mode is their PIL mode if not RGB.
+
+        Result:
+            PipelineResult: the output image (of the same kind as the
+            input) and the list of decoded messages.
+        """
+        span = metrics.start('pipeline')
+        from_pil = not isinstance(image, np.ndarray)
+        if from_pil:
+            array, mode = engine.from_pil(image, native)
+        else:
+            # the only copy of the input; every step after this may work
+            # in place
+            array = image.copy()
+            mode = mode or 'RGB'
+        depth = sim.get_depth(mode)
+        span.lap('convert')
+        messages = []
+        for step in self.plan(depth):
+            kind = step[0]
+            if kind == 'table':
+                engine.apply_table(array, step[1], out=array)
+            elif kind == 'func':
+                result = step[1](array)
+                if result is not None:
+                    array = result
+            elif kind == 'encode':
+                engine.encode_ext(array, step[1], step[2], depth, out=array)
+            elif kind == 'decode':
+                messages.append(engine.decode_ext(array, step[1], depth))
+            else:
+                messages.append(_encoded_message(step[1], step[2],
+                                                 array.size))
+            # one stage per kind of fused step, e.g. 'table', 'encode'
+            span.lap(kind)
+        pixels, size = metrics.array_stats(array)
+        if from_pil:
+            array = engine.to_pil(array, mode)
+            span.lap('convert')
+        span.done(pixels, buffer_bytes=size)
+        return PipelineResult(array, messages)
@@ -0,0 +1,121 @@
+"""
+################################################################################
+Capacity planner
+
+Notes:
+
+encode_ext needs num_bits up front: too low and the end of the message is
+silently cut off, too high and more bits of the cover are changed than
+needed. The planner works out the smallest num_bits that fits a payload
+from the image dimensions alone (SimpleImage.read_size reads only the
+header), and which pixels the payload will occupy, so a batch job can
+reject or re-route an oversized payload before decoding any pixels.
+
+Bits are laid out as in encode_ext: num_bits per intensity value, in
+row-major order from the top-left pixel. The payload occupies the pixels
+from (0, 0) up to last_pixel; encode_ext also clears the low num_bits bits
+of every value after that (its stop code), so only pixels whose low bits
+are already 0 stay untouched there.
+
+Payload sizes:
+- text messages (encode_ext): one byte per character
+- files (embed_file): the payload header and chunk table are added; pass
+  compress=True to plan_file to plan for a zlib-compressed payload (the
+  caller then embeds zlib.compress(data) and decompresses after decoding)
+
+    plan = planner.plan_image('cover.png', len(message))
+    if plan is None: reject ...
+    steganography.encode_ext(image, message, plan.num_bits)
+    # or simply encode_ext(image, message, 'auto')
+################################################################################
+"""
+from collections import namedtuple
+import SimpleImage as sim
+
+# num_bits: smallest that fits; payload_bits: bits written; capacity_bits:
+# capacity at that num_bits; values: intensity values holding payload
+# bits; last_pixel: (row, col) of the last pixel holding payload bits, or
+# None for an empty payload; rows: number of rows holding payload bits
+Plan = namedtuple('Plan', ['num_bits', 'payload_bytes', 'payload_bits',
+                           'capacity_bits', 'values', 'last_pixel', 'rows'])
+
+def plan_bits(width, height, payload_bits, mode='RGB', max_num_bits=None):
+    """
+    Smallest num_bits that fits payload_bits bits in a width x height
+    image of the given mode.
+
+    Result:
+        A Plan, or None if the payload does not fit even using every bit
+        (or max_num_bits bits) of each intensity value.
+    """
+    channels = sim.get_channels(mode)
+    depth = sim.get_depth(mode)
+    values_available = width * height * channels
+    for num_bits in range(1, (max_num_bits or depth) + 1):
+        capacity = values_available * num_bits
+        if payload_bits <= capacity:
+            values = -(-payload_bits // num_bits)
+            last_pixel = None
+            rows = 0
+            if values:
+                pixel = (values - 1) // channels
+                last_pixel = divmod(pixel, width)
+                rows = last_pixel[0] + 1
+            return Plan(num_bits, -(-payload_bits // 8), payload_bits,
+                        capacity, values, last_pixel, rows)
+    return None
+
+def plan_message(width, height, length, mode='RGB', max_num_bits=None):
+    """
+    Plan for an encode_ext message of length characters.
+    """
+    return plan_bits(width, height, length * 8, mode, max_num_bits)
+
+def compressed_size(data, level=9):
+    import zlib
+    return len(zlib.compress(data, level))
+
+def plan_file(width, height, payload, mode='RGB', flags=0, index_chunk=None,
+              compress=False, max_num_bits=None):
+    """
+    Plan for embed_file. payload is the payload size in bytes, or the
+    payload itself (bytes) when compress is set.
+    """
+    import steganography as steg
+    if compress:
+        length = compressed_size(payload)
+    elif isinstance(payload, (bytes, bytearray)):
+        length = len(payload)
+    else:
+        length = payload
+    if index_chunk:
+        flags |= steg.FLAG_INDEX
+        length += -(-length // index_chunk) * steg.ENTRY_SIZE
+    total = steg.header_size(flags) + length
+    return plan_bits(width, height, total * 8, mode,
+                     min(max_num_bits or 8, 8))
+
+def plan_image(image_name, length, native=False, max_num_bits=None):
+    """
+    plan_message for an image file, reading only its header.
+    """
+    PILimage = sim.open_image(image_name)
+    try:
+        width, height = PILimage.size
+        mode = sim.native_mode(PILimage.mode) if native else 'RGB'
+    finally:
+        PILimage.close()
+    return plan_message(width, height, length, mode, max_num_bits)
+
+def choose_num_bits(image, message, depth=8):
+    """
+    Smallest num_bits that fits message in image (rectangular format), or
+    None if it does not fit at all. Used by encode_ext(..., 'auto').
+    """
+    width = sim.get_width(image)
+    height = sim.get_height(image)
+    channels = len(image[0][0]) if width else 3
+    for num_bits in range(1, depth + 1):
+        if len(message) <= width * height * channels * num_bits // 8:
+            return num_bits
+    return None
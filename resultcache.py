@@ -0,0 +1,151 @@
+"""
+################################################################################
+Result cache
+
+Notes:
+
+Services that see the same image more than once (retries, duplicate
+uploads, fan-out) would otherwise rerun decode/unscramble in full every
+time. A ResultCache remembers results keyed by a hash of the pixel buffer
+plus the operation and its parameters (num_bits, mode, ...).
+
+There are two tiers:
+- memory: an LRU dict, evicting the least recently used results once the
+  total size of the cached results goes over max_bytes
+- disk (optional): one pickle file per result in a directory, so results
+  survive restarts and can be shared between processes. Disk hits are
+  copied back into the memory tier.
+
+Usage:
+    cache = ResultCache(max_bytes=64 << 20, directory='cache')
+    steganography.decode_direct('in.png', 2, cache=cache)
+    image_scrambler.unscramblePILimage(PILimage, cache=cache)
+################################################################################
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+def image_key(PILimage, operation, **params):
+    """
+    Cache key for running operation with params on a PIL image: a hex
+    digest of the image mode, size and pixel buffer, the operation name and
+    the parameters. blake2b is used as it is fast and has no practical
+    collisions.
+
+    For palette images the buffer only holds palette indices, so the
+    palette and the transparency setting are hashed too: the colours
+    (and so the decoded result) depend on them.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((operation, PILimage.mode, PILimage.size,
+                        sorted(params.items()),
+                        PILimage.info.get('transparency'))).encode('utf-8'))
+    palette = PILimage.getpalette() if PILimage.palette is not None else None
+    if palette is not None:
+        digest.update(b'palette')
+        digest.update(bytes(bytearray(palette)))
+    digest.update(b'pixels')
+    digest.update(PILimage.tobytes())
+    return digest.hexdigest()
+
+def data_key(data, operation, **params):
+    """
+    Like image_key, but hashes an encoded file (e.g. an uploaded PNG)
+    instead of its pixels, so no image decoding is needed at all. The
+    same picture saved twice with different settings gets two keys.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((operation, sorted(params.items()))).encode('utf-8'))
+    digest.update(data)
+    return digest.hexdigest()
+
+def result_size(value):
+    """
+    Approximate size in bytes of a cached result, used for eviction.
+    Strings and bytes count their length; tuples (e.g. (mode, size, data)
+    for images) count their parts.
+    """
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum([result_size(part) for part in value])
+    return 64
+
+class ResultCache(object):
+    def __init__(self, max_bytes=64 << 20, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def _remember(self, key, value):
+        # add to the memory tier, evicting least recently used entries;
+        # results bigger than the whole tier are only kept on disk
+        size = result_size(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.total_bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            old_value, old_size = self._entries.popitem(last=False)[1]
+            self.total_bytes -= old_size
+
+    def get(self, key, default=None):
+        """
+        Return the cached result for key, or default if there is none.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+        if self.directory is not None:
+            try:
+                with open(self._path(key), 'rb') as infile:
+                    value = pickle.load(infile)
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                pass
+            else:
+                with self._lock:
+                    self._remember(key, value)
+                    self.hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """
+        Store a result in the memory tier and, if enabled, on disk.
+        """
+        with self._lock:
+            self._remember(key, value)
+        if self.directory is not None:
+            # write to a temporary file first so readers never see
+            # half-written results
+            handle, tmp_name = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(handle, 'wb') as outfile:
+                pickle.dump(value, outfile, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_name, self._path(key))
+
+    def clear(self):
+        """
+        Empty the memory tier (the disk tier is left alone).
+        """
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
@@ -0,0 +1,216 @@
+"""
+################################################################################
+Payload scanner
+
+Notes:
+
+Triage for large sets of images: decides whether an image probably carries
+a payload written by this tool, without decoding the whole image. Only the
+top rows holding the first sample_bytes bytes are decoded (for PNG and
+uncompressed files the rest of the file is not even decompressed, see
+SimpleImage.read_rows), and for each num_bits the leading bytes of the
+hidden bitstream are checked for:
+
+- a file payload header (b'STEG' ..., see steganography.embed_file)
+- a text message as written by encode_ext: printable characters, then a
+  zero byte (the stop code) followed only by zero bits, since encode_ext
+  clears the low bits of every value after the message
+
+Untouched photos have noisy low bits, so neither pattern turns up by
+chance. Hits should still be confirmed with a full decode.
+
+Run:
+    python scanner.py photos/ uploads/ --workers 8
+################################################################################
+"""
+import argparse
+import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+IMAGE_EXTENSIONS = ('.png', '.bmp', '.gif', '.tif', '.tiff', '.ppm', '.webp')
+SAMPLE_BYTES = 4096
+MIN_MESSAGE = 4
+THRESHOLD = 0.9
+
+# kind is 'file', 'text' or None; score is between 0 and 1
+ScanResult = namedtuple('ScanResult', ['filename', 'kind', 'num_bits',
+                                       'score', 'error'])
+
+"""
+Scoring
+"""
+
+def _printable(data):
+    if not data:
+        return 0.0
+    count = 0
+    for byte in bytearray(data):
+        if 32 <= byte < 127 or byte in (9, 10, 13):
+            count += 1
+    return count / len(data)
+
+def score_stream(data, min_message=MIN_MESSAGE):
+    """
+    Score the leading bytes of a hidden bitstream.
+
+    Result:
+        (kind, score): ('file', 1.0) for a valid payload header,
+        ('text', score) for something that looks like an encode_ext
+        message, otherwise (None, score).
+    """
+    import steganography as steg
+    try:
+        steg.unpack_header(data)
+        return 'file', 1.0
+    except ValueError:
+        pass
+    end = data.find(b'\x00')
+    if end < 0:
+        # message runs past the sample
+        return ('text', 0.95) if _printable(data) >= 0.99 and \
+            len(data) >= min_message else (None, 0.0)
+    message, tail = data[:end], data[end + 1:]
+    if len(message) < min_message:
+        return None, 0.0
+    score = _printable(message)
+    if tail:
+        score *= tail.count(b'\x00') / len(tail)
+    return ('text' if score >= THRESHOLD else None), score
+
+def value_streams(values, num_bits_list=range(1, 9),
+                  sample_bytes=SAMPLE_BYTES):
+    """
+    Yield (num_bits, leading bytes of the hidden bitstream) for a flat
+    uint8 array of intensity values, as encode_ext lays the bits out.
+    The low 8 bit planes of the leading values are extracted once and
+    every num_bits candidate is read from them.
+    """
+    import numpy as np
+    import bits
+    # planes[i, b] is bit b of value i
+    planes = bits.get_planes(values[:sample_bytes * 8], 8)
+    for num_bits in num_bits_list:
+        count = -(-sample_bytes * 8 // num_bits)
+        stream = planes[:count, :num_bits].reshape(-1)
+        stream = stream[:min(len(stream), sample_bytes * 8) // 8 * 8]
+        yield num_bits, np.packbits(stream).tobytes()
+
+def sample_streams(PILimage, num_bits_list=range(1, 9),
+                   sample_bytes=SAMPLE_BYTES):
+    """
+    value_streams for an image (converted to RGB).
+    """
+    import numpy as np
+    if PILimage.mode != 'RGB':
+        PILimage = PILimage.convert('RGB')
+    values = np.frombuffer(PILimage.tobytes(), dtype=np.uint8)
+    return value_streams(values, num_bits_list, sample_bytes)
+
+def best_candidate(streams, min_message=MIN_MESSAGE):
+    """
+    (kind, num_bits, score) of the best scoring (num_bits, data) pair.
+
+    Ties are common for short messages: reading a message written with
+    num_bits=4 using 2 bits per value gives half its bits, then the
+    cleared bits, which can look like a shorter message. The candidate
+    with the longest message wins, then the one with the most bits (a
+    num_bits that is too big reads the untouched cover bits above the
+    message, which score low).
+    """
+    best = (None, None, 0.0)
+    best_rank = None
+    for num_bits, data in streams:
+        kind, score = score_stream(data, min_message)
+        end = data.find(b'\x00')
+        rank = (score, len(data) if end < 0 else end, num_bits)
+        if score > 0 and (best_rank is None or rank > best_rank):
+            best = (kind, num_bits, score)
+            best_rank = rank
+    return best
+
+def sample_rows(width, sample_bytes=SAMPLE_BYTES):
+    # rows needed for sample_bytes bytes at num_bits=1
+    if width == 0:
+        return 0
+    return -(-sample_bytes * 8 // (width * 3))
+
+def scan_file(filename, num_bits_list=range(1, 9),
+              sample_bytes=SAMPLE_BYTES):
+    """
+    Scan one image. Result:
+        ScanResult for the num_bits with the highest score; errors
+        reading the image are reported in error rather than raised.
+    """
+    import SimpleImage as sim
+    try:
+        width, height = sim.read_size(filename)
+        PILimage = sim.read_rows(filename, sample_rows(width, sample_bytes))
+        kind, num_bits, score = best_candidate(sample_streams(
+            PILimage, num_bits_list, sample_bytes))
+        return ScanResult(filename, kind, num_bits, score, None)
+    except Exception as error:
+        return ScanResult(filename, None, None, 0.0, str(error))
+
+"""
+Batch scanning
+"""
+
+def iter_images(paths):
+    """
+    Yield image filenames from files and (recursively) directories.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def _scan_one(args):
+    filename, num_bits_list, sample_bytes = args
+    return scan_file(filename, num_bits_list, sample_bytes)
+
+def scan(paths, num_bits_list=range(1, 9), sample_bytes=SAMPLE_BYTES,
+         workers=None):
+    """
+    Scan every image under paths over a process pool, yielding a
+    ScanResult per image (in order).
+    """
+    num_bits_list = list(num_bits_list)
+    jobs = ((filename, num_bits_list, sample_bytes)
+            for filename in iter_images(paths))
+    with ProcessPoolExecutor(workers or os.cpu_count() or 1) as pool:
+        for result in pool.map(_scan_one, jobs, chunksize=16):
+            yield result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Find images that probably carry a hidden payload')
+    parser.add_argument('paths', nargs='+', help='image files or directories')
+    parser.add_argument('-n', '--num-bits', type=int, action='append',
+                        help='num_bits to check (repeatable; default 1-8)')
+    parser.add_argument('--sample-bytes', type=int, default=SAMPLE_BYTES)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--all', action='store_true',
+                        help='report every image, not just candidates')
+    args = parser.parse_args(argv)
+    found = 0
+    for result in scan(args.paths, args.num_bits or range(1, 9),
+                       args.sample_bytes, args.workers):
+        if result.error is not None:
+            sys.stderr.write('{}: {}\n'.format(result.filename, result.error))
+        elif result.kind is not None or args.all:
+            print('{}\t{}\t{}\t{:.3f}'.format(result.filename,
+                                              result.kind or '-',
+                                              result.num_bits or '-',
+                                              result.score))
+        found += result.kind is not None
+    return 0 if found else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,486 @@
+"""
+################################################################################
+Image service
+
+Notes:
+
+A small asyncio HTTP service exposing the image operations, meant to run
+on localhost behind whatever needs them:
+
+    POST /encode?num_bits=2&message=...    body: image   -> PNG
+    POST /decode?num_bits=2                body: image   -> text (UTF-8)
+    POST /scramble                         body: image   -> PNG
+    POST /unscramble                       body: image   -> PNG
+    GET  /health                                         -> JSON stats
+
+Uploads may be sent with Content-Length or chunked transfer encoding, and
+are read a chunk at a time. The pixel work runs in a process pool, so one
+slow request never blocks the event loop.
+
+Backpressure: jobs go through a bounded queue; when it is full the service
+answers 503 with a Retry-After header instead of piling up work.
+
+Errors: a job that fails (not an image, an image that was never
+scrambled, ...) gets 422 and a worker pool failure 500; the connection
+stays open for both. If a worker process dies (e.g. killed for running out
+of memory) the pool is broken for good, so it is replaced by a new one;
+only the jobs that were running get 500. Malformed requests get 4xx, and
+the connection is closed when the request body could not be read.
+
+Batching: small jobs waiting in the queue are sent to a worker together,
+so for lots of tiny images the cost of a round trip to the pool is shared.
+
+Decode and unscramble results are cached by a hash of the uploaded file
+(see resultcache.py), so repeated uploads of the same image are answered
+without touching the pool.
+
+Run:
+    python service.py serve --port 8765
+Load test (against a running server):
+    python service.py loadtest --port 8765 --image cover.png --op scramble
+################################################################################
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlsplit, parse_qs, urlencode
+import resultcache
+
+OPERATIONS = ('encode', 'decode', 'scramble', 'unscramble')
+CACHED_OPERATIONS = ('decode', 'unscramble')
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+               405: 'Method Not Allowed', 411: 'Length Required',
+               413: 'Payload Too Large', 422: 'Unprocessable Entity',
+               500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+"""
+Worker side: these run in the process pool
+"""
+
+def _run_job(op, params, data):
+    # imported here so the event loop process stays light
+    from PIL import Image
+    import SimpleImage as sim
+    import steganography as steg
+    import image_scrambler as isc
+
+    PILimage = Image.open(io.BytesIO(data))
+    if op == 'decode':
+        image = sim.to_rectangle(PILimage)
+        message = steg.decode_ext(image, params['num_bits'])
+        if message is None:
+            raise ValueError('num_bits must be between 1 and 8')
+        return message.encode('utf-8'), 'text/plain; charset=utf-8'
+    if op == 'encode':
+        image = sim.to_rectangle(PILimage)
+        output = steg.encode_ext(image, params['message'], params['num_bits'])
+        if output is None:
+            raise ValueError('num_bits must be between 1 and 8')
+        output = sim.to_flat(output)
+    elif op == 'scramble':
+        output = isc.scramblePILimage(PILimage)
+    else:
+        output = isc.unscramblePILimage(PILimage)
+    out = io.BytesIO()
+    output.save(out, 'PNG')
+    return out.getvalue(), 'image/png'
+
+def _run_batch(jobs):
+    """
+    Run a list of (op, params, data) jobs, returning a list of
+    ('ok', body, content_type) or ('error', message) in the same order.
+    """
+    results = []
+    for op, params, data in jobs:
+        try:
+            body, content_type = _run_job(op, params, data)
+            results.append(('ok', body, content_type))
+        except Exception as e:
+            results.append(('error', '{}: {}'.format(type(e).__name__, e)))
+    return results
+
+"""
+Server side
+"""
+
+class HTTPError(Exception):
+    # close: the request body may not have been read (in full), so the
+    # connection cannot be reused
+    def __init__(self, status, message='', close=False):
+        Exception.__init__(self, message)
+        self.status = status
+        self.close = close
+
+class ImageService(object):
+    def __init__(self, workers=None, queue_size=64, batch_size=8,
+                 batch_bytes=64 << 10, batch_wait=0.005,
+                 max_body=64 << 20, cache=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch_wait = batch_wait
+        self.max_body = max_body
+        if cache is None:
+            cache = resultcache.ResultCache()
+        self.cache = cache
+        self.stats = {'requests': 0, 'rejected': 0, 'batches': 0,
+                      'jobs': 0, 'cache_hits': 0, 'pool_restarts': 0}
+        self.pool = None
+        self.queue = None
+
+    # Job queue and dispatcher
+
+    def _is_small(self, job):
+        return len(job[2]) <= self.batch_bytes
+
+    async def _dispatch(self):
+        # Take jobs off the queue and hand them to the pool; at most one
+        # batch per worker is in flight, so when the pool is busy the
+        # queue fills up and new requests are turned away
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.workers)
+        while True:
+            batch = [await self.queue.get()]
+            if self._is_small(batch[0]):
+                deadline = loop.time() + self.batch_wait
+                while len(batch) < self.batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        job = await asyncio.wait_for(self.queue.get(),
+                                                     timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if not self._is_small(job):
+                        # big jobs go on their own
+                        await slots.acquire()
+                        asyncio.ensure_future(self._run([job], slots))
+                        continue
+                    batch.append(job)
+            await slots.acquire()
+            asyncio.ensure_future(self._run(batch, slots))
+
+    async def _run(self, batch, slots):
+        loop = asyncio.get_running_loop()
+        self.stats['batches'] += 1
+        self.stats['jobs'] += len(batch)
+        pool = self.pool
+        try:
+            results = await loop.run_in_executor(
+                pool, _run_batch, [job[:3] for job in batch])
+        except BrokenProcessPool as e:
+            self._replace_pool(pool)
+            results = [('failed', 'worker failed: {}'.format(e))] * \
+                len(batch)
+        except Exception as e:
+            # the pool itself failed (e.g. a worker died): not the
+            # client's fault
+            results = [('failed', 'worker failed: {}'.format(e))] * \
+                len(batch)
+        finally:
+            slots.release()
+        for job, result in zip(batch, results):
+            if not job[3].done():
+                job[3].set_result(result)
+
+    def _replace_pool(self, broken):
+        # several batches can fail with the same broken pool; only the
+        # first one replaces it
+        if self.pool is not broken:
+            return
+        self.stats['pool_restarts'] += 1
+        self.pool = ProcessPoolExecutor(self.workers)
+        broken.shutdown(wait=False)
+
+    async def submit(self, op, params, data):
+        """
+        Queue a job and wait for its result; raises HTTPError(503) if the
+        queue is full.
+        """
+        cache_key = None
+        if op in CACHED_OPERATIONS:
+            cache_key = resultcache.data_key(data, op, **params)
+            result = self.cache.get(cache_key)
+            if result is not None:
+                self.stats['cache_hits'] += 1
+                return result
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((op, params, data, future))
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            raise HTTPError(503, 'server busy, retry later')
+        result = await future
+        if result[0] == 'failed':
+            raise HTTPError(500, result[1])
+        if result[0] == 'error':
+            # the job itself failed: bad image, num_bits out of range, an
+            # image that was never scrambled, ...
+            raise HTTPError(422, result[1])
+        if cache_key is not None:
+            self.cache.put(cache_key, result)
+        return result
+
+    # HTTP
+
+    async def _read_body(self, reader, headers):
+        # Read the upload a chunk at a time, enforcing max_body
+        body = bytearray()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                try:
+                    # readline raises ValueError for an overlong line
+                    size_line = await reader.readline()
+                    size = int(size_line.split(b';')[0].strip(), 16)
+                except ValueError:
+                    size = -1
+                if size < 0:
+                    raise HTTPError(400, 'bad chunk size', close=True)
+                if size == 0:
+                    # skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n',
+                                                            b''):
+                        pass
+                    return bytes(body)
+                if len(body) + size > self.max_body:
+                    raise HTTPError(413, 'upload too large', close=True)
+                body += await reader.readexactly(size)
+                await reader.readline()
+        if 'content-length' not in headers:
+            raise HTTPError(411, 'Content-Length or chunked body required',
+                            close=True)
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HTTPError(400, 'bad Content-Length', close=True)
+        if length > self.max_body:
+            raise HTTPError(413, 'upload too large', close=True)
+        while len(body) < length:
+            chunk = await reader.read(min(65536, length - len(body)))
+            if not chunk:
+                raise HTTPError(400, 'connection closed mid-upload',
+                                close=True)
+            body += chunk
+        return bytes(body)
+
+    async def _handle_request(self, method, target, headers, reader):
+        url = urlsplit(target)
+        path = url.path.strip('/')
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        if path == 'health' and method == 'GET':
+            stats = dict(self.stats, queued=self.queue.qsize(),
+                         workers=self.workers)
+            return (200, json.dumps(stats).encode('utf-8'),
+                    'application/json')
+        # any body is left unread, so these close the connection
+        if path not in OPERATIONS:
+            raise HTTPError(404, 'unknown endpoint', close=True)
+        if method != 'POST':
+            raise HTTPError(405, 'use POST', close=True)
+        data = await self._read_body(reader, headers)
+        params = {}
+        if path in ('encode', 'decode'):
+            try:
+                params['num_bits'] = int(query.get('num_bits', '1'))
+            except ValueError:
+                raise HTTPError(400, 'num_bits must be an integer')
+        if path == 'encode':
+            params['message'] = query.get('message', '')
+        result, body, content_type = await self.submit(path, params, data)
+        return 200, body, content_type
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = \
+                        request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                self.stats['requests'] += 1
+                extra = {}
+                close = False
+                try:
+                    status, body, content_type = await self._handle_request(
+                        method, target, headers, reader)
+                except HTTPError as e:
+                    status, body = e.status, str(e).encode('utf-8')
+                    content_type = 'text/plain; charset=utf-8'
+                    close = e.close
+                    if status == 503:
+                        extra['Retry-After'] = '1'
+                keep_alive = (version == 'HTTP/1.1' and
+                              headers.get('connection', '').lower() != 'close'
+                              and not close)
+                lines = ['HTTP/1.1 {} {}'.format(status, STATUS_TEXT[status]),
+                         'Content-Type: ' + content_type,
+                         'Content-Length: {}'.format(len(body)),
+                         'Connection: ' + ('keep-alive' if keep_alive
+                                           else 'close')]
+                lines += ['{}: {}'.format(k, v) for k, v in extra.items()]
+                writer.write(('\r\n'.join(lines) + '\r\n\r\n')
+                             .encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        self.queue = asyncio.Queue(self.queue_size)
+        self.pool = ProcessPoolExecutor(self.workers)
+        dispatcher = asyncio.ensure_future(self._dispatch())
+        server = await asyncio.start_server(self.handle, host, port)
+        print('Serving on http://{}:{}/ with {} workers'.format(
+            host, port, self.workers))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            dispatcher.cancel()
+            self.pool.shutdown()
+
+"""
+Load testing
+"""
+
+async def _client(host, port, op, query, data, count, latencies, errors):
+    target = '/{}?{}'.format(op, urlencode(query))
+    request = ('POST {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'
+               .format(target, host, len(data)).encode('latin-1') + data)
+    reader = writer = None
+    try:
+        for i in range(count):
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                # the server closed the connection without answering
+                errors['closed'] = errors.get('closed', 0) + 1
+                writer.close()
+                writer = None
+                continue
+            status = int(status_line.split()[1])
+            length = 0
+            close = False
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+                elif name.lower() == 'connection':
+                    close = value.strip().lower() == 'close'
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors[status] = errors.get(status, 0) + 1
+            if close:
+                # reconnect for the next request
+                writer.close()
+                writer = None
+    finally:
+        if writer is not None:
+            writer.close()
+
+async def load_test(host, port, image_name, op='scramble', requests=200,
+                    concurrency=16, num_bits=2, message='hello'):
+    """
+    Send requests POSTs of image_name to a running service over
+    concurrency keep-alive connections; prints throughput, latency
+    percentiles and error counts, and returns the latencies.
+    """
+    with open(image_name, 'rb') as infile:
+        data = infile.read()
+    query = {}
+    if op in ('encode', 'decode'):
+        query['num_bits'] = num_bits
+    if op == 'encode':
+        query['message'] = message
+    latencies = []
+    errors = {}
+    per_client = [requests // concurrency] * concurrency
+    for i in range(requests % concurrency):
+        per_client[i] += 1
+    start = time.perf_counter()
+    await asyncio.gather(*[_client(host, port, op, query, data, n,
+                                   latencies, errors)
+                           for n in per_client if n])
+    elapsed = time.perf_counter() - start
+    if not latencies:
+        print('no responses; errors: {}'.format(errors))
+        return latencies
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+    print('{} requests in {:.2f}s: {:.1f} req/s'.format(
+        len(latencies), elapsed, len(latencies) / elapsed))
+    print('latency p50 {:.1f}ms  p90 {:.1f}ms  p99 {:.1f}ms'.format(
+        percentile(0.5) * 1000, percentile(0.9) * 1000,
+        percentile(0.99) * 1000))
+    if errors:
+        print('errors by status: {}'.format(errors))
+    return latencies
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local image service')
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help='run the service')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--workers', type=int, default=None)
+    serve.add_argument('--queue', type=int, default=64)
+    serve.add_argument('--batch', type=int, default=8)
+    serve.add_argument('--cache-dir', default=None)
+    load = commands.add_parser('loadtest', help='load test a running service')
+    load.add_argument('--host', default='127.0.0.1')
+    load.add_argument('--port', type=int, default=8765)
+    load.add_argument('--image', required=True)
+    load.add_argument('--op', choices=OPERATIONS, default='scramble')
+    load.add_argument('--requests', type=int, default=200)
+    load.add_argument('--concurrency', type=int, default=16)
+    load.add_argument('--num-bits', type=int, default=2)
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        cache = resultcache.ResultCache(directory=args.cache_dir)
+        service = ImageService(workers=args.workers, queue_size=args.queue,
+                               batch_size=args.batch, cache=cache)
+        try:
+            asyncio.run(service.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'loadtest':
+        asyncio.run(load_test(args.host, args.port, args.image, args.op,
+                              args.requests, args.concurrency,
+                              args.num_bits))
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
@@ -79,8 +79,15 @@ Date modified and reason:
 4 October 2013: Added documentation
 ################################################################################
 """
+import io
+import struct
+import threading
+from collections import namedtuple, OrderedDict
 import bits
+import metrics
 import SimpleImage as sim
+# numpy and resultcache are imported where they are used, so that
+# importing this module stays cheap (see importbench.py)
 #from SimpleImage import read_image, write_image, to_flat, to_rectangle
 
 def encode(image,message):
@@ -151,20 +158,20 @@ def encode(image,message):
         # Empty list intialised for each new row-list
         new_row = []
         # Nested 'for' loop iterates over each pixel in the current row-list
-        # (r,g,b) matches r,g,b to the three intenstiy values in each pixel
-        # respectively, so r = first intensity value (red), and so on.
-        for (r,g,b) in row:
-            # Use codebit function to set the LSB of the
-            # new intensity values to match the bit being indexed 
-            new_r = bits.set_bit(r,bits.codebit(i,bitstream),0)
-            new_g = bits.set_bit(g,bits.codebit(i + 1,bitstream),0)
-            new_b = bits.set_bit(b,bits.codebit(i + 2,bitstream),0)
-            # Amalgamate the three new intensity values into a new pixel
-            new_pixel = (new_r,new_g,new_b)
-            # Append new pixel to new row-list
-            new_row.append(new_pixel)
-            # increment counter by 3, as each pixel has 3 intensity values
-            i += 3
+        for pixel in row:
+            # Iterate over the intensity values of the pixel (three for
+            # RGB, but greyscale/alpha images in native mode have 1-4)
+            new_pixel = []
+            for intensity in pixel:
+                # Use codebit function to set the LSB of the
+                # new intensity value to match the bit being indexed 
+                new_pixel.append(bits.set_bit(intensity,
+                                              bits.codebit(i,bitstream),0))
+                # increment counter by 1 for each intensity value
+                i += 1
+            # Amalgamate the new intensity values into a new pixel, and
+            # append it to new row-list
+            new_row.append(tuple(new_pixel))
         # attach new row-list to new image-list
         new_image.append(new_row)
     return new_image
@@ -211,7 +218,7 @@ def decode(image):
     message = bits.bits_to_message(bitstream)
     return message  
 
-def encode_ext(image, message, num_bits):
+def encode_ext(image, message, num_bits, key=None, depth=8):
     """
     Essentially the same as the encode function, but:
     - in the original encode function, only the LSB was used to encode
@@ -227,7 +234,18 @@ def encode_ext(image, message, num_bits):
         message: a string of ASCII characters
         num_bits: integer value between 1 and 8 inclusive,
                   which determines how many bits are used to encode
-                  the message, starting with the LSB.
+                  the message, starting with the LSB; or 'auto' for the
+                  smallest value that fits the whole message (the value
+                  chosen is planner.choose_num_bits(image, message,
+                  depth); decode_auto finds it again). 'auto' does not
+                  work with key, as decode_auto cannot read a scattered
+                  message.
+        key: optional; if given, the bits are scattered over the image
+             in a keyed pseudo-random order instead of row-major order
+             (see encode_scatter)
+        depth: bits per intensity value; 16 for 16-bit images read in
+               native mode (SimpleImage.NATIVE_MODES), which allows
+               num_bits up to 16
     
     Result:
         new_image: a new image in the same format as the original, with the 
@@ -249,12 +267,32 @@ def encode_ext(image, message, num_bits):
         [(0, 0, 0), (0, 0, 0)]]
     
     """
+    # num_bits='auto': the smallest num_bits that fits the whole message
+    # (see planner.py)
+    if num_bits == 'auto':
+        if key is not None:
+            print ("num_bits='auto' does not work with a key")
+            return None
+        import planner
+        num_bits = planner.choose_num_bits(image, message, depth)
+        if num_bits is None:
+            print ('Message does not fit in the image, even using all {}\
+ bits'.format(depth))
+            return None
     # Check num_bits is within accepted range
-    if not(0 < num_bits <= 8):
-        print ('Number of bits must be an integer between 1 and 8\
- inclusive')
+    if not(0 < num_bits <= depth):
+        print ('Number of bits must be an integer between 1 and {}\
+ inclusive'.format(depth))
         return None 
+    span = metrics.start('encode_ext')
+    if key is not None:
+        new_image = encode_scatter(image, message, num_bits, key, depth)
+        span.lap('scatter')
+        pixels, size = metrics.image_stats(image, depth)
+        span.done(pixels, len(message), size)
+        return new_image
     bitstream = bits.message_to_bits(message)
+    span.lap('bits')
     new_image = []
     i = 0
     for row in image:
@@ -278,23 +316,36 @@ def encode_ext(image, message, num_bits):
                 # append each intensity value to a list;
                 # tuples cannot be used as they are immutable
                 pre_pixel.append(new_i)
-            # convert full pixel into three-element tuple
-            new_pixel = (pre_pixel[0],pre_pixel[1],pre_pixel[2])
+            # convert full pixel into a tuple (three elements for RGB)
+            new_pixel = tuple(pre_pixel)
             new_row.append(new_pixel)
         new_image.append(new_row)
+    span.lap('embed')
+    # working buffers: the pixel data and the bitstream string
+    pixels, size = metrics.image_stats(image, depth)
+    span.done(pixels, len(message), size + len(bitstream))
     return new_image
 
-def decode_ext(image, num_bits):
+def decode_ext(image, num_bits, key=None, depth=8):
     """
     Very slight change from original decode function;
     addition of extra nested 'for' loop allows iteration over
     one intensity value to extract multiple code bits, as 
     determined by num_bits input
+    If key is given, the message is read back in the keyed scatter order
+    used by encode_ext (see decode_scatter). depth is as for encode_ext.
     """
-    if not(0 < num_bits <= 8):
-        print ('Number of bits must be an integer between 1 and 8\
- inclusive')
+    if not(0 < num_bits <= depth):
+        print ('Number of bits must be an integer between 1 and {}\
+ inclusive'.format(depth))
         return None 
+    span = metrics.start('decode_ext')
+    if key is not None:
+        message = decode_scatter(image, num_bits, key, depth=depth)
+        span.lap('scatter')
+        pixels, size = metrics.image_stats(image, depth)
+        span.done(pixels, len(message), size)
+        return message
     bitstream = ''
     for row in image:
         for pixel in row:
@@ -303,7 +354,11 @@ def decode_ext(image, num_bits):
                 # selected from each intensity value 
                 for pos in range(num_bits):
                     bitstream += bits.get_bit(intensity,pos)
+    span.lap('extract')
     message = bits.bits_to_message(bitstream)
+    span.lap('bits')
+    pixels, size = metrics.image_stats(image, depth)
+    span.done(pixels, len(message), size + len(bitstream))
     return message  
 
 
@@ -348,15 +403,43 @@ def ext_test(image,message,num_bits):
 Extra Stuff
 """
 
-def encode_direct(image_name,message,num_bits,coded_image_name):
-    image = sim.read_image(image_name)
-    encoded_image = encode_ext(image,message,num_bits)
-    sim.write_image(encoded_image, coded_image_name)
+# With native=True, images are processed in their own mode and bit depth
+# (greyscale, RGBA, 16-bit, see SimpleImage.NATIVE_MODES) instead of
+# being converted to RGB
+
+def encode_direct(image_name,message,num_bits,coded_image_name,key=None,
+                  native=False,profile=None):
+    # fail before doing any work if the output format is lossy
+    sim.check_lossless(sim.output_format(coded_image_name))
+    PILimage = sim.open_image(image_name)
+    mode = sim.native_mode(PILimage.mode) if native else 'RGB'
+    image = sim.to_rectangle(PILimage, native)
+    encoded_image = encode_ext(image,message,num_bits,key,sim.get_depth(mode))
+    if encoded_image is None:
+        return None
+    sim.write_image(encoded_image, coded_image_name, mode, profile, True)
     return None
 
-def decode_direct(image_name, num_bits):
-    image = sim.read_image(image_name)
-    message = decode_ext(image,num_bits)
+def decode_direct(image_name, num_bits, key=None, cache=None, native=False):
+    if cache is None:
+        PILimage = sim.open_image(image_name)
+        depth = sim.get_depth(sim.native_mode(PILimage.mode)) if native else 8
+        return decode_ext(sim.to_rectangle(PILimage, native),num_bits,key,
+                          depth)
+    # With a ResultCache (see resultcache.py), an image that has been
+    # decoded before with the same settings is only hashed, not decoded
+    import resultcache
+    PILimage = sim.open_image(image_name)
+    depth = sim.get_depth(sim.native_mode(PILimage.mode)) if native else 8
+    cache_key = resultcache.image_key(PILimage, 'decode_ext',
+                                      num_bits=num_bits, key=key,
+                                      native=native)
+    message = cache.get(cache_key)
+    if message is None:
+        message = decode_ext(sim.to_rectangle(PILimage, native),num_bits,key,
+                             depth)
+        if message is not None:
+            cache.put(cache_key, message)
     return message
 
 def decode_to_file(image_name, num_bits, filename):
@@ -368,55 +451,804 @@ def decode_to_file(image_name, num_bits, filename):
     return message 
 
 # function wrapper api for use in gui
-def encodePILimage(PILimage, message):
-    image = sim.to_rectangle(PILimage)
+def encodePILimage(PILimage, message, native=False):
+    image = sim.to_rectangle(PILimage, native)
     output = encode(image, message)
+    if native:
+        return sim.to_flat(output, sim.native_mode(PILimage.mode))
     return sim.to_flat(output)
 
-def decodePILimage(PILimage):
-    image = sim.to_rectangle(PILimage)
+def decodePILimage(PILimage, native=False):
+    image = sim.to_rectangle(PILimage, native)
     return decode(image)
 
+"""
+Binary file payloads
+
+encode_ext only handles ASCII text, and needs the whole message in memory
+as a string of '1's and '0's (8 times the size of the message). The
+functions below embed an arbitrary file instead, read from a file object
+a chunk at a time and written into successive intensity values, so only
+one chunk of the bitstream exists at any time.
+
+Bits are laid out exactly as in encode_ext (num_bits per intensity value,
+LSB first, in row-major order), but since binary data can contain zero
+bytes there is no stop code. Instead the payload starts with a small header:
+
+    magic   4 bytes   b'STEG'
+    flags   1 byte    FLAG_* bits below
+    length  8 bytes   payload length in bytes, big-endian
+
+followed by optional fields, present only when the matching flag is set,
+in this order:
+
+    FLAG_SHARD      shard index, 4 bytes big-endian (see multicover.py)
+                    FLAG_LAST_SHARD is also set on the final shard
+    FLAG_INDEX      chunk table: chunk size (4 bytes) and the bit offset
+                    of the table (8 bytes)
+
+The chunk table is written after the payload. Entry k (16 bytes) holds the
+payload offset of chunk k and the bit offset at which that chunk starts in
+the image, so decode_range can go straight to the pixels holding any byte
+range of the payload without decoding everything before it.
+"""
 
+PAYLOAD_MAGIC = b'STEG'
+HEADER_FORMAT = '>4sBQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+FLAG_SHARD = 0x01
+FLAG_LAST_SHARD = 0x02
+FLAG_INDEX = 0x04
+SHARD_FORMAT = '>I'
+SHARD_SIZE = struct.calcsize(SHARD_FORMAT)
+INDEX_FORMAT = '>IQ'
+INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+ENTRY_FORMAT = '>QQ'
+ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+
+# Parsed payload header; offset is the bit offset where the payload starts
+PayloadHeader = namedtuple('PayloadHeader', ['flags', 'length', 'shard_index',
+                                             'index_chunk', 'table_offset',
+                                             'offset'])
+
+def _check_num_bits(num_bits):
+    """
+    Same num_bits check as encode_ext/decode_ext, shared by the file
+    functions. Returns False (after printing a message) if out of range.
+    """
+    if not(0 < num_bits <= 8):
+        print ('Number of bits must be an integer between 1 and 8\
+ inclusive')
+        return False
+    return True
 
+def header_size(flags=0):
+    """
+    Size in bytes of a payload header with the given flags, including
+    the optional fields.
+    """
+    size = HEADER_SIZE
+    if flags & FLAG_SHARD:
+        size += SHARD_SIZE
+    if flags & FLAG_INDEX:
+        size += INDEX_SIZE
+    return size
+
+def pack_header(length, flags=0, shard_index=0, index_chunk=0,
+                table_offset=0):
+    """
+    Build the payload header for a payload of length bytes.
 
+    Examples:
+        >>> pack_header(5)
+        b'STEG\x00\x00\x00\x00\x00\x00\x00\x00\x05'
+    """
+    header = struct.pack(HEADER_FORMAT, PAYLOAD_MAGIC, flags, length)
+    if flags & FLAG_SHARD:
+        header += struct.pack(SHARD_FORMAT, shard_index)
+    if flags & FLAG_INDEX:
+        header += struct.pack(INDEX_FORMAT, index_chunk, table_offset)
+    return header
+
+def unpack_header(data):
+    """
+    Parse the fixed part of a payload header, returning (flags, length).
+    Raises ValueError if data does not start with a valid header, i.e. the
+    image does not carry a file payload (or num_bits is wrong).
+    """
+    if len(data) < HEADER_SIZE:
+        raise ValueError('Image too small to hold a payload header')
+    magic, flags, length = struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])
+    if magic != PAYLOAD_MAGIC:
+        raise ValueError('No embedded file found (bad header)')
+    return flags, length
+
+def _parse_header(read_bits, capacity):
+    """
+    Read a payload header using read_bits(offset, count), which returns
+    count bits starting at bit offset. capacity is the image capacity in
+    bits. Returns a PayloadHeader.
+    """
+    if capacity < HEADER_SIZE * 8:
+        raise ValueError('Image too small to hold a payload header')
+    flags, length = unpack_header(bits.bits_to_bytes(
+        read_bits(0, HEADER_SIZE * 8)))
+    size = header_size(flags)
+    if (size + length) * 8 > capacity:
+        raise ValueError('Payload length in header exceeds image capacity')
+    extra = bits.bits_to_bytes(read_bits(HEADER_SIZE * 8,
+                                         (size - HEADER_SIZE) * 8))
+    shard_index = None
+    index_chunk = table_offset = None
+    if flags & FLAG_SHARD:
+        shard_index = struct.unpack(SHARD_FORMAT, extra[:SHARD_SIZE])[0]
+        extra = extra[SHARD_SIZE:]
+    if flags & FLAG_INDEX:
+        index_chunk, table_offset = struct.unpack(INDEX_FORMAT, extra)
+        if index_chunk == 0:
+            raise ValueError('Invalid chunk table in header')
+    return PayloadHeader(flags, length, shard_index, index_chunk,
+                         table_offset, size * 8)
+
+def read_header(image, num_bits):
+    """
+    Read and check the payload header of an image (rectangular format).
 
+    Result:
+        A PayloadHeader; shard_index is None unless FLAG_SHARD is set,
+        index_chunk and table_offset are None unless FLAG_INDEX is set.
+    """
+    def read_bits(offset, count):
+        return _extract_bits(image, offset, count, num_bits)
+    return _parse_header(read_bits, capacity_bits(image, num_bits))
 
+def read_header_direct(image_name, num_bits):
+    """
+    read_header for an image file, decoding only the top rows that hold
+    the header (see SimpleImage.read_rows).
+    """
+    width, height = sim.read_size(image_name)
+    longest = header_size(FLAG_SHARD | FLAG_INDEX) * 8
+    rows = -(-longest // (num_bits * width * 3)) if width else 0
+    top = sim.to_rectangle(sim.read_rows(image_name, rows))
+    def read_bits(offset, count):
+        return _extract_bits(top, offset, count, num_bits)
+    return _parse_header(read_bits, width * height * 3 * num_bits)
+
+def capacity_bits(image, num_bits):
+    """
+    Number of bits that can be stored in image using num_bits bits
+    per intensity value.
+    """
+    num_pixels = sim.get_width(image) * sim.get_height(image)
+    if num_pixels == 0:
+        return 0
+    return num_pixels * len(image[0][0]) * num_bits
 
+def _bit_region(image, offset, count, num_bits):
+    """
+    The rows of image holding bits offset .. offset + count - 1, as an
+    array, for the bulk bit plane functions in bits.py.
 
+    Result:
+        (first_row, rows, values, skip): rows is a (rows, width, channels)
+        array, values a flat view of the intensity values holding the
+        bits, and skip the position of bit offset within the first of
+        them.
+    """
+    import numpy as np
+    line = sim.get_width(image) * len(image[0][0])
+    first, skip = divmod(offset, num_bits)
+    values = -(-(skip + count) // num_bits)
+    first_row = first // line
+    last_row = (first + values - 1) // line + 1
+    rows = np.array(image[first_row:last_row], dtype=np.uint16)
+    start = first - first_row * line
+    return first_row, rows, rows.reshape(-1)[start:start + values], skip
+
+def _put_rows(image, first_row, rows):
+    # write an array of rows back into image, in place
+    for row_n, row in enumerate(rows.tolist(), first_row):
+        image[row_n][:] = [tuple(pixel) for pixel in row]
+
+def _embed_bits(image, bitstream, offset, num_bits):
+    """
+    Write bitstream into the image IN PLACE, starting at bit offset
+    (counted the same way encode_ext walks the image: num_bits bits per
+    intensity value, intensity values in row-major order).
+    Returns the offset just past the last bit written.
+    The caller must make sure the bitstream fits.
+    """
+    import numpy as np
+    if not bitstream:
+        return offset
+    first_row, rows, values, skip = _bit_region(image, offset,
+                                                len(bitstream), num_bits)
+    # the low bits of the values holding the bitstream, with the bits
+    # before and after it (in the first and last value) kept as they are
+    stream = bits.get_planes(values, num_bits).reshape(-1)
+    stream[skip:skip + len(bitstream)] = np.frombuffer(
+        bitstream.encode('ascii'), dtype=np.uint8) - ord('0')
+    bits.insert_planes(values, np.packbits(stream), num_bits)
+    _put_rows(image, first_row, rows)
+    return offset + len(bitstream)
+
+def _extract_bits(image, offset, count, num_bits):
+    """
+    Read count bits from the image starting at bit offset; the inverse
+    of _embed_bits.
+    """
+    if count <= 0:
+        return ''
+    first_row, rows, values, skip = _bit_region(image, offset, count,
+                                                num_bits)
+    stream = bits.get_planes(values, num_bits).reshape(-1)[skip:skip + count]
+    return (stream + ord('0')).tobytes().decode('ascii')
+
+def _clear_bits(image, offset, num_bits):
+    """
+    Set every bit from offset to the end of the image to 0, like encode_ext
+    does for the intensity values left over after the message.
+    """
+    end = capacity_bits(image, num_bits)
+    if offset >= end:
+        return offset
+    first_row, rows, values, skip = _bit_region(image, offset, end - offset,
+                                                num_bits)
+    # the bits before offset in the first value are kept
+    kept = values[0] & ((1 << skip) - 1)
+    bits.insert_planes(values, b'', num_bits)
+    values[0] |= kept
+    _put_rows(image, first_row, rows)
+    return end
+
+def _indexed_capacity(capacity, index_chunk):
+    """
+    Largest payload (in bytes) that fits in capacity bytes together with
+    its chunk table.
+    """
+    length = capacity * index_chunk // (index_chunk + ENTRY_SIZE)
+    while length > 0 and \
+            length + -(-length // index_chunk) * ENTRY_SIZE > capacity:
+        length -= 1
+    return max(length, 0)
+
+def embed_file(image, payload_file, num_bits, chunk_size=4096, flags=0,
+               shard_index=0, index_chunk=None):
+    """
+    Embed the contents of an open (binary) file object into an image in
+    rectangular format, IN PLACE.
 
+    The payload is read chunk_size bytes at a time, so memory use does not
+    depend on the payload size. If the payload does not fit, as much as
+    possible is embedded, as with encode_ext.
 
+    Inputs:
+        image: a two-dimensional list of pixels, as for encode_ext
+        payload_file: file object opened for reading in binary mode
+        num_bits: integer value between 1 and 8 inclusive
+        chunk_size: number of payload bytes read at a time
+        flags, shard_index: extra header fields, see pack_header
+        index_chunk: if given, a chunk table with one entry per index_chunk
+                     payload bytes is stored, for use by decode_range
 
+    Result:
+        The number of payload bytes embedded.
+    """
+    if not _check_num_bits(num_bits):
+        return None
+    if index_chunk:
+        flags |= FLAG_INDEX
+        # table entries are recorded as chunk boundaries are reached
+        chunk_size = min(chunk_size, index_chunk)
+    size = header_size(flags)
+    capacity = capacity_bits(image, num_bits) // 8 - size
+    if capacity < 0:
+        raise ValueError('Image too small to hold a payload header')
+    if index_chunk:
+        capacity = _indexed_capacity(capacity, index_chunk)
+    # Leave room for the header; it is written last, once the length
+    # is known
+    offset = size * 8
+    length = 0
+    entries = []
+    while length < capacity:
+        n = min(chunk_size, capacity - length)
+        if index_chunk:
+            # never read across a chunk boundary
+            n = min(n, index_chunk - length % index_chunk)
+        chunk = payload_file.read(n)
+        if not chunk:
+            break
+        if index_chunk and length % index_chunk == 0:
+            entries.append(struct.pack(ENTRY_FORMAT, length, offset))
+        offset = _embed_bits(image, bits.bytes_to_bits(chunk), offset,
+                             num_bits)
+        length += len(chunk)
+    table_offset = offset
+    for entry in entries:
+        offset = _embed_bits(image, bits.bytes_to_bits(entry), offset,
+                             num_bits)
+    _clear_bits(image, offset, num_bits)
+    header = pack_header(length, flags, shard_index, index_chunk or 0,
+                         table_offset)
+    _embed_bits(image, bits.bytes_to_bits(header), 0, num_bits)
+    return length
+
+def encode_file(image_name, payload_file, num_bits, coded_image_name,
+                chunk_size=4096, flags=0, shard_index=0, index_chunk=None,
+                profile=None):
+    """
+    File version of embed_file: reads the cover from image_name and writes
+    the result to coded_image_name (which must be a lossless format;
+    ValueError otherwise). profile is as for SimpleImage.save_image.
 
+    Result:
+        The number of payload bytes embedded.
+    """
+    if not _check_num_bits(num_bits):
+        return None
+    sim.check_lossless(sim.output_format(coded_image_name))
+    image = sim.read_image(image_name)
+    length = embed_file(image, payload_file, num_bits, chunk_size, flags,
+                        shard_index, index_chunk)
+    sim.write_image(image, coded_image_name, profile=profile, lossless=True)
+    return length
 
+def _copy_payload(image, offset, length, num_bits, out_file, chunk_size):
+    """
+    Write length bytes of payload, starting at bit offset, to out_file
+    a chunk at a time.
+    """
+    remaining = length
+    while remaining:
+        n = min(chunk_size, remaining)
+        out_file.write(bits.bits_to_bytes(_extract_bits(image, offset, n * 8,
+                                                        num_bits)))
+        offset += n * 8
+        remaining -= n
+
+def decode_file(image_name, num_bits, out_file, chunk_size=4096):
+    """
+    Extract a payload embedded by encode_file, writing it to the open
+    (binary) file object out_file a chunk at a time.
 
+    Result:
+        The number of payload bytes written.
+    """
+    if not _check_num_bits(num_bits):
+        return None
+    image = sim.read_image(image_name)
+    return extract_file(image, num_bits, out_file, chunk_size)
 
+def extract_file(image, num_bits, out_file, chunk_size=4096):
+    """
+    Image version of decode_file: extracts the payload embedded by
+    embed_file from an image in rectangular format.
 
+    Result:
+        The number of payload bytes written.
+    """
+    header = read_header(image, num_bits)
+    _copy_payload(image, header.offset, header.length, num_bits, out_file,
+                  chunk_size)
+    return header.length
 
+def _top_rows_reader(image_name, width, height, num_bits):
+    """
+    read_bits(offset, count) as in _parse_header for an image file,
+    decoding the file only down to the last row holding the bits asked
+    for (see SimpleImage.read_rows). The decoded rows are kept; when bits
+    further down are needed, at least twice as many rows are decoded.
+    """
+    row_bits = width * 3 * num_bits
+    top = [None, 0]    # PIL image of the decoded top rows, its height
+
+    def read_bits(offset, count):
+        if count == 0:
+            return ''
+        first_row = offset // row_bits
+        last_row = (offset + count - 1) // row_bits
+        if last_row >= top[1]:
+            top[1] = min(height, max(last_row + 1, 2 * top[1]))
+            top[0] = sim.read_rows(image_name, top[1])
+        rows = sim.to_rectangle(top[0].crop((0, first_row, width,
+                                             last_row + 1)))
+        return _extract_bits(rows, offset - first_row * row_bits, count,
+                             num_bits)
+    return read_bits
+
+def decode_range(image_name, num_bits, start, stop):
+    """
+    Extract bytes start to stop (exclusive, like a slice) of a payload
+    that was embedded by encode_file with a chunk table (index_chunk).
 
+    The file is only decoded down to the last row holding the header,
+    the needed table entries and the requested chunks (for PNG and
+    uncompressed files, see SimpleImage.read_rows); the rows below it are
+    never decoded.
 
+    Result:
+        A bytes object; shorter than stop - start if the range runs past
+        the end of the payload.
+    """
+    if not _check_num_bits(num_bits):
+        return None
+    width, height = sim.read_size(image_name)
+    row_bits = width * 3 * num_bits
+    read_bits = _top_rows_reader(image_name, width, height, num_bits)
+
+    header = _parse_header(read_bits, row_bits * height)
+    if not header.flags & FLAG_INDEX:
+        raise ValueError('Payload has no chunk table; use decode_file')
+    stop = min(stop, header.length)
+    if start >= stop:
+        return b''
+    chunk = header.index_chunk
+    result = []
+    for k in range(start // chunk, (stop - 1) // chunk + 1):
+        entry = bits.bits_to_bytes(read_bits(
+            header.table_offset + k * ENTRY_SIZE * 8, ENTRY_SIZE * 8))
+        chunk_start, chunk_offset = struct.unpack(ENTRY_FORMAT, entry)
+        lo = max(start, chunk_start)
+        hi = min(stop, chunk_start + chunk)
+        result.append(bits.bits_to_bytes(read_bits(
+            chunk_offset + (lo - chunk_start) * 8, (hi - lo) * 8)))
+    return b''.join(result)
 
+"""
+num_bits auto-detection
+
+For images encoded with unknown settings. Instead of decoding the whole
+image once per num_bits, the leading intensity values (enough for
+scanner.SAMPLE_BYTES bytes at num_bits=1) are split into their low 8 bit
+planes once; the leading bytes of the bitstream for every num_bits are
+read from those planes and scored as in scanner.score_stream (a valid
+payload header, or printable text followed by the stop code and cleared
+bits). Only the best candidate is then decoded in full.
+"""
 
+# kind is 'text' (an encode_ext message, data is a string) or 'file' (an
+# embed_file payload, data is bytes)
+AutoResult = namedtuple('AutoResult', ['num_bits', 'kind', 'data'])
 
+def _leading_values(image, count):
+    import numpy as np
+    from itertools import chain, islice
+    values = islice(chain.from_iterable(chain.from_iterable(image)), count)
+    return np.fromiter(values, dtype=np.uint8)
 
+def detect_num_bits(image, num_bits_list=range(1, 9)):
+    """
+    Detect the num_bits an image (rectangular format, 8 bits per value)
+    was encoded with, from its leading values only.
 
+    Result:
+        (kind, num_bits, score) as scanner.best_candidate; kind and
+        num_bits are None if nothing was detected.
+    """
+    import scanner
+    values = _leading_values(image, scanner.SAMPLE_BYTES * 8)
+    return scanner.best_candidate(scanner.value_streams(values,
+                                                        num_bits_list), 1)
 
+def decode_auto(image, num_bits_list=range(1, 9)):
+    """
+    decode_ext / extract_file without knowing num_bits: detects num_bits
+    (see detect_num_bits), then decodes with that num_bits only.
 
+    Result:
+        An AutoResult. Raises ValueError if no message or payload was
+        detected.
 
+    Examples:
+        decode_auto(encode_ext(image, 'hello', 3)) ->
+            AutoResult(num_bits=3, kind='text', data='hello')
+    """
+    kind, num_bits, score = detect_num_bits(image, num_bits_list)
+    return _decode_detected(image, kind, num_bits)
+
+def _decode_detected(image, kind, num_bits):
+    if kind is None:
+        raise ValueError('No message or payload detected')
+    if kind == 'file':
+        out = io.BytesIO()
+        extract_file(image, num_bits, out)
+        return AutoResult(num_bits, kind, out.getvalue())
+    return AutoResult(num_bits, kind, decode_ext(image, num_bits))
+
+def decode_direct_auto(image_name, num_bits_list=range(1, 9)):
+    """
+    decode_auto for an image file. Detection reads only the top rows of
+    the image (see SimpleImage.read_rows), so an image with nothing in it
+    is rejected without being decoded in full.
+    """
+    import scanner
+    width, height = sim.read_size(image_name)
+    PILimage = sim.read_rows(image_name, scanner.sample_rows(width))
+    kind, num_bits, score = scanner.best_candidate(
+        scanner.sample_streams(PILimage, num_bits_list), 1)
+    if kind is None:
+        raise ValueError('No message or payload detected')
+    return _decode_detected(sim.read_image(image_name), kind, num_bits)
 
+"""
+Delta re-encoding
+
+Updating the message in an image that was encoded with encode_ext does not
+need the whole image to be encoded again: everything after the old and
+the new message (and their stop codes) is already 0 in the low num_bits
+bits. reencode reads the old message, then walks only the intensity values
+covering max(old, new) and changes those whose low bits differ.
+
+reencode_direct does the same for an image file. For uncompressed formats
+with a plain row layout (BMP, PPM, TGA with 24 bits per pixel) only the
+rows of pixels that changed are written back into the file, in place;
+other formats are rewritten in full.
+"""
 
+# Uncompressed row layouts that can be patched in place: PIL raw modes
+# with 3 bytes per pixel and nothing else in the row but padding
+PATCHABLE_RAWMODES = ('RGB', 'BGR')
 
+def _message_span(read_bits, capacity):
+    """
+    Number of bits taken up by the message at the start of an image,
+    including its stop code, using read_bits(offset, count) as in
+    _parse_header. Never more than capacity.
+    """
+    step = 64 * 8
+    offset = 0
+    while offset < capacity:
+        count = min(step, capacity - offset)
+        chunk = read_bits(offset, count)
+        for i in range(0, count - count % 8, 8):
+            if chunk[i:i + 8] == '00000000':
+                return offset + i + 8
+        offset += count
+    return capacity
+
+def _reencode_rows(image, message, num_bits, span):
+    """
+    Make the first span bits of image (in place) hold message, as
+    encode_ext would; returns the sorted list of rows that changed.
+    """
+    import numpy as np
+    if span <= 0:
+        return []
+    first_row, rows, values, skip = _bit_region(image, 0, span, num_bits)
+    new_rows = rows.copy()
+    new_values = new_rows.reshape(-1)[:len(values)]
+    # as encode_ext: the message, then 0 bits up to the end of the span
+    # (and of the last intensity value in it)
+    stream = np.unpackbits(np.frombuffer(
+        bytes(bytearray([ord(char) & 0xFF for char in message])),
+        dtype=np.uint8))[:span]
+    bits.insert_planes(new_values, np.packbits(stream), num_bits)
+    changed = np.flatnonzero((new_rows != rows).reshape(len(rows), -1)
+                             .any(axis=1))
+    for row_n in changed.tolist():
+        image[row_n][:] = [tuple(pixel) for pixel in new_rows[row_n].tolist()]
+    return changed.tolist()
+
+def reencode(image, message, num_bits):
+    """
+    Replace the message hidden in image by encode_ext with a new one,
+    IN PLACE, changing only the intensity values whose bits differ.
 
+    Inputs:
+        image: an image previously encoded with encode_ext(image, old,
+               num_bits), in rectangular format
+        message: the new message
+        num_bits: as used for the old message
 
+    Result:
+        Sorted list of the row numbers that changed; the image is then the
+        same as encode_ext(original cover, message, num_bits) apart from
+        the bits above num_bits, which are never touched.
+    """
+    if not _check_num_bits(num_bits):
+        return None
+    capacity = capacity_bits(image, num_bits)
+    if capacity == 0:
+        return []
+
+    def read_bits(offset, count):
+        return _extract_bits(image, offset, count, num_bits)
+    span = max(_message_span(read_bits, capacity), len(message) * 8 + 8)
+    return _reencode_rows(image, message, num_bits, min(span, capacity))
+
+def _raw_layout(PILimage):
+    """
+    (offset, stride, orientation, rawmode) of an uncompressed RGB image
+    file whose rows can be patched in place, or None.
+    """
+    tiles = getattr(PILimage, 'tile', None)
+    if PILimage.mode != 'RGB' or not tiles or len(tiles) != 1:
+        return None
+    codec, extents, offset, args = tiles[0]
+    if codec != 'raw' or tuple(extents) != (0, 0) + PILimage.size:
+        return None
+    if isinstance(args, str):
+        args = (args, 0, 1)
+    rawmode, stride, orientation = (tuple(args) + (0, 1))[:3]
+    if rawmode not in PATCHABLE_RAWMODES:
+        return None
+    return offset, stride or PILimage.size[0] * 3, orientation, rawmode
+
+def reencode_direct(image_name, message, num_bits, coded_image_name=None):
+    """
+    reencode for an image file. With coded_image_name None the file is
+    updated in place: for BMP/PPM/TGA style files only the changed rows
+    are written, other formats are saved again in full (as PNG files
+    etc. compress the whole image, they cannot be patched).
 
+    Result:
+        Sorted list of the row numbers that changed.
+    """
+    if not _check_num_bits(num_bits):
+        return None
+    PILimage = sim.open_image(image_name)
+    width, height = PILimage.size
+    layout = _raw_layout(PILimage)
+    if coded_image_name not in (None, image_name) or layout is None:
+        image = sim.to_rectangle(PILimage)
+        changed = reencode(image, message, num_bits)
+        if changed or coded_image_name not in (None, image_name):
+            sim.write_image(image, coded_image_name or image_name,
+                            lossless=True)
+        return changed
+    row_bits = width * 3 * num_bits
+    capacity = row_bits * height
+    if capacity == 0:
+        return []
+
+    PILimage.close()
+    read_bits = _top_rows_reader(image_name, width, height, num_bits)
+    span = min(capacity, max(_message_span(read_bits, capacity),
+                             len(message) * 8 + 8))
+    # the message region always starts at the top row
+    rows = sim.to_rectangle(sim.read_rows(image_name,
+                                          (span - 1) // row_bits + 1))
+    changed = _reencode_rows(rows, message, num_bits, span)
+    offset, stride, orientation, rawmode = layout
+    with open(image_name, 'r+b') as image_file:
+        for row_n in changed:
+            line = sim.to_flat([rows[row_n]]).tobytes('raw', rawmode)
+            if orientation < 0:
+                image_file.seek(offset + (height - 1 - row_n) * stride)
+            else:
+                image_file.seek(offset + row_n * stride)
+            image_file.write(line)
+    return changed
 
+"""
+Keyed scatter embedding
+
+encode_ext fills the image from the top-left corner, so the payload sits
+in a block at the top of the image where it is easy to spot. In scatter
+mode the k-th bit of the bitstream goes to bit slot perm[k] instead, where
+the slots are all (intensity value, bit position) pairs in the image and
+perm is a pseudo-random permutation derived from a key. Everything else
+is as in encode_ext: unused slots are set to 0, and decoding stops at the
+first zero byte.
+
+Generating the permutation is the expensive part for big images (one entry
+per bit slot), so it is done with numpy and recent permutations are kept
+in an LRU cache keyed on (key, width, height, num_bits, channels), bounded
+by their total size in bytes (SCATTER_CACHE_BYTES).
+"""
 
-
-
-
-
-
-
-
-
-
+# A 24 megapixel RGB image at num_bits=8 has about 576 million slots, so
+# 2.3 GB of index; a permutation bigger than the limit is not cached
+SCATTER_CACHE_BYTES = 1 << 30
+_scatter_cache = OrderedDict()
+_scatter_lock = threading.Lock()
+
+def _scatter_permutation(key, count):
+    import hashlib
+    import numpy as np
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    seed = int.from_bytes(hashlib.sha256(key).digest(), 'big')
+    rng = np.random.default_rng(seed)
+    # uint32 halves memory up to 2**32 slots (~178 megapixels at 8 bits);
+    # past that the values would wrap, so uint64 is used. The permutation
+    # itself does not depend on the type.
+    dtype = np.uint32 if count <= 1 << 32 else np.uint64
+    index = np.arange(count, dtype=dtype)
+    rng.shuffle(index)
+    index.setflags(write=False)
+    return index
+
+def scatter_index(key, width, height, num_bits, channels=3):
+    """
+    Permutation of the width * height * channels * num_bits bit slots of an
+    image,
+    derived from key (a string or bytes). Slot s is bit s % num_bits of
+    intensity value s // num_bits (intensity values in row-major order).
+    The returned array is read-only since it is shared through the cache.
+    """
+    cache_key = (key, width, height, num_bits, channels)
+    with _scatter_lock:
+        index = _scatter_cache.get(cache_key)
+        if index is not None:
+            _scatter_cache.move_to_end(cache_key)
+            return index
+    index = _scatter_permutation(key, width * height * channels * num_bits)
+    if index.nbytes <= SCATTER_CACHE_BYTES:
+        with _scatter_lock:
+            _scatter_cache[cache_key] = index
+            total = sum([value.nbytes for value in _scatter_cache.values()])
+            while total > SCATTER_CACHE_BYTES:
+                # least recently used first
+                old_key, old = _scatter_cache.popitem(last=False)
+                total -= old.nbytes
+    return index
+
+def scatter_cache_clear():
+    with _scatter_lock:
+        _scatter_cache.clear()
+
+def _to_array(image, depth=8):
+    # rectangular list of lists -> flat array of intensity values
+    import numpy as np
+    dtype = np.uint16 if depth > 8 else np.uint8
+    return np.array(image, dtype=dtype).reshape(-1)
+
+def _from_array(flat, width, height):
+    rows = flat.reshape(height, width, -1).tolist()
+    return [[tuple(pixel) for pixel in row] for row in rows]
+
+def encode_scatter(image, message, num_bits, key, depth=8):
+    """
+    Keyed scatter version of encode_ext; same inputs and result, but the
+    message bits are spread over the whole image in an order derived from
+    key. Must be decoded with decode_scatter and the same key.
+    """
+    import numpy as np
+    width, height = sim.get_width(image), sim.get_height(image)
+    if width * height == 0:
+        return [[] for row in image]
+    flat = _to_array(image, depth)
+    channels = len(image[0][0])
+    # same bits as message_to_bits (low 8 bits of each character)
+    data = bytearray([ord(char) & 0xFF for char in message])
+    stream = np.unpackbits(np.frombuffer(bytes(data), dtype=np.uint8))
+    index = scatter_index(key, width, height, num_bits, channels)
+    slots = index[:len(stream)]
+    stream = stream[:len(slots)].astype(flat.dtype)
+    flat &= flat.dtype.type(((1 << depth) - 1) ^ ((1 << num_bits) - 1))
+    # every slot is distinct, so summing the shifted bits per intensity
+    # value is the same as OR-ing them in
+    shifts = (slots % num_bits).astype(flat.dtype)
+    values = np.bincount(slots // num_bits, weights=stream << shifts,
+                         minlength=len(flat))
+    flat |= values.astype(flat.dtype)
+    return _from_array(flat, width, height)
+
+def decode_scatter(image, num_bits, key, block_size=65536, depth=8):
+    """
+    Inverse of encode_scatter. The bit slots are read block_size bytes at
+    a time, and reading stops at the first zero byte (the stop code), so a
+    short message in a big image only touches a few slots.
+    """
+    import numpy as np
+    width, height = sim.get_width(image), sim.get_height(image)
+    if width * height == 0:
+        return ''
+    flat = _to_array(image, depth)
+    index = scatter_index(key, width, height, num_bits, len(image[0][0]))
+    usable = len(index) - len(index) % 8
+    message = []
+    for start in range(0, usable, block_size * 8):
+        slots = index[start:min(start + block_size * 8, usable)]
+        stream = (flat[slots // num_bits] >> (slots % num_bits)) & 1
+        data = np.packbits(stream.astype(np.uint8)).tobytes()
+        end = data.find(b'\x00')
+        if end >= 0:
+            message.append(data[:end])
+            break
+        message.append(data)
+    return ''.join([chr(byte) for byte in bytearray(b''.join(message))])
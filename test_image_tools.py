@@ -0,0 +1,395 @@
+"""
+################################################################################
+Tests
+
+Notes:
+
+Regression tests for the library entry points and front ends (file
+payloads, chunk tables, shards, scatter mode, the result cache, the
+engine, pipeline and watermark fast paths, the CLI, the watch-folder
+daemon and the HTTP service), plus the bits.py doctests and a short run
+of the differential harness (differential.py compares the fast engines
+with the reference functions on random inputs).
+
+Run:
+    python -m pytest test_image_tools.py
+    python -m unittest test_image_tools
+    python differential.py              exits 1 if any case mismatches
+    python -m doctest bits.py
+################################################################################
+"""
+import asyncio
+import contextlib
+import doctest
+import io
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import bits
+import cli
+import differential
+import engine
+import image_scrambler as isc
+import metrics
+import multicover
+import multiframe
+import pipeline
+import planner
+import resultcache
+import service
+import SimpleImage as sim
+import steganography as steg
+import watcher
+import watermark
+
+def noise(width, height, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+
+class TempDirTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, *names):
+        return os.path.join(self.dir, *names)
+
+    def save(self, array, name):
+        Image.fromarray(array).save(self.path(name))
+        return self.path(name)
+
+"""
+bits.py and the differential harness
+"""
+
+class BitsTest(unittest.TestCase):
+    def test_doctests(self):
+        result = doctest.testmod(bits)
+        self.assertGreater(result.attempted, 0)
+        self.assertEqual(result.failed, 0)
+
+    def test_planes_round_trip(self):
+        values = noise(7, 5).reshape(-1)
+        for num_bits in range(1, 9):
+            data = os.urandom(values.size * num_bits // 8)
+            out = bits.insert_planes(values.copy(), data, num_bits)
+            self.assertEqual(bits.extract_planes(out, num_bits).tobytes(),
+                             data)
+
+class DifferentialTest(unittest.TestCase):
+    def test_quick_run(self):
+        count, failures = differential.run(200, seed=1)
+        self.assertEqual(count, 200)
+        self.assertEqual(failures, [])
+
+    def test_exit_status(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(differential.main(['--iterations', '20']), 0)
+
+"""
+steganography.py
+"""
+
+class FilePayloadTest(TempDirTest):
+    def test_encode_decode_file(self):
+        cover = self.save(noise(40, 30), 'cover.png')
+        payload = os.urandom(800)
+        length = steg.encode_file(cover, io.BytesIO(payload), 2,
+                                  self.path('out.png'))
+        self.assertEqual(length, len(payload))
+        out = io.BytesIO()
+        steg.decode_file(self.path('out.png'), 2, out)
+        self.assertEqual(out.getvalue(), payload)
+
+    def test_decode_range(self):
+        cover = self.save(noise(60, 50), 'cover.png')
+        payload = os.urandom(1500)
+        steg.encode_file(cover, io.BytesIO(payload), 2,
+                         self.path('out.png'), index_chunk=64)
+        for start, stop in ((0, 10), (100, 900), (1490, 2000), (5, 5)):
+            self.assertEqual(steg.decode_range(self.path('out.png'), 2,
+                                               start, stop),
+                             payload[start:stop])
+
+    def test_reencode_direct(self):
+        name = self.save(noise(30, 20), 'image.bmp')
+        expected = steg.encode_ext(sim.read_image(name), 'second', 2)
+        steg.encode_direct(name, 'a first message', 2, name)
+        steg.reencode_direct(name, 'second', 2)
+        self.assertEqual(sim.read_image(name), expected)
+
+class AutoTest(unittest.TestCase):
+    def test_auto_round_trip(self):
+        image = engine.to_rectangle(noise(20, 20))
+        encoded = steg.encode_ext(image, 'hello there', 'auto')
+        result = steg.decode_auto(encoded)
+        self.assertEqual(result.kind, 'text')
+        self.assertEqual(result.data, 'hello there')
+        self.assertEqual(result.num_bits,
+                         planner.choose_num_bits(image, 'hello there'))
+
+    def test_auto_with_key_is_rejected(self):
+        image = engine.to_rectangle(noise(8, 8))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertIsNone(steg.encode_ext(image, 'hi', 'auto', key='k'))
+
+class ScatterTest(unittest.TestCase):
+    def test_round_trip(self):
+        image = engine.to_rectangle(noise(25, 15))
+        encoded = steg.encode_ext(image, 'scattered', 2, key='secret')
+        self.assertEqual(steg.decode_ext(encoded, 2, key='secret'),
+                         'scattered')
+        self.assertNotEqual(steg.decode_ext(encoded, 2, key='other'),
+                            'scattered')
+
+    def test_permutation(self):
+        perm = steg._scatter_permutation(b'k', 1000)
+        self.assertEqual(sorted(perm.tolist()), list(range(1000)))
+        steg.scatter_cache_clear()
+
+class ShardTest(TempDirTest):
+    def test_round_trip_in_any_order(self):
+        covers = [self.save(noise(20, 20, seed), 'c{}.png'.format(seed))
+                  for seed in range(4)]
+        outputs = [self.path('s{}.png'.format(n)) for n in range(4)]
+        payload = os.urandom(800)
+        used = multicover.encode_shards(covers, io.BytesIO(payload), 2,
+                                        outputs, workers=1)
+        shards = outputs[:used]
+        random.Random(3).shuffle(shards)
+        out = io.BytesIO()
+        multicover.decode_shards(shards, 2, out, workers=1)
+        self.assertEqual(out.getvalue(), payload)
+        with self.assertRaises(ValueError):
+            multicover.decode_shards(shards[1:], 2, io.BytesIO(), workers=1)
+
+"""
+image_scrambler.py, resultcache.py, SimpleImage.py, multiframe.py
+"""
+
+class ScramblerTest(unittest.TestCase):
+    def test_tiles_round_trip(self):
+        array = noise(70, 50)
+        scrambled = isc.scramble_tiles(array, 'key', 16)
+        self.assertTrue((isc.unscramble_tiles(scrambled, b'key', 16) ==
+                         array).all())
+
+    def test_tiles_bad_arguments(self):
+        array = noise(8, 8)
+        for key, tile in ((None, 4), (5, 4), ('k', 0)):
+            with self.assertRaises(ValueError):
+                isc.scramble_tiles(array, key, tile)
+
+    def test_PILimage_argument_order(self):
+        PILimage = Image.fromarray(noise(12, 9)).convert('L')
+        scrambled = isc.scramblePILimage(PILimage, True)
+        self.assertEqual(scrambled.mode, 'L')
+        self.assertEqual(isc.unscramblePILimage(scrambled, True).mode, 'L')
+        cache = resultcache.ResultCache()
+        first = isc.unscramblePILimage(scrambled, True, cache=cache)
+        second = isc.unscramblePILimage(scrambled, True, cache=cache)
+        self.assertEqual(first.tobytes(), second.tobytes())
+        self.assertEqual(cache.hits, 1)
+
+class CacheKeyTest(unittest.TestCase):
+    def test_palette_is_part_of_the_key(self):
+        first = Image.new('P', (4, 4))
+        first.putpalette([0, 0, 0] * 256)
+        second = first.copy()
+        second.putpalette([255, 0, 0] * 256)
+        self.assertNotEqual(resultcache.image_key(first, 'decode'),
+                            resultcache.image_key(second, 'decode'))
+
+class ReadRowsTest(TempDirTest):
+    def test_formats(self):
+        array = noise(23, 37)
+        for extension in ('png', 'bmp', 'ppm', 'tga', 'tif'):
+            name = self.save(array, 'image.' + extension)
+            for rows in (-1, 0, 1, 10, 37, 50):
+                top = sim.read_rows(name, rows)
+                expected = array[:max(0, min(rows, 37))]
+                self.assertEqual(top.size, (23, len(expected)))
+                self.assertTrue((np.asarray(top.convert('RGB')) ==
+                                 expected).all())
+
+    def test_lossy_formats(self):
+        with self.assertRaises(ValueError):
+            sim.check_lossless('GIF')
+        sim.check_lossless('PNG')
+
+class FramesTest(TempDirTest):
+    def test_loading_strategy_is_restored(self):
+        from PIL import GifImagePlugin
+        frames = [Image.fromarray(noise(10, 10, seed)).convert('P')
+                  for seed in range(3)]
+        name = self.path('anim.gif')
+        frames[0].save(name, save_all=True, append_images=frames[1:])
+        saved = GifImagePlugin.LOADING_STRATEGY
+        self.assertEqual(multiframe.count_frames(name), 3)
+        self.assertEqual(GifImagePlugin.LOADING_STRATEGY, saved)
+
+"""
+engine.py, pipeline.py, watermark.py, metrics.py
+"""
+
+class FastPathTest(unittest.TestCase):
+    def test_batch_matches_single(self):
+        images = [noise(9, 7, seed) for seed in range(3)]
+        messages = ['a', 'bb', '']
+        batch = engine.encode_ext_batch(images, messages, 2)
+        for image, message, encoded in zip(images, messages, batch):
+            self.assertTrue((engine.encode_ext(image, message, 2) ==
+                             encoded).all())
+        self.assertEqual(engine.decode_ext_batch(batch, 2), messages)
+
+    def test_prepared_cover(self):
+        array = noise(16, 12)
+        cover = watermark.PreparedCover(Image.fromarray(array), 1)
+        for message in ('', 'for alice', 'x' * 100):
+            self.assertTrue((cover.encode(message) ==
+                             engine.encode_ext(array, message, 1)).all())
+        with self.assertRaises(ValueError):
+            watermark.PreparedCover(Image.fromarray(array), 9)
+
+    def test_metrics_on_fast_paths(self):
+        def count(operation):
+            return metrics.OPERATIONS.values.get((operation,), 0)
+        before = dict((name, count(name)) for name in
+                      ('encode_ext', 'scramble', 'encode_ext_batch',
+                       'pipeline'))
+        array = noise(9, 7)
+        engine.encode_ext(array, 'hi', 1)
+        engine.scramble(array)
+        engine.encode_ext_batch([array], ['hi'], 1)
+        pipeline.Pipeline([pipeline.Scramble()]).run(array)
+        if metrics.enabled():
+            for name, value in before.items():
+                self.assertGreater(count(name), value, name)
+
+"""
+Front ends
+"""
+
+class CLITest(TempDirTest):
+    def run_cli(self, args, data=b''):
+        stdin = io.TextIOWrapper(io.BytesIO(data))
+        stdout = io.TextIOWrapper(io.BytesIO())
+        stderr = io.StringIO()
+        saved = sys.stdin, sys.stdout, sys.stderr
+        sys.stdin, sys.stdout, sys.stderr = stdin, stdout, stderr
+        try:
+            try:
+                status = cli.main(args)
+            except SystemExit as e:
+                status = e.code
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved
+        return status, stdout.buffer.getvalue(), stderr.getvalue()
+
+    def png(self):
+        out = io.BytesIO()
+        Image.fromarray(noise(30, 20)).save(out, 'PNG')
+        return out.getvalue()
+
+    def test_round_trip_auto(self):
+        status, image, error = self.run_cli(
+            ['encode', '-n', 'auto', '-m', 'hello'], self.png())
+        self.assertEqual(status, 0, error)
+        status, message, error = self.run_cli(['decode', '-n', 'auto'], image)
+        self.assertEqual((status, message), (0, b'hello'))
+
+    def test_errors_go_to_stderr(self):
+        payload = self.path('payload.bin')
+        with open(payload, 'wb') as outfile:
+            outfile.write(b'data')
+        for args, data in ((['encode', '-n', '9', '-m', 'hi'], self.png()),
+                           (['decode'], b'not an image'),
+                           (['encode', '--key', 'k', '--payload', payload],
+                            self.png())):
+            status, output, error = self.run_cli(args, data)
+            self.assertEqual(status, 2, args)
+            self.assertEqual(output, b'', args)
+            self.assertTrue(error, args)
+
+class WatcherTest(TempDirTest):
+    def test_new_output_directory(self):
+        os.mkdir(self.path('in'))
+        daemon = watcher.WatchDaemon(self.path('in'), 'scramble',
+                                     self.path('out', 'new'),
+                                     force_poll=True)
+        daemon.journal.close()
+        self.assertTrue(os.path.isdir(self.path('out', 'new')))
+
+    def test_oversized_payload_does_not_block_covers(self):
+        os.mkdir(self.path('in'))
+        os.mkdir(self.path('payloads'))
+        self.save(noise(10, 10), os.path.join('in', 'small.png'))
+        self.save(noise(100, 100), os.path.join('in', 'big.png'))
+        with open(self.path('payloads', '1-big'), 'wb') as outfile:
+            outfile.write(os.urandom(2000))
+        with open(self.path('payloads', '2-small'), 'wb') as outfile:
+            outfile.write(b'hi')
+        daemon = watcher.WatchDaemon(self.path('in'), 'encode',
+                                     self.path('out'), 1,
+                                     self.path('payloads'), workers=1,
+                                     force_poll=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            with ProcessPoolExecutor(1) as pool:
+                daemon.scan(pool)
+                while daemon.pending:
+                    daemon.collect(timeout=None)
+        daemon.journal.close()
+        used = sorted(os.path.basename(name)
+                      for name in daemon.journal.used_payloads)
+        self.assertEqual(used, ['1-big', '2-small'])
+        self.assertEqual(len(daemon.journal.done), 2)
+
+class ServiceTest(unittest.TestCase):
+    def test_broken_pool_is_replaced(self):
+        async def run():
+            svc = service.ImageService(workers=1)
+            svc.pool = ProcessPoolExecutor(1)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(svc.pool, os.getpid)
+            for pid in list(svc.pool._processes):
+                os.kill(pid, signal.SIGKILL)
+            await asyncio.sleep(0.5)
+            out = io.BytesIO()
+            Image.fromarray(noise(8, 8)).save(out, 'PNG')
+            results = []
+            for attempt in range(2):
+                slots = asyncio.Semaphore(0)
+                future = loop.create_future()
+                await svc._run([('scramble', {}, out.getvalue(), future)],
+                               slots)
+                results.append(future.result()[0])
+            svc.pool.shutdown()
+            return results, svc.stats['pool_restarts']
+        self.assertEqual(asyncio.run(run()), (['failed', 'ok'], 1))
+
+    def test_bad_chunk_size(self):
+        async def run():
+            svc = service.ImageService(workers=1)
+            reader = asyncio.StreamReader()
+            reader.feed_data(b'-5\r\nabc\r\n')
+            reader.feed_eof()
+            try:
+                await svc._read_body(reader,
+                                     {'transfer-encoding': 'chunked'})
+            except service.HTTPError as e:
+                return e.status, e.close
+        self.assertEqual(asyncio.run(run()), (400, True))
+
+if __name__ == '__main__':
+    unittest.main()
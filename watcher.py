@@ -0,0 +1,385 @@
+"""
+################################################################################
+Watch-folder daemon
+
+Notes:
+
+Watches a directory and runs one operation (encode, decode, scramble or
+unscramble) on every new image that appears in it, writing the results to
+an output directory. Used instead of a cron job that re-scans everything.
+
+- New files are noticed with inotify (Linux) when available, otherwise by
+  polling the directory. On start-up the directory is scanned once, so
+  files that arrived while the daemon was down are picked up too.
+- Work is spread over a process pool.
+- Every processed file is recorded in a journal (one JSON object per line)
+  together with its size and modification time, so a restart does not
+  reprocess the backlog; a file that is replaced by a new version (different
+  size or mtime) is processed again.
+- For encode, payloads are taken in name order from a payload directory
+  (the queue) and embedded with encode_file; each payload is used once,
+  which is also recorded in the journal. Each cover gets the first unused
+  payload that fits in it (at --num-bits); a payload too big for it stays
+  in the queue for a bigger image, and a cover that no payload fits waits
+  (unjournaled) for the next scan.
+- Decode writes the payload to <name>.bin if the image carries a file
+  payload (encode_file), otherwise the text message to <name>.txt.
+
+Run:
+    python watcher.py incoming --op scramble --out scrambled
+    python watcher.py covers --op encode --payloads outbox --out encoded
+################################################################################
+"""
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+OPERATIONS = ('encode', 'decode', 'scramble', 'unscramble')
+IMAGE_EXTENSIONS = ('.png', '.bmp', '.gif', '.tif', '.tiff', '.ppm', '.webp')
+
+"""
+Worker side
+"""
+
+class PayloadTooLarge(ValueError):
+    """
+    The payload handed to an encode job does not fit in the cover. Not a
+    final state: the cover is tried again with another payload.
+    """
+
+def payload_fits(src, payload, num_bits):
+    """
+    True if the file payload fits in the image src with encode_file at
+    num_bits (only the image header is read).
+    """
+    import planner
+    import SimpleImage as sim
+    width, height = sim.read_size(src)
+    return planner.plan_file(width, height, os.path.getsize(payload),
+                             max_num_bits=num_bits) is not None
+
+def process_file(op, src, out_dir, num_bits=1, payload=None):
+    """
+    Run op on the image src, writing the result to out_dir.
+    Returns the output filename.
+    """
+    import steganography as steg
+    import image_scrambler as isc
+    import SimpleImage as sim
+
+    name = os.path.splitext(os.path.basename(src))[0]
+    if op == 'encode':
+        dst = os.path.join(out_dir, name + '.png')
+        # a payload that does not fit would be cut short; fail the job
+        # instead, so the payload is not used up (e.g. it grew after the
+        # daemon checked it)
+        if not payload_fits(src, payload, num_bits):
+            raise PayloadTooLarge('payload {} ({} bytes) does not fit in {} '
+                                  'at num_bits={}'.format(
+                                      payload, os.path.getsize(payload),
+                                      src, num_bits))
+        size = os.path.getsize(payload)
+        with open(payload, 'rb') as payload_file:
+            length = steg.encode_file(src, payload_file, num_bits, dst)
+        if length != size:
+            # e.g. the payload changed while it was being read
+            os.remove(dst)
+            raise ValueError('only {} of {} bytes of {} were embedded'
+                             .format(length, size, payload))
+    elif op == 'decode':
+        image = sim.read_image(src)
+        try:
+            steg.read_header(image, num_bits)
+            has_payload = True
+        except ValueError:
+            has_payload = False
+        if has_payload:
+            dst = os.path.join(out_dir, name + '.bin')
+            with open(dst, 'wb') as outfile:
+                steg.extract_file(image, num_bits, outfile, 65536)
+        else:
+            dst = os.path.join(out_dir, name + '.txt')
+            with open(dst, 'w') as outfile:
+                outfile.write(steg.decode_ext(image, num_bits))
+    else:
+        dst = os.path.join(out_dir, name + '.png')
+        PILimage = sim.open_image(src)
+        if op == 'scramble':
+            output = isc.scramblePILimage(PILimage)
+        else:
+            output = isc.unscramblePILimage(PILimage)
+        output.save(dst)
+    return dst
+
+"""
+Journal
+"""
+
+class Journal(object):
+    """
+    Append-only record of processed files and used payloads.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = set()
+        self.used_payloads = set()
+        if os.path.exists(filename):
+            with open(filename) as infile:
+                for line in infile:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a torn last line from a crash
+                        continue
+                    self.done.add((entry['path'], entry['size'],
+                                   entry['mtime']))
+                    if entry.get('payload'):
+                        self.used_payloads.add(entry['payload'])
+        self._file = open(filename, 'a')
+
+    def seen(self, key):
+        return key in self.done
+
+    def record(self, key, status, output=None, payload=None):
+        path, size, mtime = key
+        entry = {'path': path, 'size': size, 'mtime': mtime,
+                 'status': status, 'output': output, 'time': time.time()}
+        if payload:
+            entry['payload'] = payload
+            self.used_payloads.add(payload)
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done.add(key)
+
+    def close(self):
+        self._file.close()
+
+"""
+Watching
+"""
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+EVENT_HEADER = struct.Struct('iIII')
+
+class InotifyWatcher(object):
+    """
+    Minimal inotify wrapper (via ctypes): yields names of files that were
+    closed after writing or moved into the directory.
+    """
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def poll(self, timeout):
+        names = []
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return names
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(object):
+    """
+    Fallback when inotify is not available: lists the directory every
+    interval seconds and reports files whose size and mtime have stopped
+    changing since the previous listing (i.e. finished being written).
+    """
+    def __init__(self, directory, interval=2.0):
+        self.directory = directory
+        self.interval = interval
+        self._last = {}
+
+    def poll(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        current = {}
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                current[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        names = [name for name, state in current.items()
+                 if self._last.get(name) == state]
+        self._last = current
+        return names
+
+    def close(self):
+        pass
+
+def make_watcher(directory, force_poll=False, interval=2.0):
+    if not force_poll:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError, TypeError):
+            pass
+    return PollingWatcher(directory, interval)
+
+"""
+Daemon
+"""
+
+class WatchDaemon(object):
+    def __init__(self, directory, op, out_dir, num_bits=1, payload_dir=None,
+                 workers=None, journal=None, force_poll=False,
+                 interval=2.0):
+        if op not in OPERATIONS:
+            raise ValueError('op must be one of {}'.format(OPERATIONS))
+        if op == 'encode' and payload_dir is None:
+            raise ValueError('encode needs a payload directory')
+        if os.path.abspath(directory) == os.path.abspath(out_dir):
+            raise ValueError('output directory must differ from the '
+                             'watched directory')
+        self.directory = directory
+        self.op = op
+        self.out_dir = out_dir
+        self.num_bits = num_bits
+        self.payload_dir = payload_dir
+        self.workers = workers or os.cpu_count() or 1
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        self.journal = Journal(journal or
+                               os.path.join(out_dir, '.watcher-journal'))
+        self.watcher = make_watcher(directory, force_poll, interval)
+        self.pending = {}
+        self.queued = set()
+
+    def _key(self, name):
+        path = os.path.join(self.directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    def _next_payload(self, src):
+        # first unused payload (in name order) that fits in the cover src
+        in_use = set(payload for key, payload in self.pending.values())
+        for name in sorted(os.listdir(self.payload_dir)):
+            path = os.path.abspath(os.path.join(self.payload_dir, name))
+            if os.path.isfile(path) and path not in in_use and \
+                    path not in self.journal.used_payloads and \
+                    payload_fits(src, path, self.num_bits):
+                return path
+        return None
+
+    def submit(self, pool, name):
+        """
+        Queue an image for processing unless it is not an image, already
+        processed (per the journal) or already in progress.
+        """
+        if name.startswith('.') or \
+                not name.lower().endswith(IMAGE_EXTENSIONS):
+            return
+        key = self._key(name)
+        if key is None or self.journal.seen(key) or key in self.queued:
+            return
+        payload = None
+        if self.op == 'encode':
+            try:
+                payload = self._next_payload(key[0])
+            except OSError:
+                # not readable as an image; the job fails and is recorded
+                payload = None
+            else:
+                if payload is None:
+                    # nothing that fits to embed yet; picked up again on
+                    # the next scan
+                    return
+        future = pool.submit(process_file, self.op, key[0], self.out_dir,
+                             self.num_bits, payload)
+        self.pending[future] = (key, payload)
+        self.queued.add(key)
+
+    def collect(self, timeout=0):
+        if not self.pending:
+            return
+        done, _ = wait(list(self.pending), timeout=timeout,
+                       return_when=FIRST_COMPLETED)
+        for future in done:
+            key, payload = self.pending.pop(future)
+            self.queued.discard(key)
+            try:
+                output = future.result()
+                self.journal.record(key, 'ok', output, payload)
+                print('{} -> {}'.format(key[0], output))
+            except PayloadTooLarge as e:
+                # not recorded: the cover gets another payload on the next
+                # scan
+                print('{} skipped: {}'.format(key[0], e))
+            except Exception as e:
+                # recorded so a bad file is not retried forever; a new
+                # version of it (different size/mtime) will be
+                self.journal.record(key, 'error: {}'.format(e))
+                print('{} failed: {}'.format(key[0], e))
+
+    def scan(self, pool):
+        for name in sorted(os.listdir(self.directory)):
+            self.submit(pool, name)
+
+    def run(self, rescan_interval=60.0):
+        with ProcessPoolExecutor(self.workers) as pool:
+            self.scan(pool)
+            last_scan = time.time()
+            try:
+                while True:
+                    for name in self.watcher.poll(0.5):
+                        self.submit(pool, name)
+                    self.collect()
+                    # occasional full scan catches events missed while the
+                    # pool was busy, and covers waiting for a payload
+                    if time.time() - last_scan > rescan_interval:
+                        self.scan(pool)
+                        last_scan = time.time()
+            finally:
+                while self.pending:
+                    self.collect(timeout=None)
+                self.watcher.close()
+                self.journal.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watch-folder daemon')
+    parser.add_argument('directory')
+    parser.add_argument('--op', choices=OPERATIONS, required=True)
+    parser.add_argument('--out', required=True, help='output directory')
+    parser.add_argument('--num-bits', type=int, default=1)
+    parser.add_argument('--payloads', help='payload queue directory (encode)')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--journal', default=None)
+    parser.add_argument('--poll', action='store_true',
+                        help='poll instead of using inotify')
+    parser.add_argument('--interval', type=float, default=2.0,
+                        help='polling interval in seconds')
+    args = parser.parse_args(argv)
+    daemon = WatchDaemon(args.directory, args.op, args.out, args.num_bits,
+                         args.payloads, args.workers, args.journal,
+                         args.poll, args.interval)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
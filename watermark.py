@@ -0,0 +1,127 @@
+"""
+################################################################################
+Per-recipient watermarking
+
+Notes:
+
+Embedding thousands of different short messages into the same cover with
+encode_ext decodes the cover, clears the low bits of every intensity value
+and walks the whole image again for every message. A PreparedCover does
+the work that is the same for every message once:
+
+- the cover is read into a pixel buffer (see engine.py) and the low
+  num_bits bits of every intensity value are cleared; the result is kept
+  read-only, along with a PIL image of it
+- a message only changes the rows holding its bits (encode_ext leaves
+  the rest exactly as the cleared buffer), so encoding one copies just
+  those rows, writes the message bits into them (bits.insert_planes) and
+  pastes them over a copy of the cleared image
+
+    cover = watermark.PreparedCover('cover.png', 1)
+    cover.write_many([('for alice', 'alice.png'), ('for bob', 'bob.png')])
+
+The output is the same as encode_ext(read_image('cover.png'), message, 1).
+write_many saves the images on a thread pool; PIL releases the GIL while
+compressing, so the saves run in parallel.
+################################################################################
+"""
+from concurrent.futures import ThreadPoolExecutor
+import bits
+import engine
+import metrics
+import SimpleImage as sim
+
+class PreparedCover(object):
+    """
+    A cover image prepared for encode_ext with num_bits. image is a file
+    name or a PIL image; with native=True it is used in its own mode and
+    bit depth (as SimpleImage.to_rectangle).
+    """
+    def __init__(self, image, num_bits, native=False):
+        if isinstance(image, str):
+            image = sim.open_image(image)
+        array, self.mode = engine.from_pil(image, native)
+        self.depth = sim.get_depth(self.mode)
+        engine.check_num_bits(num_bits, self.depth)
+        self.num_bits = num_bits
+        self.height, self.width, self.channels = array.shape
+        # an empty message clears the low bits of every value
+        self.cleared = bits.insert_planes(array, b'', num_bits)
+        self.cleared.setflags(write=False)
+        self.PILimage = engine.to_pil(self.cleared, self.mode)
+
+    def capacity(self):
+        """
+        Number of whole message characters that fit (longer messages are
+        cut off, as in encode_ext).
+        """
+        return self.cleared.size * self.num_bits // 8
+
+    def region(self, message):
+        """
+        The rows holding the bits of message.
+
+        Result:
+            (rows, array): the message is in the top rows rows of the
+            encoded image, array is a new (rows, width, channels) array
+            holding them. Everything below is the same as the cleared
+            cover.
+        """
+        # insert_planes cuts off the bits that do not fit, including the
+        # leading bits of a character only partly inside, as encode_ext
+        data = engine.message_bytes(message)
+        values = min(-(-len(data) * 8 // self.num_bits), self.cleared.size)
+        line = self.width * self.channels
+        rows = -(-values // line) if line else 0
+        head = self.cleared[:rows].copy()
+        bits.insert_planes(head, data, self.num_bits)
+        return rows, head
+
+    def encode(self, message):
+        """
+        Same result as encode_ext on the cover, as an array.
+        """
+        rows, head = self.region(message)
+        out = self.cleared.copy()
+        out[:rows] = head
+        return out
+
+    def encodePILimage(self, message):
+        """
+        Same result as encode_ext on the cover, as a PIL image.
+        """
+        span = metrics.start('prepared_encode')
+        rows, head = self.region(message)
+        span.lap('embed')
+        PILimage = self.PILimage.copy()
+        if rows:
+            PILimage.paste(engine.to_pil(head, self.mode), (0, 0))
+        span.lap('copy')
+        span.done(rows * self.width, len(message), head.nbytes)
+        return PILimage
+
+    def write(self, message, filename, profile=None):
+        """
+        Encode message and save the result to filename (lossy formats
+        raise ValueError, see SimpleImage.save_image).
+        """
+        sim.save_image(self.encodePILimage(message), filename, profile,
+                       lossless=True)
+        return filename
+
+    def write_many(self, items, workers=4, profile=None):
+        """
+        write() for every (message, filename) pair in items, on workers
+        threads.
+
+        Result:
+            List of the filenames, in the same order as items.
+        """
+        items = list(items)
+        for message, filename in items:
+            # fail before doing any work if an output format is lossy
+            sim.check_lossless(sim.output_format(filename))
+        with ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(self.write, message, filename, profile)
+                       for message, filename in items]
+            return [future.result() for future in futures]